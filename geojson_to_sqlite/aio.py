@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import io
+import itertools
+import os
+import sqlite3
+import sqlite_utils
+
+from . import utils
+from .streams import ChunkReader
+
+# Maximum number of chunks, or batches of features, waiting to be imported
+QUEUE_SIZE = 16
+
+
+class _Abort:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+async def import_features_async(
+    db_path,
+    table,
+    source,
+    nl=False,
+    decoder="auto",
+    queue_size=QUEUE_SIZE,
+    executor=None,
+    **kwargs
+):
+    """
+    Import GeoJSON from an async iterator without blocking the event loop.
+
+    source can yield chunks of bytes (or str) making up a GeoJSON
+    document, or newline-delimited GeoJSON if nl is True, or feature
+    dictionaries. Chunks are parsed incrementally as they arrive.
+
+    Parsing, conversion and SQLite writes run in a thread from executor,
+    or the loop's default executor. At most queue_size chunks or batches
+    of features are buffered between the two, so a source that is faster
+    than the import is paused until it catches up.
+
+    Other keyword arguments are passed to import_features(). db_path can
+    be a path or a sqlite_utils.Database created with
+    check_same_thread=False.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    source = source.__aiter__()
+    try:
+        first = await source.__anext__()
+    except StopAsyncIteration:
+        return None
+    streaming = isinstance(first, (bytes, bytearray, memoryview, str))
+
+    def get():
+        return asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+
+    def run():
+        items = _iter_queue(get)
+        if not streaming:
+            features = itertools.chain.from_iterable(items)
+            return utils.import_features(_database(db_path), table, features, **kwargs)
+        features = utils.get_features(
+            io.BufferedReader(ChunkReader(items)), nl, decoder
+        )
+        # Closed so that a failed import stops any read-ahead thread
+        with contextlib.closing(features):
+            return utils.import_features(_database(db_path), table, features, **kwargs)
+
+    worker = loop.run_in_executor(executor, run)
+    producer = asyncio.ensure_future(
+        _produce(queue, first, source, streaming, kwargs.get("batch_size", 100))
+    )
+    try:
+        await asyncio.wait([worker, producer], return_when=asyncio.FIRST_COMPLETED)
+        if producer.done() and producer.exception() is None:
+            return await worker
+        if producer.done():
+            # The source failed: stop the import, then raise its exception
+            await _abort(queue, producer.exception())
+            await asyncio.wait([worker])
+            # The worker re-raised the same exception, mark it as retrieved
+            worker.exception()
+            raise producer.exception()
+        # The import finished or failed before reading everything
+        producer.cancel()
+        return await worker
+    except asyncio.CancelledError:
+        producer.cancel()
+        await _abort(queue, asyncio.CancelledError())
+        raise
+
+
+async def _produce(queue, first, source, streaming, batch_size):
+    if streaming:
+        await queue.put(_to_bytes(first))
+        async for chunk in source:
+            await queue.put(_to_bytes(chunk))
+    else:
+        # Features are queued in batches to keep per-item overhead low
+        batch = [first]
+        async for feature in source:
+            batch.append(feature)
+            if len(batch) >= batch_size:
+                await queue.put(batch)
+                batch = []
+        if batch:
+            await queue.put(batch)
+    await queue.put(_END)
+
+
+async def _abort(queue, exception):
+    # Make room so that the worker is never left blocked waiting on the queue
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(_Abort(exception))
+
+
+def _iter_queue(get):
+    while True:
+        item = get()
+        if item is _END:
+            return
+        if isinstance(item, _Abort):
+            raise item.exception
+        yield item
+
+
+def _to_bytes(chunk):
+    if isinstance(chunk, str):
+        return chunk.encode("utf-8")
+    return bytes(chunk)
+
+
+def _database(db_path):
+    if isinstance(db_path, sqlite_utils.Database):
+        return db_path
+    # The returned Table may be used from the event loop's thread
+    return sqlite_utils.Database(
+        sqlite3.connect(os.fspath(db_path), check_same_thread=False)
+    )
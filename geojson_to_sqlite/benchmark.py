@@ -0,0 +1,244 @@
+"""
+Benchmarks for the import pipeline.
+
+    python -m geojson_to_sqlite.benchmark --count 100000 -o results.json
+
+Generates synthetic GeoJSON, imports it using each mode in a fresh
+process and records features/second, peak RSS and database size.
+"""
+
+from sqlite_utils.utils import find_spatialite
+import click
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shapely
+import sqlite3
+import sqlite_utils
+import sys
+import tempfile
+import time
+
+from . import utils
+from .decoders import DECODERS
+
+DATASETS = ("points", "multipolygons", "wide")
+
+# name: (keyword arguments for import_features, read as newline-delimited)
+MODES = {
+    "plain": ({}, False),
+    "nl": ({}, True),
+    "spatialite": ({"spatialite": True}, False),
+    "spatialite-wkb": ({"spatialite": True, "geometry_format": "wkb"}, False),
+    "spatial-index": ({"spatial_index": True}, False),
+    "pk-upsert": ({"pk": "fid"}, False),
+    "properties": ({"properties": "properties"}, False),
+}
+SPATIALITE_MODES = ("spatialite", "spatialite-wkb", "spatial-index")
+
+
+def generate_features(dataset, count, ids=True, seed=0):
+    "Yield count synthetic GeoJSON features of the given kind"
+    rnd = random.Random(seed)
+    for i in range(count):
+        x, y = rnd.uniform(-180, 180), rnd.uniform(-85, 85)
+        properties = {"fid": i, "name": "feature {}".format(i)}
+        if dataset == "points":
+            geometry = {"type": "Point", "coordinates": [x, y]}
+        elif dataset == "multipolygons":
+            geometry = {
+                "type": "MultiPolygon",
+                "coordinates": [
+                    [_ring(rnd, x + part * 0.1, y, rnd.randint(20, 200))]
+                    for part in range(rnd.randint(1, 5))
+                ],
+            }
+        elif dataset == "wide":
+            geometry = {"type": "Point", "coordinates": [x, y]}
+            for column in range(100):
+                if column % 3 == 0:
+                    properties["int_{}".format(column)] = rnd.randint(0, 1000000)
+                elif column % 3 == 1:
+                    properties["float_{}".format(column)] = rnd.random()
+                else:
+                    properties["text_{}".format(column)] = "value {}".format(
+                        rnd.randint(0, 1000)
+                    )
+        else:
+            raise ValueError("Unknown dataset: {}".format(dataset))
+        feature = {"type": "Feature", "properties": properties, "geometry": geometry}
+        if ids:
+            feature["id"] = i
+        yield feature
+
+
+def _ring(rnd, cx, cy, points):
+    radius = rnd.uniform(0.001, 0.05)
+    ring = [
+        [
+            cx + radius * math.cos(2 * math.pi * p / points),
+            cy + radius * math.sin(2 * math.pi * p / points),
+        ]
+        for p in range(points)
+    ]
+    ring.append(ring[0])
+    return ring
+
+
+def write_dataset(directory, dataset, count, ids=True):
+    """
+    Write a dataset as both a FeatureCollection and newline-delimited
+    GeoJSON, returning the two paths.
+    """
+    name = "{}-{}{}".format(dataset, count, "" if ids else "-noids")
+    collection_path = os.path.join(directory, name + ".geojson")
+    nl_path = os.path.join(directory, name + ".ndjson")
+    with open(collection_path, "w") as collection, open(nl_path, "w") as nl:
+        collection.write('{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(generate_features(dataset, count, ids)):
+            line = json.dumps(feature)
+            collection.write(("," if i else "") + line + "\n")
+            nl.write(line + "\n")
+        collection.write("]}\n")
+    return collection_path, nl_path
+
+
+def run_import(path, db_path, mode, decoder="auto"):
+    "Import path into db_path using mode, returning a results dictionary"
+    kwargs, nl = MODES[mode]
+    if mode == "pk-upsert":
+        # Time upserting over rows that are already there
+        with open(path, "rb") as fp:
+            features = utils.get_features(fp, nl, decoder)
+            utils.import_features(db_path, "features", features, **kwargs)
+    start = time.perf_counter()
+    with open(path, "rb") as fp:
+        features = utils.get_features(fp, nl, decoder)
+        table = utils.import_features(db_path, "features", features, **kwargs)
+    elapsed = time.perf_counter() - start
+    count = table.count
+    table.db.close()
+    return {
+        "features": count,
+        "seconds": elapsed,
+        "features_per_second": count / elapsed if elapsed else None,
+        "peak_rss_bytes": peak_rss(),
+        "db_size_bytes": os.path.getsize(db_path),
+    }
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_benchmarks(
+    datasets, modes, count, ids=True, repeat=1, directory=None, decoders=("auto",)
+):
+    """
+    Run every combination of dataset, mode and JSON decoder, each import
+    in a new process so that its peak RSS is measured independently.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for dataset in datasets:
+            collection_path, nl_path = write_dataset(tmp, dataset, count, ids)
+            for mode in modes:
+                path = nl_path if MODES[mode][1] else collection_path
+                for decoder in decoders:
+                    for run in range(repeat):
+                        db_path = os.path.join(tmp, "benchmark-{}.db".format(run))
+                        with context.Pool(1) as pool:
+                            result = pool.apply(
+                                run_import, (path, db_path, mode, decoder)
+                            )
+                        os.remove(db_path)
+                        result.update(
+                            {
+                                "dataset": dataset,
+                                "mode": mode,
+                                "decoder": decoder,
+                                "run": run,
+                            }
+                        )
+                        results.append(result)
+    return results
+
+
+def environment():
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "sqlite_utils": getattr(sqlite_utils, "__version__", None),
+        "shapely": shapely.__version__,
+    }
+
+
+@click.command()
+@click.option(
+    "datasets",
+    "--dataset",
+    type=click.Choice(DATASETS),
+    multiple=True,
+    help="Datasets to generate, defaults to all of them",
+)
+@click.option(
+    "modes",
+    "--mode",
+    type=click.Choice(list(MODES)),
+    multiple=True,
+    help="Import modes to run, defaults to all that are available",
+)
+@click.option(
+    "decoders",
+    "--decoder",
+    type=click.Choice(DECODERS),
+    multiple=True,
+    help="JSON decoders to compare, defaults to auto",
+)
+@click.option("--count", type=int, default=10000, show_default=True)
+@click.option("--no-ids", is_flag=True, help="Generate features without ids")
+@click.option("--repeat", type=int, default=1, show_default=True)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="File to write the JSON results to",
+)
+def cli(datasets, modes, decoders, count, no_ids, repeat, output):
+    "Benchmark geojson-to-sqlite imports against synthetic data"
+    if not modes:
+        modes = [
+            mode for mode in MODES if mode not in SPATIALITE_MODES or find_spatialite()
+        ]
+    results = run_benchmarks(
+        datasets or DATASETS,
+        modes,
+        count,
+        ids=not no_ids,
+        repeat=repeat,
+        decoders=decoders or ("auto",),
+    )
+    json.dump(
+        {"environment": environment(), "count": count, "results": results},
+        output,
+        indent=2,
+    )
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,122 @@
+import hashlib
+import itertools
+import json
+
+HASH_COLUMN = "_geojson_hash"
+
+
+def content_hash(record):
+    "Hash of a record's properties and GeoJSON geometry, before conversion"
+    encoded = json.dumps(record, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class ChangeDetector:
+    """
+    Skips records whose content hash matches the one stored with the
+    existing row, so that re-importing a mostly unchanged layer only
+    writes the rows that are new or have changed.
+
+    Records must have been produced by yield_records() with
+    hash_column=HASH_COLUMN. The same detector can be used for several
+    imports into the same table; call delete_missing() after the last
+    one to remove rows that none of them contained.
+    """
+
+    def __init__(self, db, table, pk, track_seen=False, batch_size=500):
+        self.db = db
+        self.table = table
+        self.pk = pk
+        self.batch_size = batch_size
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        self.seen_table = None
+        self.has_column = False
+        if track_seen:
+            # A TEMP table, so tracking unchanged rows does not write to the
+            # main database file
+            self.seen_table = "geojson_seen_{}".format(table)
+            db.execute("drop table if exists temp.[{}]".format(self.seen_table))
+            db.execute(
+                "create temp table [{}] (pk primary key)".format(self.seen_table)
+            )
+
+    def ensure_column(self):
+        if self.has_column:
+            return
+        table = self.db[self.table]
+        if table.exists():
+            if HASH_COLUMN not in table.columns_dict:
+                table.add_column(HASH_COLUMN, str)
+            self.has_column = True
+
+    def filter(self, records):
+        "Yield only the records that are new or have changed"
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                break
+            existing = self._existing_hashes([record[self.pk] for record in batch])
+            if self.seen_table:
+                with transaction(self.db):
+                    self.db.conn.executemany(
+                        "insert or ignore into temp.[{}] (pk) values (?)".format(
+                            self.seen_table
+                        ),
+                        [(record[self.pk],) for record in batch],
+                    )
+            for record in batch:
+                key = record[self.pk]
+                if key not in existing:
+                    self.counts["inserted"] += 1
+                elif existing[key] == record[HASH_COLUMN]:
+                    self.counts["unchanged"] += 1
+                    continue
+                else:
+                    self.counts["updated"] += 1
+                yield record
+
+    def _existing_hashes(self, keys):
+        if not self.db[self.table].exists():
+            return {}
+        self.ensure_column()
+        sql = (
+            "select [{pk}], [{hash}] from [{table}] where [{pk}] in ({params})".format(
+                pk=self.pk,
+                hash=HASH_COLUMN,
+                table=self.table,
+                params=", ".join("?" for _ in keys),
+            )
+        )
+        return dict(self.db.execute(sql, keys).fetchall())
+
+    def delete_missing(self):
+        "Delete rows whose primary key was not seen by filter()"
+        if not self.seen_table:
+            raise ValueError("ChangeDetector was created without track_seen=True")
+        if not self.db[self.table].exists():
+            return 0
+        with transaction(self.db):
+            cursor = self.db.execute(
+                "delete from [{table}] where [{pk}] not in "
+                "(select pk from temp.[{seen}])".format(
+                    table=self.table, pk=self.pk, seen=self.seen_table
+                )
+            )
+        self.counts["deleted"] += cursor.rowcount
+        return cursor.rowcount
+
+    def summary(self):
+        return (
+            "{inserted:,} inserted, {updated:,} updated, "
+            "{unchanged:,} unchanged, {deleted:,} deleted".format(**self.counts)
+        )
+
+
+def transaction(db):
+    """
+    A transaction that nests inside an outer one, such as the one from
+    bulk_load(). Older sqlite-utils without Database.atomic() fall back
+    to the connection's own transaction, which commits when it ends.
+    """
+    return db.atomic() if hasattr(db, "atomic") else db.conn
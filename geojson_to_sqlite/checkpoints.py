@@ -0,0 +1,137 @@
+import collections
+import contextlib
+import itertools
+import os
+import stat
+
+from . import utils
+from .changes import transaction
+from .decoders import get_decoder
+from .streams import detect_compression
+
+# Table recording how far each import has got
+CHECKPOINTS_TABLE = "_geojson_checkpoints"
+
+
+class Checkpoint:
+    """
+    Records how far an import of one source into table has got, in the
+    same transaction as each batch of rows written by import_records(),
+    so that an interrupted import can be resumed where it stopped.
+
+    Call load() before read_features() to resume from the saved
+    position, and clear() once every source has been imported.
+    """
+
+    def __init__(self, db, table, source, size=None):
+        self.db = db
+        self.table = table
+        self.source = source
+        self.size = size
+        # Features read and rows written before the current batch, and
+        # the byte offset just after the last of those features if known
+        self.features = 0
+        self.rows = 0
+        self.offset = None
+        self._offsets = collections.deque()
+
+    @classmethod
+    def for_file(cls, db, table, fp):
+        "A checkpoint for an import from the open file fp"
+        size = None
+        if hasattr(fp, "fileno"):
+            try:
+                info = os.fstat(fp.fileno())
+            except (OSError, ValueError):
+                info = None
+            if info is not None and stat.S_ISREG(info.st_mode):
+                size = info.st_size
+        return cls(db, table, getattr(fp, "name", "-"), size)
+
+    def load(self):
+        """
+        Load the saved position, returning False if there is none. Raises
+        ValueError if the source has changed size since it was saved.
+        """
+        if not self.db[CHECKPOINTS_TABLE].exists():
+            return False
+        rows = list(
+            self.db[CHECKPOINTS_TABLE].rows_where(
+                "table_name = ? and source = ?", [self.table, self.source]
+            )
+        )
+        if not rows:
+            return False
+        row = rows[0]
+        if None not in (row["size"], self.size) and row["size"] != self.size:
+            raise ValueError(
+                "{} has changed since the import was checkpointed, "
+                "it cannot be resumed".format(self.source)
+            )
+        self.features = row["features"]
+        self.rows = row["rows"]
+        self.offset = row["offset"]
+        return True
+
+    def read_features(self, fp, nl=False, decoder="auto"):
+        """
+        Features from fp, as returned by utils.get_features(), starting
+        after the ones that have already been committed.
+
+        Uncompressed newline-delimited files that can be seeked are read
+        from the saved byte offset. Otherwise the features that have
+        already been imported are parsed again and skipped.
+        """
+        if nl and self._can_seek(fp) and (self.offset is not None or not self.features):
+            fp.seek(self.offset or 0)
+            return self._read_lines(fp, get_decoder(decoder).loads)
+        return self._skip_features(utils.get_features(fp, nl, decoder))
+
+    def _skip_features(self, features):
+        # A generator like get_features(), which closes it when closed
+        with contextlib.closing(features):
+            yield from itertools.islice(features, self.features, None)
+
+    def _can_seek(self, fp):
+        return (
+            fp.seekable()
+            and isinstance(fp.read(0), bytes)
+            and detect_compression(fp) is None
+        )
+
+    def _read_lines(self, fp, loads):
+        offset = self.offset or 0
+        for line in fp:
+            offset += len(line)
+            if line.strip():
+                self._offsets.append(offset)
+                yield loads(line)
+
+    def commit(self, count):
+        """
+        Record that count more rows have been written. Call this inside
+        the transaction that wrote them.
+        """
+        self.features += count
+        self.rows += count
+        for _ in range(min(count, len(self._offsets))):
+            self.offset = self._offsets.popleft()
+        self.db[CHECKPOINTS_TABLE].upsert(
+            {
+                "table_name": self.table,
+                "source": self.source,
+                "size": self.size,
+                "features": self.features,
+                "offset": self.offset,
+                "rows": self.rows,
+            },
+            pk=("table_name", "source"),
+        )
+
+    def clear(self):
+        "Delete the saved position, once the import has completed"
+        if self.db[CHECKPOINTS_TABLE].exists():
+            with transaction(self.db):
+                self.db[CHECKPOINTS_TABLE].delete_where(
+                    "table_name = ? and source = ?", [self.table, self.source]
+                )
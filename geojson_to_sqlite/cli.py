@@ -1,9 +1,35 @@
 import click
+import contextlib
+import os
 import sqlite_utils
+from sqlite_utils.utils import sqlite3
+import stat
+import sys
 import json
 from . import utils
+from .decoders import DECODERS, get_decoder
+from .stats import ImportStats
+from .streams import detect_format
 
-import pdb
+# Choices of options whose modules are only imported by the runs that use
+# them, the same as geometry.ENCODINGS, geometry.VALIDATE_MODES,
+# clustering.CURVES, sharding.SHARD_BY and sharding.MAX_SHARDS
+ENCODINGS = ("geojson", "wkb", "twkb")
+VALIDATE_MODES = ("reject", "repair", "quarantine")
+CURVES = ("hilbert", "zorder")
+SHARD_BY = ("spatial", "pk")
+MAX_SHARDS = 10
+
+
+def _zoom_range(ctx, param, value):
+    if value is None:
+        return None
+    from .tiles import parse_zoom_range
+
+    try:
+        return parse_zoom_range(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 @click.command()
@@ -14,7 +40,7 @@ import pdb
     required=True,
 )
 @click.argument("table", required=True)
-@click.argument("geojson", type=click.File(), required=True, nargs=-1)
+@click.argument("geojson", type=click.File("rb"), required=True, nargs=-1)
 @click.option("--nl", is_flag=True, help="Use newline-delimited GeoJSON features")
 @click.option("--pk", help="Column to use as a primary key")
 @click.option("--alter", is_flag=True, help="Add any missing columns")
@@ -27,10 +53,192 @@ import pdb
 )
 @click.option("--spatialite", is_flag=True, help="Use SpatiaLite")
 @click.option("--spatial-index", is_flag=True, help="Create spatial indexes")
+@click.option(
+    "--spatial-index-threshold",
+    type=click.IntRange(min=0),
+    default=10000,
+    show_default=True,
+    help="Appends of at least this many rows to a table with a spatial index "
+    "rebuild the index afterwards instead of updating it row by row",
+)
 @click.option(
     "--spatialite_mod",
     help="Path to SpatiaLite module, for if --spatialite cannot find it automatically",
 )
+@click.option(
+    "--geometry-format",
+    type=click.Choice(utils.GEOMETRY_FORMATS),
+    default="wkt",
+    show_default=True,
+    help="Format used to pass geometries to SpatiaLite",
+)
+@click.option(
+    "--geometry-encoding",
+    type=click.Choice(ENCODINGS),
+    default="geojson",
+    show_default=True,
+    help="How to store geometries when not using SpatiaLite",
+)
+@click.option(
+    "--precision",
+    type=click.IntRange(min=0),
+    help="Round coordinates to this many decimal places",
+)
+@click.option(
+    "--simplify",
+    type=click.FloatRange(min=0),
+    help="Simplify geometries to this tolerance, preserving topology",
+)
+@click.option(
+    "simplify_zooms",
+    "--simplify-zoom",
+    type=click.IntRange(min=0, max=30),
+    multiple=True,
+    help="Add a geometry_zN column simplified for web map zoom level N, "
+    "can be used multiple times",
+)
+@click.option(
+    "--bbox",
+    is_flag=True,
+    help="Add indexed minx, miny, maxx and maxy columns for each geometry",
+)
+@click.option(
+    "--bbox-rtree",
+    is_flag=True,
+    help="Also index the bounding boxes using a SQLite R*Tree, implies --bbox",
+)
+@click.option(
+    "--source-crs",
+    help="CRS of the input coordinates, such as EPSG:27700. Defaults to "
+    "EPSG:4326, or the CRS declared by a FlatGeobuf or GeoParquet file",
+)
+@click.option(
+    "--target-crs",
+    help="Reproject geometries to this CRS and record its SRID. Defaults to "
+    "the source CRS. Requires pyproj",
+)
+@click.option(
+    "--validate",
+    type=click.Choice(VALIDATE_MODES),
+    help="Check geometries are valid, and stop the import (reject), fix them "
+    "(repair) or write those features to a TABLE_invalid table (quarantine)",
+)
+@click.option(
+    "--cluster",
+    type=click.Choice(CURVES),
+    help="Insert rows in the order of a space-filling curve through their "
+    "geometries, so that nearby features are stored together, cannot be used "
+    "with --pk or features with ids",
+)
+@click.option(
+    "--dedupe-geometries",
+    is_flag=True,
+    help="Store each distinct geometry once in a TABLE_geometries table, "
+    "referenced by a geometry_id column, with a TABLE_with_geometry view",
+)
+@click.option(
+    "--tile-zooms",
+    callback=_zoom_range,
+    help="Index the XYZ tiles each row covers at these zoom levels, such as "
+    "0-14, in a TABLE_tiles table of (z, x, y, rowid)",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Parse and convert files using this many worker processes",
+)
+@click.option(
+    "--unordered",
+    is_flag=True,
+    help="With --workers, insert rows in the order they finish parsing rather "
+    "than input order, cannot be used with --pk or features with ids",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=2, max=MAX_SHARDS),
+    help="Split the table across this many database files, loaded in parallel",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(SHARD_BY),
+    help="Send features to shards by location or by a hash of the primary "
+    "key [default: pk if there is a primary key, otherwise spatial]",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Number of rows to insert at a time",
+)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Bulk-load mode: import all files in a single transaction with fast PRAGMAs",
+)
+@click.option(
+    "--journal-mode",
+    type=click.Choice(utils.JOURNAL_MODES),
+    help="journal_mode to use during the import, implies --bulk [default: memory]",
+)
+@click.option(
+    "--synchronous",
+    type=click.Choice(utils.SYNCHRONOUS_MODES),
+    help="synchronous setting to use during the import, implies --bulk [default: off]",
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    help="cache_size to use during the import, negative for KiB, implies --bulk [default: -256000]",
+)
+@click.option(
+    "--exclusive",
+    is_flag=True,
+    help="Use locking_mode=EXCLUSIVE during the import, implies --bulk",
+)
+@click.option(
+    "--json-decoder",
+    type=click.Choice(DECODERS),
+    default="auto",
+    show_default=True,
+    help="JSON decoder to use, auto picks orjson or msgspec if installed",
+)
+@click.option(
+    "--sample-size",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Number of features used to detect column types",
+)
+@click.option(
+    "--reservoir",
+    is_flag=True,
+    help="With --nl, sample features from across the whole of the input files",
+)
+@click.option(
+    "--detect-changes",
+    is_flag=True,
+    help="Store a content hash for each row and skip features that have not "
+    "changed since the last import, requires --pk",
+)
+@click.option(
+    "--delete-missing",
+    is_flag=True,
+    help="Delete rows whose primary key is not in the input, implies --detect-changes",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Record progress as each batch is committed, and skip the features "
+    "an interrupted import with --resume already committed",
+)
+@click.option("--progress", is_flag=True, help="Show a progress bar")
+@click.option(
+    "--stats-json",
+    type=click.File("w"),
+    help="Write per-stage timings and row counts to this file as JSON",
+)
 def cli(
     db_path,
     table,
@@ -41,7 +249,39 @@ def cli(
     properties,
     spatialite,
     spatial_index,
+    spatial_index_threshold,
     spatialite_mod,
+    geometry_format,
+    geometry_encoding,
+    precision,
+    simplify,
+    simplify_zooms,
+    bbox,
+    bbox_rtree,
+    source_crs,
+    target_crs,
+    validate,
+    cluster,
+    dedupe_geometries,
+    tile_zooms,
+    workers,
+    unordered,
+    shards,
+    shard_by,
+    batch_size,
+    bulk,
+    journal_mode,
+    synchronous,
+    cache_size,
+    exclusive,
+    json_decoder,
+    sample_size,
+    reservoir,
+    detect_changes,
+    delete_missing,
+    resume,
+    progress,
+    stats_json,
 ):
     """
     Import GeoJSON into a SQLite database
@@ -52,19 +292,481 @@ def cli(
 
     This command can be passed more than one GeoJSON file
     """
-    for file in geojson:
-        try:
-            features = utils.get_features(file, nl)
-            utils.import_features(
-                db_path,
-                table,
-                features,
-                pk=pk,
-                alter=alter,
-                properties=properties,
-                spatialite=spatialite,
-                spatialite_mod=spatialite_mod,
-                spatial_index=spatial_index,
+    if workers > 1 and any(file.name in ("-", "<stdin>") for file in geojson):
+        raise click.ClickException("--workers cannot be used with standard input")
+    if unordered and pk:
+        # Upserts must be applied in input order
+        raise click.ClickException("--unordered cannot be used with --pk")
+    if cluster and pk:
+        raise click.ClickException("--cluster cannot be used with --pk")
+    if reservoir and not nl:
+        raise click.ClickException("--reservoir can only be used with --nl")
+
+    if delete_missing:
+        detect_changes = True
+    if shards and detect_changes:
+        raise click.ClickException(
+            "--shards cannot be used with --detect-changes or --delete-missing"
+        )
+    if shards and tile_zooms:
+        raise click.ClickException("--shards cannot be used with --tile-zooms")
+    if shard_by == "pk" and shards and not pk:
+        raise click.ClickException("--shard-by pk requires --pk")
+    if shard_by == "spatial" and shards and pk:
+        # A feature that moved would be upserted into a different shard
+        raise click.ClickException("--shard-by spatial cannot be used with --pk")
+    if detect_changes and not pk:
+        raise click.ClickException("--detect-changes requires --pk")
+    if resume:
+        # Positions are only known when one process writes rows in input order
+        for option, value in (
+            ("--workers", workers > 1),
+            ("--shards", shards),
+            ("--cluster", cluster),
+            ("--detect-changes", detect_changes),
+            ("--validate quarantine", validate == "quarantine"),
+        ):
+            if value:
+                raise click.ClickException(
+                    "--resume cannot be used with {}".format(option)
+                )
+
+    formats = [detect_format(file) for file in geojson]
+    if any(formats):
+        # These files are inserted straight from their columns, so options
+        # that work on GeoJSON features or records do not apply
+        for option, value in (
+            ("--nl", nl),
+            ("--properties", properties),
+            ("--precision", precision is not None),
+            ("--simplify", simplify or simplify_zooms),
+            ("--bbox", bbox or bbox_rtree),
+            ("--validate", validate),
+            ("--cluster", cluster),
+            ("--dedupe-geometries", dedupe_geometries),
+            ("--workers", workers > 1),
+            ("--shards", shards),
+            ("--detect-changes", detect_changes),
+            ("--resume", resume),
+        ):
+            if value:
+                raise click.ClickException(
+                    "FlatGeobuf and GeoParquet files cannot be used with {}".format(
+                        option
+                    )
+                )
+
+    if dedupe_geometries:
+        # New geometries are written as rows are generated, by one process
+        for option, value in (
+            ("--workers", workers > 1),
+            ("--shards", shards),
+            ("--cluster", cluster),
+            ("--reservoir", reservoir),
+            ("--validate quarantine", validate == "quarantine"),
+        ):
+            if value:
+                raise click.ClickException(
+                    "--dedupe-geometries cannot be used with {}".format(option)
+                )
+
+    if journal_mode or synchronous or cache_size is not None or exclusive:
+        bulk = True
+    if resume and bulk:
+        raise click.ClickException(
+            "--resume cannot be used with --bulk, which commits once at the end"
+        )
+
+    try:
+        decoder = get_decoder(json_decoder)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    db = sqlite_utils.Database(db_path)
+    import_kwargs = dict(
+        pk=pk,
+        alter=alter,
+        properties=properties,
+        spatialite=spatialite,
+        spatialite_mod=spatialite_mod,
+        spatial_index=spatial_index,
+        geometry_format=geometry_format,
+        batch_size=batch_size,
+        spatial_index_threshold=spatial_index_threshold,
+        log=lambda message: click.echo(message, err=True),
+        sample_size=sample_size,
+        cluster=cluster,
+    )
+    if geometry_encoding != "geojson" and (
+        spatialite or spatialite_mod or spatial_index
+    ):
+        raise click.ClickException(
+            "--geometry-encoding cannot be used with SpatiaLite, "
+            "use --geometry-format instead"
+        )
+    if bbox_rtree:
+        bbox = True
+        import_kwargs["rtree"] = True
+    if (
+        precision is not None
+        or simplify
+        or simplify_zooms
+        or bbox
+        or geometry_encoding != "geojson"
+        or validate
+        or source_crs
+        or target_crs
+    ):
+        from .geometry import GeometryOptions
+
+        import_kwargs["geometry_options"] = GeometryOptions(
+            precision,
+            simplify,
+            tuple(sorted(set(simplify_zooms))),
+            bbox,
+            geometry_encoding,
+            validate,
+            source_crs,
+            target_crs,
+        )
+    for crs in (source_crs, target_crs):
+        if crs:
+            from .geometry import crs_srid
+
+            # Check it is a CRS that can be recorded as a SpatiaLite SRID
+            try:
+                crs_srid(crs)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+    stats = None
+    if progress or stats_json:
+        stats = ImportStats()
+        import_kwargs["stats"] = stats
+    changes = None
+    if detect_changes:
+        from .changes import ChangeDetector
+
+        changes = ChangeDetector(db, table, pk, track_seen=delete_missing)
+        import_kwargs["changes"] = changes
+    if dedupe_geometries:
+        from .dedupe import GeometryDeduplicator
+
+        import_kwargs["deduplicator"] = GeometryDeduplicator(db, table)
+    # The SRID of the stored geometries, if it is not that of the options
+    tile_srid = None
+    bulk_settings = None
+    if bulk:
+        bulk_settings = dict(
+            journal_mode=journal_mode or "memory",
+            synchronous=synchronous or "off",
+            cache_size=-256000 if cache_size is None else cache_size,
+            exclusive=exclusive,
+        )
+    try:
+        if reservoir:
+            import_kwargs["sample"] = utils.sample_nl_features(
+                geojson, sample_size, decoder
             )
-        except (TypeError, ValueError) as e:
-            raise click.ClickException(str(e))
+        if bulk and not shards:
+            if spatialite or spatialite_mod or spatial_index:
+                # SpatiaLite metadata must be created outside the transaction
+                utils.init_spatialite(db, spatialite_mod)
+            context = utils.bulk_load(db, **bulk_settings)
+        else:
+            context = contextlib.nullcontext()
+        if progress:
+            progress_context = _progress(stats, geojson, workers)
+        else:
+            progress_context = contextlib.nullcontext()
+        with context, progress_context as on_file:
+            if shards:
+                _import_sharded(
+                    db_path,
+                    table,
+                    geojson,
+                    shards,
+                    shard_by,
+                    nl,
+                    decoder,
+                    workers,
+                    unordered,
+                    bulk_settings,
+                    on_file,
+                    import_kwargs,
+                )
+            elif workers > 1:
+                from . import parallel
+
+                parallel.import_files(
+                    db,
+                    table,
+                    [file.name for file in geojson],
+                    workers,
+                    nl=nl,
+                    decoder=decoder.name,
+                    ordered=not unordered,
+                    **import_kwargs
+                )
+            elif cluster:
+                # Sort the whole input along the curve, not each file alone
+                utils.import_features(
+                    db,
+                    table,
+                    _file_features(geojson, nl, decoder, on_file),
+                    **import_kwargs
+                )
+            else:
+                checkpoints = []
+                for file, format in zip(geojson, formats):
+                    if on_file:
+                        on_file(file)
+                    if format:
+                        from . import columnar
+
+                        reader = columnar.open_reader(file, format)
+                        if not (source_crs or target_crs) and reader.srid:
+                            # Geometries are stored in the file's CRS
+                            tile_srid = reader.srid
+                        try:
+                            columnar.import_batches(
+                                db,
+                                table,
+                                reader,
+                                pk=pk,
+                                alter=alter,
+                                spatialite=spatialite,
+                                spatialite_mod=spatialite_mod,
+                                spatial_index=spatial_index,
+                                encoding=geometry_encoding,
+                                stats=stats,
+                                source_crs=source_crs,
+                                target_crs=target_crs,
+                            )
+                        except sqlite3.Error as e:
+                            # Such as columns missing from an existing table
+                            raise click.ClickException(str(e))
+                        continue
+                    if resume:
+                        from .checkpoints import Checkpoint
+
+                        checkpoint = Checkpoint.for_file(db, table, file)
+                        checkpoint.load()
+                        checkpoints.append(checkpoint)
+                        features = checkpoint.read_features(file, nl, decoder)
+                        import_kwargs["checkpoint"] = checkpoint
+                    else:
+                        features = utils.get_features(file, nl, decoder)
+                    # Stops any read-ahead thread if the import fails
+                    with contextlib.closing(features):
+                        utils.import_features(db, table, features, **import_kwargs)
+                # Only forget progress once every file has been imported
+                for checkpoint in checkpoints:
+                    checkpoint.clear()
+            if delete_missing:
+                changes.delete_missing()
+            if tile_zooms:
+                from .geometry import target_srid
+                from .tiles import TileIndex
+
+                if tile_srid is None:
+                    tile_srid = target_srid(import_kwargs.get("geometry_options"))
+                indexed = TileIndex(db, table, *tile_zooms, srid=tile_srid).update(
+                    spatialite=bool(spatialite or spatialite_mod or spatial_index)
+                )
+                click.echo(
+                    "Tile index: indexed {:,} rows for zoom levels {}-{}".format(
+                        indexed, *tile_zooms
+                    ),
+                    err=True,
+                )
+    except (TypeError, ValueError) as e:
+        raise click.ClickException(str(e))
+
+    if changes is not None:
+        click.echo(changes.summary(), err=True)
+    if stats_json:
+        results = stats.as_dict()
+        if changes is not None:
+            results["changes"] = changes.counts
+        json.dump(results, stats_json, indent=2)
+        stats_json.write("\n")
+
+
+@click.command()
+@click.version_option()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="Path of the Unix socket to listen on",
+)
+@click.option("--spatialite", is_flag=True, help="Use SpatiaLite")
+@click.option(
+    "--spatialite_mod",
+    help="Path to SpatiaLite module, for if --spatialite cannot find it automatically",
+)
+def serve(db_path, socket_path, spatialite, spatialite_mod):
+    """
+    Run GeoJSON imports into a SQLite database sent over a Unix socket
+
+    Each request is a line of JSON naming a table and the files to import:
+
+        {"table": "places", "files": ["/data/places.geojson"], "nl": true}
+
+    The server keeps one connection open, with SpatiaLite loaded, until
+    it is stopped or sent {"shutdown": true}
+    """
+    from .session import Importer, serve as serve_jobs
+
+    try:
+        with Importer(db_path, spatialite, spatialite_mod) as importer:
+            serve_jobs(
+                importer,
+                socket_path,
+                log=lambda message: click.echo(message, err=True),
+            )
+    except (utils.SpatiaLiteError, ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
+def _import_sharded(
+    db_path,
+    table,
+    files,
+    shards,
+    shard_by,
+    nl,
+    decoder,
+    workers,
+    unordered,
+    bulk_settings,
+    on_file,
+    import_kwargs,
+):
+    from . import sharding
+    from .geometry import geometry_columns, target_srid
+
+    kwargs = dict(import_kwargs)
+    properties = kwargs.pop("properties")
+    geometry_options = kwargs.pop("geometry_options", None)
+    sample = kwargs.pop("sample", None)
+    spatialite = (
+        kwargs["spatialite"] or kwargs["spatialite_mod"] or kwargs["spatial_index"]
+    )
+    convert_kwargs = dict(
+        properties=properties,
+        spatialite=bool(spatialite),
+        geometry_format=kwargs["geometry_format"],
+        geometry_options=geometry_options,
+    )
+    if workers > 1:
+        from . import parallel
+
+        records = parallel.yield_records(
+            [file.name for file in files],
+            workers,
+            nl=nl,
+            decoder=decoder.name,
+            ordered=not unordered,
+            **convert_kwargs
+        )
+    else:
+        records = _file_records(files, nl, decoder, on_file, convert_kwargs)
+    if sample is not None:
+        sample = list(
+            utils.yield_records(
+                sample, None, properties, False, "wkt", None, geometry_options
+            )
+        )
+    sharding.import_sharded(
+        db_path,
+        table,
+        records,
+        shards,
+        shard_by=shard_by,
+        sample=sample,
+        bulk=bulk_settings,
+        geometry_columns=geometry_columns(geometry_options),
+        bbox=geometry_options is not None and geometry_options.bbox,
+        quarantine=(
+            geometry_options is not None and geometry_options.validate == "quarantine"
+        ),
+        srid=target_srid(geometry_options),
+        ordered=not unordered,
+        **kwargs
+    )
+
+
+def _file_features(files, nl, decoder, on_file):
+    for file in files:
+        if on_file:
+            on_file(file)
+        with contextlib.closing(utils.get_features(file, nl, decoder)) as features:
+            yield from features
+
+
+def _file_records(files, nl, decoder, on_file, convert_kwargs):
+    return utils.yield_records(
+        _file_features(files, nl, decoder, on_file),
+        None,
+        convert_kwargs["properties"],
+        convert_kwargs["spatialite"],
+        convert_kwargs["geometry_format"],
+        None,
+        convert_kwargs["geometry_options"],
+    )
+
+
+def _file_size(file):
+    try:
+        info = os.fstat(file.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return info.st_size if stat.S_ISREG(info.st_mode) else None
+
+
+@contextlib.contextmanager
+def _progress(stats, files, workers):
+    """
+    Report progress through the input files as a progress bar, or as a
+    count of inserted rows if their total size cannot be known up front.
+
+    Yields a function to be called as each file is started.
+    """
+    sizes = [_file_size(file) for file in files]
+    if workers > 1 or None in sizes:
+        stats.callback = lambda stats: click.echo(
+            "\rInserted {:,} rows".format(stats.rows("insert")), err=True, nl=False
+        )
+        yield None
+        click.echo(err=True)
+        return
+
+    current = {"file": None, "done": 0}
+
+    def on_file(file):
+        if current["file"] is not None:
+            current["done"] += _file_size(current["file"])
+        current["file"] = file
+
+    def update(stats):
+        file = current["file"]
+        try:
+            position = current["done"] + getattr(file, "buffer", file).tell()
+        except (AttributeError, OSError, ValueError):
+            return
+        bar.update(position - bar.pos)
+
+    with click.progressbar(
+        length=sum(sizes), label="Importing", file=sys.stderr
+    ) as bar:
+        stats.callback = update
+        yield on_file
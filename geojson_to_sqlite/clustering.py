@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import json
+import numpy
+import pickle
+import shapely
+import tempfile
+
+from . import geometry, twkb, wkb
+
+CURVES = ("hilbert", "zorder")
+
+# Coordinates in EPSG:4326 are scaled from this extent onto a 2**ORDER grid
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+ORDER = 16
+
+# Records sorted in memory at a time, before spilling to a temporary file
+RUN_SIZE = 100000
+
+
+def curve_keys(x, y, curve="hilbert", extent=WORLD, order=ORDER):
+    """
+    Return the position along a space-filling curve of each point in the
+    arrays x and y. Points outside extent are clamped to its edges.
+    """
+    if curve not in CURVES:
+        raise ValueError("curve must be one of: {}".format(", ".join(CURVES)))
+    minx, miny, maxx, maxy = extent
+    n = 1 << order
+    x = _scale(x, minx, maxx, n)
+    y = _scale(y, miny, maxy, n)
+    if curve == "zorder":
+        return _interleave(x) | (_interleave(y) << 1)
+    keys = numpy.zeros(len(x), dtype=numpy.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = numpy.where(flip, n - 1 - x, x)
+        y = numpy.where(flip, n - 1 - y, y)
+        x, y = numpy.where(ry, x, y), numpy.where(ry, y, x)
+        s >>= 1
+    return keys
+
+
+def centres(bounds, srid=4326):
+    """
+    The x and y arrays of the centres of an array of bounding boxes, from
+    shapely.bounds(), of geometries in srid. They are reprojected to
+    EPSG:4326, as the curves cover WORLD whatever the units of srid.
+    """
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    if srid != 4326:
+        transformer = geometry.get_transformer(
+            "EPSG:{}".format(srid), geometry.DEFAULT_CRS
+        )
+        x, y = transformer.transform(x, y)
+    return x, y
+
+
+def _scale(values, low, high, n):
+    scaled = (numpy.asarray(values, dtype=float) - low) / (high - low) * n
+    return numpy.clip(numpy.nan_to_num(scaled), 0, n - 1).astype(numpy.int64)
+
+
+def _interleave(values):
+    # Spread the low 16 bits of each value out to the even bit positions
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    return (values | (values << 1)) & 0x55555555
+
+
+def cluster_records(
+    records,
+    spatialite,
+    geometry_format="wkt",
+    curve="hilbert",
+    extent=WORLD,
+    run_size=RUN_SIZE,
+    directory=None,
+    srid=4326,
+):
+    """
+    Yield records sorted by the position of the centre of their geometry's
+    bounding box along a space-filling curve, so that rows which are
+    close together on the map are stored close together on disk.
+
+    srid is the SRID of the geometries, whose centres are reprojected to
+    EPSG:4326 to place them within extent.
+
+    Records are sorted in runs of run_size, which are spilled to temporary
+    files in directory and merged if there is more than one. Records
+    without a geometry are yielded last, in input order.
+    """
+    runs = []
+    records = iter(records)
+    sequence = itertools.count()
+    try:
+        while True:
+            batch = list(itertools.islice(records, run_size))
+            if not batch:
+                break
+            keys = _keys(batch, spatialite, geometry_format, curve, extent, srid)
+            run = sorted(zip(keys, sequence, batch), key=lambda item: item[:2])
+            if not runs and len(batch) < run_size:
+                # Everything fitted in memory
+                for _, _, record in run:
+                    yield record
+                return
+            runs.append(_spill(run, directory))
+        merged = heapq.merge(*[_read_run(fp) for fp in runs], key=lambda i: i[:2])
+        for _, _, record in merged:
+            yield record
+    finally:
+        for fp in runs:
+            fp.close()
+
+
+def _keys(batch, spatialite, geometry_format, curve, extent, srid):
+    geometries = parse_geometries(
+        [record.get("geometry") for record in batch], spatialite, geometry_format
+    )
+    bounds = shapely.bounds(geometries)
+    keys = curve_keys(*centres(bounds, srid), curve, extent)
+    # Sort missing and empty geometries after everything else
+    missing = numpy.isnan(bounds[:, 0])
+    return numpy.where(missing, numpy.iinfo(numpy.int64).max, keys).tolist()
+
+
+def parse_geometries(values, spatialite, geometry_format):
+    "Parse the geometry values of records into an array of Shapely geometries"
+    if spatialite and geometry_format == "wkb":
+        return shapely.from_wkb(values)
+    if spatialite:
+        return shapely.from_wkt(values)
+    if all(isinstance(value, str) or value is None for value in values):
+        # GeoJSON strings from the geometry module
+        return shapely.from_geojson(values, on_invalid="ignore")
+    encoded = []
+    for value in values:
+        if not value:
+            value = None
+        elif isinstance(value, str):
+            # Such as quarantined invalid geometries among converted ones
+            value = wkb.encode(json.loads(value))
+        elif isinstance(value, dict):
+            value = wkb.encode(value)
+        elif twkb.is_twkb(value):
+            value = wkb.encode(twkb.decode(value))
+        encoded.append(value)
+    return shapely.from_wkb(encoded, on_invalid="ignore")
+
+
+def _spill(run, directory):
+    fp = tempfile.TemporaryFile(dir=directory)
+    pickler = pickle.Pickler(fp, protocol=pickle.HIGHEST_PROTOCOL)
+    for item in run:
+        pickler.dump(item)
+        # Stop the pickler remembering every record it has written
+        pickler.clear_memo()
+    fp.seek(0)
+    return fp
+
+
+def _read_run(fp):
+    unpickler = pickle.Unpickler(fp)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
@@ -0,0 +1,181 @@
+"""
+Import from binary columnar formats - FlatGeobuf and GeoParquet - whose
+readers produce batches of property value lists and WKB geometries.
+These are inserted with executemany(), without building a dictionary
+for each feature.
+"""
+
+from collections import namedtuple
+import shapely
+from shapely.geometry import mapping
+import sqlite_utils
+
+from . import geometry, twkb
+from .changes import transaction
+from .stats import NullStats
+from .streams import detect_format  # noqa: F401
+from .utils import ensure_table_has_geometry, init_spatialite
+
+# columns: dictionary of column name to a list of values
+# geometry: list of WKB bytes, or None for features without a geometry
+ColumnarBatch = namedtuple("ColumnarBatch", ("columns", "geometry"))
+
+FORMATS = ("flatgeobuf", "geoparquet")
+
+# Features read and inserted, in a single transaction, at a time
+BATCH_SIZE = 10000
+
+
+def open_reader(fp, format):
+    "Return a reader for the binary file object fp, in a format from FORMATS"
+    if format == "flatgeobuf":
+        from .flatgeobuf import FlatGeobufReader
+
+        return FlatGeobufReader(fp)
+    if format == "geoparquet":
+        from .geoparquet import GeoParquetReader
+
+        return GeoParquetReader(fp)
+    raise ValueError("format must be one of: {}".format(", ".join(FORMATS)))
+
+
+def import_batches(
+    db_path,
+    table,
+    reader,
+    pk=None,
+    alter=False,
+    spatialite=False,
+    spatialite_mod=None,
+    spatial_index=False,
+    encoding="geojson",
+    batch_size=BATCH_SIZE,
+    stats=None,
+    source_crs=None,
+    target_crs=None,
+):
+    """
+    Insert the features read by reader, from open_reader(), into table,
+    creating it with the column types of the reader's schema if needed.
+    If pk is not provided an "id" column is used as the primary key, and
+    rows with an existing primary key are updated. An existing table
+    must have pk as its primary key, or a unique index on it, for that;
+    otherwise a detected "id" is inserted as an ordinary column.
+
+    With spatialite the WKB geometries are passed to GeomFromWKB().
+    Otherwise they are stored using encoding, from geometry.ENCODINGS.
+
+    source_crs defaults to the CRS declared by the file, or EPSG:4326 if
+    it does not have one. Geometries are reprojected to target_crs if
+    that is different, and the SRID of target_crs is recorded for them.
+    """
+    if isinstance(db_path, sqlite_utils.Database):
+        db = db_path
+    else:
+        db = sqlite_utils.Database(db_path)
+    if stats is None:
+        stats = NullStats()
+    if spatialite_mod or spatial_index:
+        spatialite = True
+    if spatialite:
+        init_spatialite(db, spatialite_mod)
+    if source_crs is None:
+        source_crs = (
+            "EPSG:{}".format(reader.srid) if reader.srid else geometry.DEFAULT_CRS
+        )
+    if target_crs is None:
+        target_crs = source_crs
+    reprojecting = geometry.needs_reprojection(source_crs, target_crs)
+    srid = geometry.crs_srid(target_crs)
+    column_types = dict(reader.column_types)
+    column_types.pop("geometry", None)
+    detected_pk = pk is None and "id" in column_types
+    if detected_pk:
+        pk = "id"
+
+    if table not in db.table_names():
+        if spatialite:
+            db[table].create(column_types or {"_tmp": str}, pk=pk)
+            ensure_table_has_geometry(db, table, srid=srid)
+            if not column_types:
+                db[table].transform(drop={"_tmp"})
+        else:
+            geometry_type = str if encoding == "geojson" else bytes
+            db[table].create(dict(column_types, geometry=geometry_type), pk=pk)
+    else:
+        if alter:
+            existing = db[table].columns_dict
+            for column, column_type in column_types.items():
+                if column not in existing:
+                    db[table].add_column(column, column_type)
+        if pk and not _is_unique(db[table], pk):
+            if not detected_pk:
+                raise ValueError(
+                    "{} has no primary key or unique index on {}, so rows "
+                    "cannot be upserted by it".format(table, pk)
+                )
+            pk = None
+
+    names = list(column_types)
+    columns = names + ["geometry"]
+    sql = "INSERT INTO [{}] ({}) VALUES ({}{})".format(
+        table,
+        ", ".join("[{}]".format(column) for column in columns),
+        "?, " * len(names),
+        "GeomFromWKB(?, {})".format(int(srid)) if spatialite else "?",
+    )
+    if pk:
+        sql += " ON CONFLICT([{}]) DO UPDATE SET {}".format(
+            pk,
+            ", ".join(
+                "[{0}] = excluded.[{0}]".format(column)
+                for column in columns
+                if column != pk
+            ),
+        )
+
+    batches = reader.batches(batch_size)
+    while True:
+        with stats.stage("parse"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        count = len(batch.geometry)
+        stats.add("parse", rows=count)
+        with stats.stage("convert"):
+            geometries = batch.geometry
+            shapes = None
+            if reprojecting or (not spatialite and encoding != "wkb"):
+                shapes = shapely.from_wkb(geometries)
+            if reprojecting:
+                shapes = geometry.reproject(shapes, source_crs, target_crs)
+            if not spatialite and encoding == "geojson":
+                geometries = shapely.to_geojson(shapes)
+            elif not spatialite and encoding == "twkb":
+                geometries = [
+                    twkb.encode(mapping(shape)) if shape else None for shape in shapes
+                ]
+            elif reprojecting:
+                geometries = shapely.to_wkb(shapes, flavor="iso")
+        stats.add("convert", rows=count)
+        with stats.stage("insert"):
+            with transaction(db):
+                db.conn.executemany(
+                    sql, zip(*[batch.columns[name] for name in names], geometries)
+                )
+        stats.add("insert", rows=count)
+        if stats.callback:
+            stats.callback(stats)
+
+    if spatial_index:
+        with stats.stage("index"):
+            db[table].create_spatial_index("geometry")
+    stats.finish()
+    return db[table]
+
+
+def _is_unique(table, column):
+    "Whether column is the primary key of table, or has a unique index"
+    if table.pks == [column]:
+        return True
+    return any(index.unique and index.columns == [column] for index in table.indexes)
@@ -0,0 +1,50 @@
+from collections import namedtuple
+import json
+
+# name: the backend in use
+# loads: callable accepting str, bytes or a memoryview
+# binary: True if loads() is fastest when passed UTF-8 bytes
+Decoder = namedtuple("Decoder", ("name", "loads", "binary"))
+
+DECODERS = ("auto", "orjson", "msgspec", "json")
+
+
+def _orjson():
+    import orjson
+
+    return Decoder("orjson", orjson.loads, True)
+
+
+def _msgspec():
+    import msgspec
+
+    return Decoder("msgspec", msgspec.json.Decoder().decode, True)
+
+
+def _json():
+    return Decoder("json", json.loads, False)
+
+
+_FACTORIES = {"orjson": _orjson, "msgspec": _msgspec, "json": _json}
+
+
+def get_decoder(name="auto"):
+    """
+    Return the Decoder for a backend name, or for "auto" the fastest one
+    that is installed: orjson, then msgspec, then the standard library.
+    """
+    if isinstance(name, Decoder):
+        return name
+    if name == "auto":
+        for name in ("orjson", "msgspec"):
+            try:
+                return _FACTORIES[name]()
+            except ImportError:
+                pass
+        return _json()
+    if name not in _FACTORIES:
+        raise ValueError("decoder must be one of: {}".format(", ".join(DECODERS)))
+    try:
+        return _FACTORIES[name]()
+    except ImportError:
+        raise ValueError("The {} package is not installed".format(name))
@@ -0,0 +1,222 @@
+import hashlib
+import itertools
+import json
+
+from . import geometry, utils
+from .changes import content_hash
+
+# Column in the main table referencing the row holding its geometry
+GEOMETRY_ID = "geometry_id"
+
+# Features whose geometries are looked up and stored at a time
+BATCH_SIZE = 1000
+
+
+def geometries_table(table):
+    return "{}_geometries".format(table)
+
+
+def view_name(table):
+    return "{}_with_geometry".format(table)
+
+
+def geometry_hash(value):
+    "SHA-1 digest of a GeoJSON geometry, before it has been converted"
+    # Always the standard library's encoding, so that hashes stored by
+    # earlier imports match whichever JSON libraries are installed
+    encoded = json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha1(encoded.encode("utf-8")).digest()
+
+
+class GeometryDeduplicator:
+    """
+    Stores each distinct geometry imported into table once, in a separate
+    table with an id, hash and geometry column. Rows in table get a
+    geometry_id column referencing it in place of their geometry, and a
+    view joins the two back together.
+
+    Geometries are hashed before they are converted, so those that have
+    been seen before skip conversion entirely. The hashes of geometries
+    stored by this import are kept in memory.
+    """
+
+    def __init__(self, db, table, batch_size=BATCH_SIZE):
+        self.db = db
+        self.table = table
+        self.geometries_table = geometries_table(table)
+        self.batch_size = batch_size
+        self.schema = utils.SchemaCache(db)
+        self.counts = {"features": 0, "stored": 0}
+        self._ids = {}
+        self._next_id = None
+
+    @property
+    def foreign_keys(self):
+        return [(GEOMETRY_ID, self.geometries_table, "id")]
+
+    def records(
+        self,
+        features,
+        properties="",
+        spatialite=False,
+        geometry_format="wkt",
+        hash_column=None,
+        geometry_options=None,
+        srid=4326,
+        stats=None,
+    ):
+        """
+        Yield a record for each feature, as yield_records() would, but
+        with a geometry_id instead of a geometry. New geometries are
+        converted and written to the geometries table first.
+        """
+        if stats is None:
+            stats = utils.NullStats()
+        columns = self.schema.columns(self.table)
+        if columns is not None and "geometry" in columns:
+            raise ValueError(
+                "{} already has a geometry column, so its geometries "
+                "cannot be deduplicated".format(self.table)
+            )
+        features = iter(features)
+        while True:
+            batch = list(itertools.islice(features, self.batch_size))
+            if not batch:
+                break
+            with stats.stage("geometries"):
+                ids = self._store(
+                    [feature.get("geometry") for feature in batch],
+                    spatialite,
+                    geometry_format,
+                    geometry_options,
+                    srid,
+                )
+            stripped = (dict(feature, geometry=None) for feature in batch)
+            records = utils.yield_records(stripped, None, properties, False)
+            for record, geometry_id in zip(records, ids):
+                del record["geometry"]
+                record[GEOMETRY_ID] = geometry_id
+                if hash_column:
+                    # The id stands in for the geometry, as equal geometries
+                    # always get the same one
+                    record[hash_column] = content_hash(record)
+                yield record
+            self.counts["features"] += len(batch)
+
+    def _store(self, geometries, spatialite, geometry_format, options, srid):
+        if self._next_id is None:
+            self._create_table(spatialite, options, srid)
+        hashes = [
+            None if value is None else geometry_hash(value) for value in geometries
+        ]
+        if self._next_id > 1:
+            # Geometries may have been stored by earlier imports
+            self._ids.update(
+                self._existing_ids({h for h in hashes if h and h not in self._ids})
+            )
+        new = {}
+        for value, digest in zip(geometries, hashes):
+            if digest is not None and digest not in self._ids:
+                self._ids[digest] = self._next_id
+                new[self._next_id] = {
+                    "id": self._next_id,
+                    "properties": {"hash": digest},
+                    "geometry": value,
+                }
+                self._next_id += 1
+        if new:
+            utils.import_records(
+                self.db,
+                self.geometries_table,
+                utils.yield_records(
+                    new.values(),
+                    None,
+                    "",
+                    spatialite,
+                    geometry_format,
+                    geometry_options=options,
+                ),
+                alter=True,
+                spatialite=spatialite,
+                geometry_format=geometry_format,
+                batch_size=len(new),
+                geometry_columns=geometry.geometry_columns(options),
+                srid=srid,
+                schema=self.schema,
+            )
+            self.counts["stored"] += len(new)
+        return [None if digest is None else self._ids[digest] for digest in hashes]
+
+    def _create_table(self, spatialite, options, srid):
+        table = self.db[self.geometries_table]
+        if table.exists():
+            self._next_id = (
+                self.db.execute(
+                    "select max(id) from [{}]".format(table.name)
+                ).fetchone()[0]
+                or 0
+            ) + 1
+            return
+        table.create({"id": int, "hash": bytes}, pk="id")
+        if spatialite:
+            utils.ensure_table_has_geometry(self.db, table.name, "geometry", srid)
+        else:
+            encoding = "geojson" if options is None else options.encoding
+            table.add_column("geometry", str if encoding == "geojson" else bytes)
+        table.create_index(["hash"], unique=True)
+        self._next_id = 1
+
+    def _existing_ids(self, hashes):
+        hashes = list(hashes)
+        ids = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            ids.update(
+                self.db.execute(
+                    "select hash, id from [{}] where hash in ({})".format(
+                        self.geometries_table, ", ".join("?" for _ in chunk)
+                    ),
+                    chunk,
+                ).fetchall()
+            )
+        return ids
+
+    def finish(self, geometry_options=None, spatial_index=False, rtree=False):
+        """
+        Index the geometries table, and create the view of table with
+        its geometries, once the import has finished.
+        """
+        if not self.db[self.geometries_table].exists():
+            return
+        if spatial_index:
+            self.db[self.geometries_table].create_spatial_index("geometry")
+        bbox = geometry_options is not None and geometry_options.bbox
+        if bbox:
+            geometry.create_bbox_index(self.db, self.geometries_table, rtree)
+        if self.db[self.table].exists():
+            columns = geometry.geometry_columns(geometry_options)
+            if bbox:
+                columns.extend(geometry.BBOX_COLUMNS)
+            # Recreated, in case this import added zoom level columns
+            self.db.execute("drop view if exists [{}]".format(view_name(self.table)))
+            self.db.execute(
+                "create view [{view}] as select [{table}].*, {columns} "
+                "from [{table}] left join [{geometries}] "
+                "on [{geometries}].id = [{table}].[{geometry_id}]".format(
+                    view=view_name(self.table),
+                    table=self.table,
+                    geometries=self.geometries_table,
+                    geometry_id=GEOMETRY_ID,
+                    columns=", ".join(
+                        "[{}].[{}]".format(self.geometries_table, column)
+                        for column in columns
+                    ),
+                )
+            )
+
+    def summary(self):
+        return "Stored {:,} unique geometries for {:,} features in {}".format(
+            self.counts["stored"], self.counts["features"], self.geometries_table
+        )
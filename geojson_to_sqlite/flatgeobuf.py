@@ -0,0 +1,343 @@
+"""
+Reader for FlatGeobuf files, see https://flatgeobuf.org/
+
+Features are decoded directly from their FlatBuffers encoding into
+columns of property values and ISO WKB geometries, without building a
+GeoJSON dictionary for each one.
+"""
+
+import numpy
+import struct
+
+from .columnar import BATCH_SIZE, ColumnarBatch
+from .streams import is_flatgeobuf  # noqa: F401
+
+# Geometry types, as numbered by both FlatGeobuf and WKB
+UNKNOWN = 0
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+MULTIPOINT = 4
+MULTILINESTRING = 5
+MULTIPOLYGON = 6
+GEOMETRYCOLLECTION = 7
+
+# Column types
+BYTE, UBYTE, BOOL, SHORT, USHORT, INT, UINT, LONG, ULONG = range(9)
+FLOAT, DOUBLE, STRING, JSON, DATETIME, BINARY = range(9, 15)
+
+_SCALARS = {
+    BYTE: struct.Struct("<b"),
+    UBYTE: struct.Struct("<B"),
+    BOOL: struct.Struct("<B"),
+    SHORT: struct.Struct("<h"),
+    USHORT: struct.Struct("<H"),
+    INT: struct.Struct("<i"),
+    UINT: struct.Struct("<I"),
+    LONG: struct.Struct("<q"),
+    ULONG: struct.Struct("<Q"),
+    FLOAT: struct.Struct("<f"),
+    DOUBLE: struct.Struct("<d"),
+}
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+
+# Size in bytes of each node of the packed Hilbert R-tree index
+_NODE_SIZE = 40
+
+
+def column_type(fgb_type):
+    "The Python type used to store a FlatGeobuf column type"
+    if fgb_type == BINARY:
+        return bytes
+    if fgb_type in (FLOAT, DOUBLE):
+        return float
+    if fgb_type in (STRING, JSON, DATETIME):
+        return str
+    return int
+
+
+class FlatGeobufReader:
+    """
+    Reads the header of the FlatGeobuf file fp, a binary file object.
+    batches() then reads the features that follow it, skipping the
+    spatial index if there is one.
+
+    M, T and TM coordinates are ignored. srid is the EPSG code of the
+    file's coordinate reference system, or None if it has none.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        magic = fp.read(8)
+        if not is_flatgeobuf(magic):
+            raise ValueError("Not a FlatGeobuf file")
+        header = _Table.root(self._read_sized())
+        self.name = header.string(0)
+        self.geometry_type = header.scalar(2, "<B")
+        self.has_z = bool(header.scalar(3, "<B"))
+        self.columns = [
+            (column.string(0), column.scalar(1, "<B")) for column in header.tables(7)
+        ]
+        self.features_count = header.scalar(8, "<Q")
+        self.index_node_size = header.scalar(9, "<H", 16)
+        crs = header.table(10)
+        self.srid = (crs.scalar(1, "<i") or None) if crs is not None else None
+        self._index_skipped = False
+
+    @property
+    def column_types(self):
+        return {name: column_type(fgb_type) for name, fgb_type in self.columns}
+
+    def batches(self, batch_size=BATCH_SIZE):
+        "Yield a ColumnarBatch for every batch_size features"
+        self._skip_index()
+        names = [name for name, _ in self.columns]
+        positions = {name: i for i, name in enumerate(names)}
+        layout = [(i, fgb_type) for i, (_, fgb_type) in enumerate(self.columns)]
+        while True:
+            columns = [[] for _ in names]
+            geometries = []
+            for _ in range(batch_size):
+                buf = self._read_sized()
+                if buf is None:
+                    break
+                feature = _Table.root(buf)
+                geometry = feature.table(0)
+                geometries.append(
+                    None
+                    if geometry is None
+                    else self._wkb(geometry, self.geometry_type)
+                )
+                row = [None] * len(names)
+                feature_columns = feature.tables(2)
+                if feature_columns:
+                    # Rare: columns defined per feature rather than in the
+                    # header, those that are not in the header are ignored
+                    feature_layout = [
+                        (positions.get(c.string(0)), c.scalar(1, "<B"))
+                        for c in feature_columns
+                    ]
+                    _read_properties(buf, feature.vector(1), feature_layout, row)
+                else:
+                    _read_properties(buf, feature.vector(1), layout, row)
+                for column, value in zip(columns, row):
+                    column.append(value)
+            if not geometries:
+                return
+            yield ColumnarBatch(dict(zip(names, columns)), geometries)
+            if len(geometries) < batch_size:
+                return
+
+    def _read_sized(self):
+        prefix = self.fp.read(4)
+        if len(prefix) < 4:
+            return None
+        (size,) = _UINT32.unpack(prefix)
+        buf = self.fp.read(size)
+        if len(buf) < size:
+            raise ValueError("FlatGeobuf file is truncated")
+        return buf
+
+    def _skip_index(self):
+        if self._index_skipped:
+            return
+        self._index_skipped = True
+        if not self.index_node_size or not self.features_count:
+            return
+        size = index_size(self.features_count, self.index_node_size)
+        if self.fp.seekable():
+            self.fp.seek(size, 1)
+        else:
+            while size:
+                chunk = self.fp.read(min(size, 1024 * 1024))
+                if not chunk:
+                    break
+                size -= len(chunk)
+
+    def _wkb(self, geometry, geometry_type):
+        out = []
+        _geometry_wkb(geometry, geometry_type, self.has_z, out)
+        return b"".join(out)
+
+
+def index_size(features_count, node_size):
+    "Size in bytes of the packed Hilbert R-tree for features_count features"
+    node_size = min(max(node_size, 2), 65535)
+    n = nodes = features_count
+    while n != 1:
+        n = -(-n // node_size)
+        nodes += n
+    return nodes * _NODE_SIZE
+
+
+def _read_properties(buf, vector, layout, row):
+    if vector is None:
+        return
+    pos, length = vector
+    end = pos + length
+    while pos < end:
+        (index,) = _UINT16.unpack_from(buf, pos)
+        pos += 2
+        position, fgb_type = layout[index]
+        scalar = _SCALARS.get(fgb_type)
+        if scalar is not None:
+            (value,) = scalar.unpack_from(buf, pos)
+            pos += scalar.size
+        else:
+            (size,) = _UINT32.unpack_from(buf, pos)
+            pos += 4
+            value = bytes(buf[pos : pos + size])
+            pos += size
+            if fgb_type != BINARY:
+                value = value.decode("utf-8")
+        if position is not None:
+            row[position] = value
+
+
+def _geometry_wkb(geometry, geometry_type, has_z, out):
+    if geometry_type == UNKNOWN:
+        geometry_type = geometry.scalar(6, "<B")
+    code = geometry_type + (1000 if has_z else 0)
+    if geometry_type in (MULTIPOLYGON, GEOMETRYCOLLECTION):
+        parts = geometry.tables(7)
+        out.append(struct.pack("<BII", 1, code, len(parts)))
+        for part in parts:
+            # The parts of a MultiPolygon do not need to repeat their type
+            part_type = POLYGON if geometry_type == MULTIPOLYGON else UNKNOWN
+            _geometry_wkb(part, part_type, has_z, out)
+        return
+    coordinates = _Coordinates(geometry, has_z)
+    ends = geometry.uint32s(0) or [coordinates.count]
+    if geometry_type == POINT:
+        out.append(struct.pack("<BI", 1, code))
+        if coordinates.count:
+            out.append(coordinates.slice(0, 1))
+        else:
+            dims = 3 if has_z else 2
+            out.append(struct.pack("<{}d".format(dims), *[float("nan")] * dims))
+    elif geometry_type == LINESTRING:
+        out.append(struct.pack("<BII", 1, code, coordinates.count))
+        out.append(coordinates.slice(0, coordinates.count))
+    elif geometry_type == POLYGON:
+        rings = _spans(ends) if coordinates.count else []
+        out.append(struct.pack("<BII", 1, code, len(rings)))
+        for start, end in rings:
+            out.append(_UINT32.pack(end - start))
+            out.append(coordinates.slice(start, end))
+    elif geometry_type == MULTIPOINT:
+        out.append(struct.pack("<BII", 1, code, coordinates.count))
+        point = struct.pack("<BI", 1, code - MULTIPOINT + POINT)
+        for i in range(coordinates.count):
+            out.append(point)
+            out.append(coordinates.slice(i, i + 1))
+    elif geometry_type == MULTILINESTRING:
+        lines = _spans(ends) if coordinates.count else []
+        out.append(struct.pack("<BII", 1, code, len(lines)))
+        for start, end in lines:
+            out.append(
+                struct.pack("<BII", 1, code - MULTILINESTRING + LINESTRING, end - start)
+            )
+            out.append(coordinates.slice(start, end))
+    else:
+        raise ValueError(
+            "Unsupported FlatGeobuf geometry type: {}".format(geometry_type)
+        )
+
+
+def _spans(ends):
+    starts = [0] + list(ends[:-1])
+    return list(zip(starts, ends))
+
+
+class _Coordinates:
+    "The positions of a FlatGeobuf geometry, sliced out as WKB coordinates"
+
+    def __init__(self, geometry, has_z):
+        self.buf = geometry.buf
+        xy = geometry.vector(1)
+        self.xy = xy[0] if xy else 0
+        self.count = xy[1] // 2 if xy else 0
+        z = geometry.vector(2) if has_z else None
+        self.z = z[0] if z else None
+        self.has_z = has_z
+
+    def slice(self, start, end):
+        if not self.has_z:
+            # Interleaved little-endian doubles, exactly as in WKB
+            return bytes(self.buf[self.xy + start * 16 : self.xy + end * 16])
+        xy = numpy.frombuffer(
+            self.buf, "<f8", (end - start) * 2, self.xy + start * 16
+        ).reshape(-1, 2)
+        if self.z is None:
+            z = numpy.zeros(end - start)
+        else:
+            z = numpy.frombuffer(self.buf, "<f8", end - start, self.z + start * 8)
+        return numpy.column_stack([xy, z]).astype("<f8").tobytes()
+
+
+class _Table:
+    "Minimal reader for a table in a FlatBuffers buffer"
+
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+        vtable = pos - struct.unpack_from("<i", buf, pos)[0]
+        (size,) = _UINT16.unpack_from(buf, vtable)
+        self.offsets = struct.unpack_from(
+            "<{}H".format((size - 4) // 2), buf, vtable + 4
+        )
+
+    @classmethod
+    def root(cls, buf):
+        return cls(buf, _UINT32.unpack_from(buf, 0)[0])
+
+    def _field(self, slot):
+        if slot < len(self.offsets) and self.offsets[slot]:
+            return self.pos + self.offsets[slot]
+        return None
+
+    def _indirect(self, pos):
+        return pos + _UINT32.unpack_from(self.buf, pos)[0]
+
+    def scalar(self, slot, fmt, default=0):
+        pos = self._field(slot)
+        if pos is None:
+            return default
+        return struct.unpack_from(fmt, self.buf, pos)[0]
+
+    def vector(self, slot):
+        "The position of the first item of a vector and its length, or None"
+        pos = self._field(slot)
+        if pos is None:
+            return None
+        pos = self._indirect(pos)
+        (length,) = _UINT32.unpack_from(self.buf, pos)
+        return pos + 4, length
+
+    def uint32s(self, slot):
+        vector = self.vector(slot)
+        if vector is None:
+            return None
+        pos, length = vector
+        return struct.unpack_from("<{}I".format(length), self.buf, pos)
+
+    def string(self, slot):
+        vector = self.vector(slot)
+        if vector is None:
+            return None
+        pos, length = vector
+        return bytes(self.buf[pos : pos + length]).decode("utf-8")
+
+    def table(self, slot):
+        pos = self._field(slot)
+        if pos is None:
+            return None
+        return _Table(self.buf, self._indirect(pos))
+
+    def tables(self, slot):
+        vector = self.vector(slot)
+        if vector is None:
+            return []
+        pos, length = vector
+        return [_Table(self.buf, self._indirect(pos + 4 * i)) for i in range(length)]
@@ -0,0 +1,453 @@
+from collections import namedtuple
+import functools
+import itertools
+import json
+import math
+import numpy
+import re
+import shapely
+from shapely.geometry import mapping
+
+from . import twkb, wkb
+
+# precision: number of decimal places to round coordinates to
+# tolerance: topology-preserving simplification tolerance
+# zooms: web map zoom levels to add a simplified geometry column for
+# bbox: add minx, miny, maxx and maxy columns
+# encoding: how geometries are stored without SpatiaLite, from ENCODINGS
+# validate: what to do with invalid geometries, one of VALIDATE_MODES
+# source_crs: the CRS of the input, such as "EPSG:27700"
+# target_crs: the CRS to reproject geometries to
+GeometryOptions = namedtuple(
+    "GeometryOptions",
+    (
+        "precision",
+        "tolerance",
+        "zooms",
+        "bbox",
+        "encoding",
+        "validate",
+        "source_crs",
+        "target_crs",
+    ),
+    defaults=(None, None, (), False, "geojson", None, None, None),
+)
+
+# GeoJSON coordinates are longitude and latitude on WGS 84
+DEFAULT_CRS = "EPSG:4326"
+
+ENCODINGS = ("geojson", "wkb", "twkb")
+
+VALIDATE_MODES = ("reject", "repair", "quarantine")
+
+# Added to records with an invalid geometry by the quarantine mode
+INVALID_REASON = "_invalid_reason"
+
+BBOX_COLUMNS = ("minx", "miny", "maxx", "maxy")
+
+BATCH_SIZE = 1000
+
+# The radius of the sphere that web map tiles are projected from, in metres
+EARTH_RADIUS = 6378137.0
+
+
+def zoom_column(zoom):
+    return "geometry_z{}".format(zoom)
+
+
+def zoom_tolerance(zoom, crs=DEFAULT_CRS):
+    """
+    The width of a pixel at the equator, for 256 pixel tiles, in the units
+    of crs: degrees for EPSG:4326, or metres for most projected CRSs.
+    """
+    return _units_per_radian(crs) * 2 * math.pi / (256 * 2**zoom)
+
+
+@functools.lru_cache(maxsize=16)
+def _units_per_radian(crs):
+    "The length of one radian of the equator in the units of crs"
+    if not needs_reprojection(crs, DEFAULT_CRS):
+        return 180 / math.pi
+    pyproj = _pyproj()
+    try:
+        parsed = pyproj.CRS.from_user_input(crs)
+    except pyproj.exceptions.CRSError as e:
+        raise ValueError("Invalid CRS {}: {}".format(crs, e))
+    if not parsed.axis_info:
+        raise ValueError("{} does not have units to simplify in".format(crs))
+    # Radians per unit for a geographic CRS, otherwise metres per unit
+    factor = parsed.axis_info[0].unit_conversion_factor
+    if parsed.is_geographic:
+        return 1 / factor
+    return EARTH_RADIUS / factor
+
+
+def source_crs(options):
+    if options is None or options.source_crs is None:
+        return DEFAULT_CRS
+    return options.source_crs
+
+
+def target_crs(options):
+    "The CRS of geometries written with these options"
+    if options is None or options.target_crs is None:
+        return source_crs(options)
+    return options.target_crs
+
+
+def target_srid(options):
+    "The SRID to record for geometries written with these options"
+    return crs_srid(target_crs(options))
+
+
+@functools.lru_cache(maxsize=None)
+def crs_srid(crs):
+    "The EPSG code of crs, such as 27700 for EPSG:27700"
+    match = re.fullmatch(r"(?:EPSG:)?(\d+)", str(crs).strip(), re.IGNORECASE)
+    if match:
+        return int(match.group(1))
+    pyproj = _pyproj()
+    try:
+        srid = pyproj.CRS.from_user_input(crs).to_epsg()
+    except pyproj.exceptions.CRSError as e:
+        raise ValueError("Invalid CRS {}: {}".format(crs, e))
+    if srid is None:
+        raise ValueError("{} does not have an EPSG code".format(crs))
+    return srid
+
+
+@functools.lru_cache(maxsize=16)
+def get_transformer(source, target):
+    "A pyproj Transformer between two CRSs, cached as creating one is slow"
+    pyproj = _pyproj()
+    try:
+        return pyproj.Transformer.from_crs(source, target, always_xy=True)
+    except pyproj.exceptions.ProjError as e:
+        raise ValueError("Cannot reproject from {} to {}: {}".format(source, target, e))
+
+
+def _pyproj():
+    try:
+        import pyproj
+    except ImportError:
+        raise ValueError("Reprojecting geometries requires pyproj")
+    return pyproj
+
+
+def needs_reprojection(source, target):
+    if source == target:
+        return False
+    try:
+        return crs_srid(source) != crs_srid(target)
+    except ValueError:
+        # Not both EPSG codes, so let pyproj compare them
+        return True
+
+
+def reproject(geometries, source, target):
+    """
+    Transform an array of Shapely geometries from the source CRS to the
+    target CRS, passing all of their coordinates to pyproj at once.
+    """
+    if not needs_reprojection(source, target):
+        return geometries
+    transformer = get_transformer(source, target)
+    return shapely.transform(
+        geometries, transformer.transform, include_z=None, interleaved=False
+    )
+
+
+def geometry_columns(options):
+    "The names of the geometry columns written with these options"
+    columns = ["geometry"]
+    if options is not None:
+        columns.extend(zoom_column(zoom) for zoom in options.zooms)
+    return columns
+
+
+def quarantine_table(table):
+    return "{}_invalid".format(table)
+
+
+def process_records(
+    records, options, spatialite, geometry_format="wkt", batch_size=BATCH_SIZE
+):
+    """
+    Round and simplify the GeoJSON geometries of records, from
+    yield_records() with spatialite=False, adding a simplified column
+    for each zoom level and bounding box columns if requested.
+
+    Each batch is handled with Shapely array functions, then encoded
+    ready for insertion: as WKT or WKB with spatialite, otherwise using
+    options.encoding.
+
+    If options.validate is set, invalid geometries - including rings that
+    are not closed - either raise a ValueError ("reject"), are fixed
+    with make_valid() ("repair"), or are passed on unconverted with the
+    reason in their INVALID_REASON key ("quarantine").
+    """
+    if options.validate not in (None,) + VALIDATE_MODES:
+        raise ValueError(
+            "validate must be one of: {}".format(", ".join(VALIDATE_MODES))
+        )
+    records = iter(records)
+    source, target = source_crs(options), target_crs(options)
+    reprojecting = needs_reprojection(source, target)
+    modified = (
+        options.precision is not None
+        or options.tolerance
+        or options.zooms
+        or reprojecting
+    )
+    position = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        start = position
+        position += len(batch)
+        encoded = [
+            wkb.encode(record["geometry"]) if record["geometry"] else None
+            for record in batch
+        ]
+        if options.validate:
+            geometries = shapely.from_wkb(encoded, on_invalid="ignore")
+        else:
+            # Close unclosed rings, which are stored as they are without
+            # any of these options
+            geometries = shapely.from_wkb(encoded, on_invalid="fix")
+            _check_readable(batch, start, encoded, geometries)
+        if reprojecting:
+            geometries = reproject(geometries, source, target)
+        if options.precision is not None:
+            geometries = shapely.set_precision(
+                geometries, 10**-options.precision, mode="pointwise"
+            )
+        batch_modified = modified
+        if options.validate:
+            reasons = invalid_reasons(encoded, geometries)
+            invalid = numpy.flatnonzero(reasons.astype(bool))
+            if len(invalid) and options.validate == "reject":
+                i = invalid[0]
+                raise ValueError(
+                    "Invalid geometry in feature {}: {}".format(
+                        batch[i].get("id", start + i), reasons[i]
+                    )
+                )
+            if len(invalid) and options.validate == "repair":
+                geometries = _repair(
+                    encoded, geometries, invalid, source, target, options.precision
+                )
+                batch_modified = True
+            if len(invalid) and options.validate == "quarantine":
+                valid = ~reasons.astype(bool)
+                for i in invalid:
+                    batch[i]["geometry"] = json.dumps(batch[i]["geometry"])
+                    batch[i][INVALID_REASON] = reasons[i]
+                quarantined = [batch[i] for i in invalid]
+                batch = [record for record, ok in zip(batch, valid) if ok]
+                encoded = [value for value, ok in zip(encoded, valid) if ok]
+                geometries = geometries[valid]
+                yield from quarantined
+        columns = {}
+        for zoom in options.zooms:
+            tolerance = max(zoom_tolerance(zoom, target), options.tolerance or 0)
+            columns[zoom_column(zoom)] = _encode(
+                shapely.simplify(geometries, tolerance, preserve_topology=True),
+                spatialite,
+                geometry_format,
+                options,
+            )
+        if options.tolerance:
+            geometries = shapely.simplify(
+                geometries, options.tolerance, preserve_topology=True
+            )
+        if batch_modified:
+            columns["geometry"] = _encode(
+                geometries, spatialite, geometry_format, options
+            )
+        elif not spatialite and options.encoding == "wkb":
+            columns["geometry"] = encoded
+        elif not spatialite and options.encoding == "twkb":
+            columns["geometry"] = [
+                (
+                    twkb.encode(record["geometry"], _twkb_precision(options))
+                    if record["geometry"]
+                    else None
+                )
+                for record in batch
+            ]
+        elif spatialite:
+            # Only adding bounding boxes, so encode as yield_records() would
+            if geometry_format == "wkb":
+                columns["geometry"] = encoded
+            else:
+                columns["geometry"] = shapely.to_wkt(geometries, rounding_precision=-1)
+        for column, values in columns.items():
+            for record, value in zip(batch, values):
+                record[column] = value
+        if options.bbox:
+            bounds = shapely.bounds(geometries).tolist()
+            for record, values in zip(batch, bounds):
+                # Missing and empty geometries have NaN bounds
+                if values[0] != values[0]:
+                    values = (None, None, None, None)
+                record.update(zip(BBOX_COLUMNS, values))
+        yield from batch
+
+
+def divert_invalid(db, table, records, counts, batch_size=BATCH_SIZE):
+    """
+    Yield the records that do not have an INVALID_REASON. The others are
+    written to quarantine_table(table), with the reason in an
+    invalid_reason column, and counted in counts["quarantined"].
+    """
+    invalid = []
+    for record in records:
+        if INVALID_REASON in record:
+            record["invalid_reason"] = record.pop(INVALID_REASON)
+            invalid.append(record)
+            if len(invalid) >= batch_size:
+                _quarantine(db, table, invalid, counts)
+                invalid = []
+        else:
+            yield record
+    if invalid:
+        _quarantine(db, table, invalid, counts)
+
+
+def _quarantine(db, table, records, counts):
+    db[quarantine_table(table)].insert_all(records, alter=True)
+    counts["quarantined"] = counts.get("quarantined", 0) + len(records)
+
+
+def invalid_reasons(encoded, geometries):
+    """
+    Return an array with the reason each geometry is invalid, or None if
+    it is valid or missing. encoded is the WKB that geometries were read
+    from with on_invalid="ignore", which leaves those it could not read
+    as None.
+    """
+    present = numpy.array([value is not None for value in encoded], dtype=bool)
+    unreadable = present & shapely.is_missing(geometries)
+    invalid = present & ~unreadable & ~shapely.is_valid(geometries)
+    reasons = numpy.full(len(encoded), None, dtype=object)
+    if invalid.any():
+        reasons[invalid] = shapely.is_valid_reason(geometries[invalid])
+    for i in numpy.flatnonzero(unreadable):
+        # Only these few are read again, to find out why
+        reasons[i] = _unreadable_reason(encoded[i])
+    return reasons
+
+
+def _check_readable(batch, start, encoded, geometries):
+    "Raise a ValueError for the first geometry that could not be read"
+    present = numpy.array([value is not None for value in encoded], dtype=bool)
+    unreadable = numpy.flatnonzero(present & shapely.is_missing(geometries))
+    if len(unreadable):
+        i = unreadable[0]
+        raise ValueError(
+            "Invalid geometry in feature {}: {}".format(
+                batch[i].get("id", start + i), _unreadable_reason(encoded[i])
+            )
+        )
+
+
+def _unreadable_reason(value):
+    try:
+        shapely.from_wkb(value)
+    except shapely.errors.GEOSException as e:
+        return str(e).split(": ", 1)[-1]
+    return "Could not be read"
+
+
+def _repair(encoded, geometries, invalid, source, target, precision=None):
+    geometries = geometries.copy()
+    # Read the geometries that could not be read again, closing unclosed
+    # rings and so on, then fix what is still invalid
+    unreadable = [i for i in invalid if geometries[i] is None]
+    if unreadable:
+        geometries[unreadable] = reproject(
+            shapely.from_wkb([encoded[i] for i in unreadable], on_invalid="fix"),
+            source,
+            target,
+        )
+    geometries[invalid] = shapely.make_valid(geometries[invalid])
+    if precision is not None:
+        # Those read again were not rounded, and make_valid() can add new
+        # vertices, so round the repaired geometries keeping them valid
+        geometries[invalid] = shapely.set_precision(
+            geometries[invalid], 10**-precision
+        )
+    return geometries
+
+
+def _encode(geometries, spatialite, geometry_format, options):
+    if not spatialite:
+        if options.encoding == "wkb":
+            return shapely.to_wkb(geometries, flavor="iso")
+        if options.encoding == "twkb":
+            precision = _twkb_precision(options)
+            return [
+                twkb.encode(mapping(geometry), precision) if geometry else None
+                for geometry in geometries
+            ]
+        return shapely.to_geojson(geometries)
+    if geometry_format == "wkb":
+        return shapely.to_wkb(geometries, flavor="iso")
+    return shapely.to_wkt(
+        geometries,
+        rounding_precision=-1 if options.precision is None else options.precision,
+    )
+
+
+def _twkb_precision(options):
+    return twkb.PRECISION if options.precision is None else options.precision
+
+
+def bbox_rtree_table(table):
+    return "rtree_{}_bbox".format(table)
+
+
+def create_bbox_index(db, table, rtree=False):
+    """
+    Index the bounding box columns of table. With rtree=True also create
+    an R*Tree virtual table of the boxes keyed by rowid, populated from
+    the existing rows and kept up to date by triggers.
+    """
+    for column in BBOX_COLUMNS:
+        db[table].create_index([column], if_not_exists=True)
+    rtree_table = bbox_rtree_table(table)
+    if not rtree or rtree_table in db.table_names():
+        return
+    statements = (
+        "CREATE VIRTUAL TABLE [{rtree}] USING rtree(id, minx, maxx, miny, maxy)",
+        """
+        INSERT INTO [{rtree}] SELECT rowid, minx, maxx, miny, maxy
+        FROM [{table}] WHERE minx IS NOT NULL
+        """,
+        """
+        CREATE TRIGGER [{rtree}_insert] AFTER INSERT ON [{table}]
+        WHEN new.minx IS NOT NULL BEGIN
+            INSERT INTO [{rtree}] VALUES
+                (new.rowid, new.minx, new.maxx, new.miny, new.maxy);
+        END
+        """,
+        """
+        CREATE TRIGGER [{rtree}_update]
+        AFTER UPDATE OF minx, miny, maxx, maxy ON [{table}] BEGIN
+            DELETE FROM [{rtree}] WHERE id = old.rowid;
+            INSERT INTO [{rtree}] SELECT
+                new.rowid, new.minx, new.maxx, new.miny, new.maxy
+            WHERE new.minx IS NOT NULL;
+        END
+        """,
+        """
+        CREATE TRIGGER [{rtree}_delete] AFTER DELETE ON [{table}] BEGIN
+            DELETE FROM [{rtree}] WHERE id = old.rowid;
+        END
+        """,
+    )
+    # Not executescript(), which would commit a bulk_load() transaction
+    for statement in statements:
+        db.execute(statement.format(table=table, rtree=rtree_table))
@@ -0,0 +1,155 @@
+"""
+Reader for GeoParquet files, see https://geoparquet.org/
+
+Requires pyarrow. Geometries stored as WKB are passed through unchanged,
+those using the native GeoArrow encodings are converted to WKB with
+shapely.from_ragged_array().
+"""
+
+import json
+import numpy
+import shapely
+
+from .columnar import BATCH_SIZE, ColumnarBatch
+
+# GeoArrow encodings and the Shapely type each one is read as
+GEOARROW_TYPES = {
+    "point": shapely.GeometryType.POINT,
+    "linestring": shapely.GeometryType.LINESTRING,
+    "polygon": shapely.GeometryType.POLYGON,
+    "multipoint": shapely.GeometryType.MULTIPOINT,
+    "multilinestring": shapely.GeometryType.MULTILINESTRING,
+    "multipolygon": shapely.GeometryType.MULTIPOLYGON,
+}
+
+
+class GeoParquetReader:
+    """
+    Reads the schema and "geo" metadata of the GeoParquet file fp, a path
+    or binary file object. batches() then reads its row groups.
+
+    srid is the EPSG code of the primary geometry column's coordinate
+    reference system: 4326 if it does not specify one, or None if it is
+    not an EPSG code.
+    """
+
+    def __init__(self, fp):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Reading GeoParquet requires pyarrow")
+        self.file = pyarrow.parquet.ParquetFile(fp)
+        schema = self.file.schema_arrow
+        metadata = json.loads((schema.metadata or {}).get(b"geo", b"null"))
+        if not metadata:
+            raise ValueError("Parquet file does not have GeoParquet metadata")
+        self.geometry_column = metadata["primary_column"]
+        column = metadata["columns"][self.geometry_column]
+        self.encoding = column.get("encoding", "WKB")
+        if self.encoding != "WKB" and self.encoding not in GEOARROW_TYPES:
+            raise ValueError(
+                "Unsupported GeoParquet encoding: {}".format(self.encoding)
+            )
+        self.srid = _srid(column.get("crs", "default"))
+        self.fields = [field for field in schema if field.name != self.geometry_column]
+
+    @property
+    def column_types(self):
+        return {field.name: column_type(field.type) for field in self.fields}
+
+    def batches(self, batch_size=BATCH_SIZE):
+        "Yield a ColumnarBatch for every batch_size rows"
+        for batch in self.file.iter_batches(batch_size=batch_size):
+            columns = {
+                field.name: _values(batch.column(field.name)) for field in self.fields
+            }
+            geometries = batch.column(self.geometry_column)
+            if self.encoding == "WKB":
+                geometries = geometries.to_pylist()
+            else:
+                geometries = _geoarrow_wkb(geometries, self.encoding)
+            yield ColumnarBatch(columns, geometries)
+
+
+def column_type(arrow_type):
+    "The Python type used to store an Arrow type"
+    import pyarrow
+
+    if pyarrow.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    if pyarrow.types.is_integer(arrow_type) or pyarrow.types.is_boolean(arrow_type):
+        return int
+    if pyarrow.types.is_floating(arrow_type) or pyarrow.types.is_decimal(arrow_type):
+        return float
+    if (
+        pyarrow.types.is_binary(arrow_type)
+        or pyarrow.types.is_large_binary(arrow_type)
+        or pyarrow.types.is_fixed_size_binary(arrow_type)
+    ):
+        return bytes
+    return str
+
+
+def _values(array):
+    "Convert an Arrow array to a list of values SQLite can store"
+    import pyarrow
+
+    if pyarrow.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    arrow_type = array.type
+    if pyarrow.types.is_decimal(arrow_type):
+        array = array.cast(pyarrow.float64())
+    elif pyarrow.types.is_temporal(arrow_type):
+        array = array.cast(pyarrow.string())
+    elif pyarrow.types.is_nested(arrow_type):
+        # Lists, structs and maps are stored as JSON, like GeoJSON properties
+        return [
+            None if value is None else json.dumps(value, default=str)
+            for value in array.to_pylist()
+        ]
+    return array.to_pylist()
+
+
+def _geoarrow_wkb(array, encoding):
+    import pyarrow
+
+    nulls = array.is_null().to_numpy(zero_copy_only=False)
+    # Each level of nested lists gives one array of offsets, outermost first
+    offsets = []
+    while pyarrow.types.is_list(array.type) or pyarrow.types.is_large_list(array.type):
+        offsets.append(array.offsets.to_numpy())
+        array = array.values
+    if pyarrow.types.is_struct(array.type):
+        coords = [
+            array.field(i).to_numpy(zero_copy_only=False)
+            for i in range(array.type.num_fields)
+        ]
+        coords = numpy.column_stack(coords)
+    else:
+        # Interleaved coordinates in a fixed size list
+        size = array.type.list_size
+        coords = array.values.to_numpy(zero_copy_only=False).reshape(-1, size)
+    geometries = shapely.from_ragged_array(
+        GEOARROW_TYPES[encoding], coords, tuple(reversed(offsets)) or None
+    )
+    wkb = shapely.to_wkb(geometries, flavor="iso")
+    return [None if null else value for value, null in zip(wkb, nulls)]
+
+
+def _srid(crs):
+    "The EPSG code for a GeoParquet crs: PROJJSON, a string, null or default"
+    if crs == "default":
+        # Longitude and latitude on WGS 84
+        return 4326
+    if crs is None:
+        return None
+    if isinstance(crs, dict):
+        crs_id = crs.get("id") or {}
+        if crs_id.get("authority") == "EPSG":
+            return int(crs_id["code"])
+        if crs_id.get("authority") == "OGC" and crs_id.get("code") == "CRS84":
+            return 4326
+        return None
+    if isinstance(crs, str) and crs.upper().startswith("EPSG:"):
+        return int(crs.split(":", 1)[1])
+    return None
@@ -0,0 +1,284 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import collections
+import contextlib
+import itertools
+import mmap
+import multiprocessing
+import os
+
+from . import utils
+from .changes import HASH_COLUMN
+from .geometry import geometry_columns, target_srid
+from .streams import detect_compression
+
+# Newline-delimited files larger than this are split into several tasks
+NL_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Files that cannot be split are converted by one worker, which sends its
+# records back this many at a time
+STREAM_BATCH_SIZE = 1000
+
+# Batches each of those workers may convert before they are collected
+STREAM_QUEUE_SIZE = 4
+
+
+def iter_tasks(paths, nl, chunk_size=NL_CHUNK_SIZE):
+    """
+    Yield (path, start, end) tasks covering every input file.
+
+    Newline-delimited files are split into byte ranges that start on a
+    line boundary; other files, and compressed files, are handled as a
+    single task each, with an end of None.
+    """
+    for path in paths:
+        if not nl:
+            yield (path, 0, None)
+            continue
+        size = os.path.getsize(path)
+        start = 0
+        with open(path, "rb") as fp:
+            if detect_compression(fp):
+                # Compressed streams cannot be split
+                yield (path, 0, None)
+                continue
+            if not size:
+                continue
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                while start < size:
+                    # Extend each range to the end of the line it lands in
+                    end = mapped.find(b"\n", start + chunk_size)
+                    end = size if end == -1 else end + 1
+                    yield (path, start, end)
+                    start = end
+
+
+def convert_task(
+    task,
+    nl,
+    properties,
+    spatialite,
+    geometry_format,
+    decoder="auto",
+    hash_column=None,
+    geometry_options=None,
+    queue=None,
+):
+    """
+    Run in a worker process: parse one task and return its records.
+
+    If queue is given the records are put on it in batches instead,
+    followed by None, so that a whole file is never held in memory.
+    """
+    convert_args = (
+        properties,
+        spatialite,
+        geometry_format,
+        hash_column,
+        geometry_options,
+    )
+    if queue is not None:
+        try:
+            records = _convert(task, nl, decoder, convert_args)
+            while True:
+                batch = list(itertools.islice(records, STREAM_BATCH_SIZE))
+                if not batch:
+                    break
+                queue.put(batch)
+        finally:
+            # The caller then collects any exception from the task's result
+            queue.put(None)
+        return None
+    return list(_convert(task, nl, decoder, convert_args))
+
+
+def _convert(task, nl, decoder, convert_args):
+    path, start, end = task
+    with open(path, "rb") as fp:
+        if nl and end is not None:
+            lines = _read_range(fp, start, end).splitlines()
+            features = utils.get_features(lines, True, decoder)
+        else:
+            features = utils.get_features(fp, nl, decoder)
+        with contextlib.closing(features):
+            yield from utils.yield_records(features, None, *convert_args)
+
+
+def _read_range(fp, start, end):
+    "Read a byte range of a file through a memory map"
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return mapped[start:end]
+
+
+def yield_records(
+    paths,
+    workers,
+    nl=False,
+    properties="",
+    spatialite=False,
+    geometry_format="wkt",
+    decoder="auto",
+    hash_column=None,
+    geometry_options=None,
+    ordered=True,
+    chunk_size=NL_CHUNK_SIZE,
+):
+    """
+    Parse and convert the files in a pool of worker processes, yielding
+    records in input order so upserts behave as they would sequentially.
+    With ordered=False each task's records are yielded as soon as it
+    finishes instead, so one slow task does not hold up the others.
+
+    At most two tasks per worker are in flight at a time, which bounds
+    the number of converted records held in memory. Files that cannot be
+    split into byte ranges, such as FeatureCollections, are sent back
+    through a queue in batches of STREAM_BATCH_SIZE records as they are
+    converted.
+    """
+    # The manager is shut down first, so that workers blocked on a full
+    # queue stop if the records are not all consumed
+    with ProcessPoolExecutor(
+        max_workers=workers
+    ) as executor, contextlib.ExitStack() as stack:
+        manager = None
+        pending = collections.deque()
+        try:
+            for task in iter_tasks(paths, nl, chunk_size):
+                if len(pending) >= workers * 2:
+                    yield from _next_result(pending, ordered)
+                queue = None
+                if task[2] is None:
+                    if manager is None:
+                        manager = stack.enter_context(multiprocessing.Manager())
+                    queue = manager.Queue(STREAM_QUEUE_SIZE)
+                future = executor.submit(
+                    convert_task,
+                    task,
+                    nl,
+                    properties,
+                    spatialite,
+                    geometry_format,
+                    decoder,
+                    hash_column,
+                    geometry_options,
+                    queue,
+                )
+                pending.append((future, queue))
+            while pending:
+                yield from _next_result(pending, ordered)
+        finally:
+            for future, queue in pending:
+                future.cancel()
+
+
+def _next_result(pending, ordered):
+    if ordered:
+        return _task_records(*pending.popleft())
+    streamed = [item for item in pending if item[1] is not None]
+    if streamed:
+        # Tasks before the oldest streamed task cannot block, so it has
+        # started or soon will, and its queue must be drained to finish
+        item = streamed[0]
+    else:
+        done, _ = wait([future for future, _ in pending], return_when=FIRST_COMPLETED)
+        item = next(item for item in pending if item[0] in done)
+    pending.remove(item)
+    return _task_records(*item)
+
+
+def _task_records(future, queue):
+    if queue is None:
+        yield from future.result()
+        return
+    for batch in iter(queue.get, None):
+        yield from batch
+    # Raises any exception from the worker
+    future.result()
+
+
+def import_files(
+    db_path,
+    table,
+    paths,
+    workers,
+    nl=False,
+    decoder="auto",
+    properties="",
+    spatialite=False,
+    spatialite_mod=None,
+    spatial_index=False,
+    geometry_format="wkt",
+    stats=None,
+    sample=None,
+    changes=None,
+    geometry_options=None,
+    ordered=True,
+    **kwargs
+):
+    """
+    Import several GeoJSON files using worker processes for parsing and
+    geometry conversion, with this process as the single SQLite writer.
+
+    sample is an optional list of features to detect column types from.
+    ordered=False inserts each task's records as soon as they are ready,
+    which can be faster but does not preserve the order of the input. It
+    cannot be used if there is a primary key, given as pk or detected
+    from the sample, as upserts must then be applied in input order.
+    Other keyword arguments are passed to utils.import_records().
+    """
+    if spatialite_mod or spatial_index:
+        spatialite = True
+    hash_column = HASH_COLUMN if changes is not None else None
+    records = yield_records(
+        paths,
+        workers,
+        nl=nl,
+        properties=properties,
+        spatialite=spatialite,
+        geometry_format=geometry_format,
+        decoder=decoder,
+        hash_column=hash_column,
+        geometry_options=geometry_options,
+        ordered=ordered,
+    )
+    if stats is not None:
+        # Parsing and conversion happen in the workers, so this is the
+        # time spent waiting for their results
+        records = stats.iterate("workers", records)
+    if sample is not None:
+        sample = list(
+            utils.yield_records(
+                sample, None, properties, False, "wkt", hash_column, geometry_options
+            )
+        )
+    if not ordered:
+        # Check the primary key that import_records() would detect
+        detect_from = sample
+        if detect_from is None:
+            detect_from = list(
+                itertools.islice(records, kwargs.get("sample_size", 100))
+            )
+            records = itertools.chain(detect_from, records)
+        if kwargs.get("pk") or (detect_from and utils.has_ids(detect_from)):
+            raise ValueError(
+                "Records with a primary key cannot be inserted unordered, "
+                "as upserts must be applied in input order"
+            )
+    return utils.import_records(
+        db_path,
+        table,
+        records,
+        spatialite=spatialite,
+        spatialite_mod=spatialite_mod,
+        spatial_index=spatial_index,
+        geometry_format=geometry_format,
+        stats=stats,
+        sample=sample,
+        changes=changes,
+        geometry_columns=geometry_columns(geometry_options),
+        bbox=geometry_options is not None and geometry_options.bbox,
+        quarantine=(
+            geometry_options is not None and geometry_options.validate == "quarantine"
+        ),
+        srid=target_srid(geometry_options),
+        **kwargs
+    )
@@ -0,0 +1,242 @@
+"""
+A reusable import session, and a server that runs the imports sent to it
+over a Unix socket. Many small imports can then share one connection,
+and only pay for starting Python, loading SpatiaLite and looking up the
+tables once.
+"""
+
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import sqlite_utils
+import stat
+import time
+
+from . import utils
+from .geometry import GeometryOptions
+from .stats import ImportStats
+
+# Options a job may set, passed on to Importer.import_file()
+JOB_OPTIONS = (
+    "nl",
+    "decoder",
+    "pk",
+    "alter",
+    "properties",
+    "spatial_index",
+    "spatial_index_threshold",
+    "geometry_format",
+    "batch_size",
+    "sample_size",
+    "cluster",
+)
+
+
+class JobError(Exception):
+    "An import job sent to a server failed"
+
+
+class Importer:
+    """
+    Imports GeoJSON into the database at db_path over one connection,
+    which is kept open between imports. SpatiaLite is loaded when the
+    session starts, and the columns of the tables are cached in a
+    utils.SchemaCache.
+
+    Other keyword arguments are defaults for every import, passed to
+    utils.import_features(), and can be overridden for each one.
+
+    Use it as a context manager, or call close() when finished.
+    """
+
+    def __init__(self, db_path, spatialite=False, spatialite_mod=None, **defaults):
+        if isinstance(db_path, sqlite_utils.Database):
+            self.db = db_path
+        else:
+            self.db = sqlite_utils.Database(db_path)
+        if spatialite_mod or defaults.get("spatial_index"):
+            spatialite = True
+        if spatialite:
+            utils.init_spatialite(self.db, spatialite_mod)
+        self.spatialite = spatialite
+        self.spatialite_mod = spatialite_mod
+        self.schema = utils.SchemaCache(self.db)
+        self.defaults = defaults
+
+    def import_features(self, table, features, **kwargs):
+        "Import an iterable of GeoJSON features, see utils.import_features()"
+        options = dict(self.defaults, **kwargs)
+        options.setdefault("spatialite", self.spatialite)
+        options.setdefault("spatialite_mod", self.spatialite_mod)
+        try:
+            return utils.import_features(
+                self.db, table, features, schema=self.schema, **options
+            )
+        except Exception:
+            # The failed import may have changed tables before it stopped
+            self.schema.clear()
+            raise
+
+    def import_file(self, table, path, nl=False, decoder="auto", **kwargs):
+        "Import a GeoJSON, or newline-delimited GeoJSON, file at path"
+        with open(path, "rb") as fp:
+            # Closed so that a failed import stops any read-ahead thread
+            with contextlib.closing(utils.get_features(fp, nl, decoder)) as features:
+                return self.import_features(table, features, **kwargs)
+
+    def run_job(self, job):
+        """
+        Run a job, a dictionary decoded from a server request, and return
+        the response to send back. See serve() for the format.
+        """
+        job = dict(job)
+        try:
+            table = job.pop("table")
+            files = job.pop("files")
+        except KeyError as e:
+            raise ValueError("Jobs must include {}".format(e))
+        if isinstance(files, str):
+            files = [files]
+        geometry_options = {
+            field: job.pop(field) for field in GeometryOptions._fields if field in job
+        }
+        for option in job:
+            if option not in JOB_OPTIONS:
+                raise ValueError("Unknown job option: {}".format(option))
+        if geometry_options:
+            if "zooms" in geometry_options:
+                geometry_options["zooms"] = tuple(sorted(geometry_options["zooms"]))
+            job["geometry_options"] = GeometryOptions(**geometry_options)
+        stats = ImportStats()
+        for path in files:
+            self.import_file(table, path, stats=stats, **job)
+        return {
+            "table": table,
+            "files": len(files),
+            "rows": stats.rows("insert"),
+            "seconds": round(time.perf_counter() - stats.started, 3),
+        }
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def serve(importer, socket_path, log=None):
+    """
+    Accept import jobs for importer, an Importer, on a Unix socket at
+    socket_path, until a job asks the server to shut down.
+
+    Each request is a line of JSON, such as:
+
+        {"table": "places", "files": ["/data/places.geojson"], "nl": true}
+
+    Jobs may also set the options in JOB_OPTIONS and the fields of
+    GeometryOptions. Each one gets a line of JSON in reply, with the
+    number of rows written or an "error". {"shutdown": true} stops the
+    server.
+
+    Jobs run one at a time, in the order they arrive, as SQLite only
+    allows one writer. Relative paths are relative to the server.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Unix sockets are not supported on this platform")
+    _remove_stale_socket(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                response = _respond(importer, line, log)
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+                if response.get("shutdown"):
+                    self.server.stopping = True
+                    return
+
+    server = socketserver.UnixStreamServer(socket_path, Handler)
+    server.stopping = False
+    utils._log(log, "Listening on {}".format(socket_path))
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def _respond(importer, line, log):
+    try:
+        job = json.loads(line)
+        if not isinstance(job, dict):
+            raise ValueError("Jobs must be JSON objects")
+        if job.get("shutdown"):
+            return {"shutdown": True}
+        response = importer.run_job(job)
+    except Exception as e:
+        # Report the failure to the client and keep serving
+        utils._log(log, "Job failed: {}".format(e))
+        return {"error": str(e) or e.__class__.__name__}
+    utils._log(
+        log,
+        "Imported {rows} rows into {table} from {files} files in {seconds}s".format(
+            **response
+        ),
+    )
+    return response
+
+
+def _remove_stale_socket(socket_path):
+    # A socket file left behind by a server that did not exit cleanly
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("{} already exists and is not a socket".format(socket_path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise ValueError("A server is already listening on {}".format(socket_path))
+
+
+def submit(socket_path, table, files, timeout=None, **options):
+    """
+    Send an import job to a server started by serve() and wait for it to
+    finish, returning the server's response. Paths in files are made
+    absolute first. Raises JobError if the import failed.
+    """
+    if isinstance(files, (str, os.PathLike)):
+        files = [files]
+    job = dict(options, table=table, files=[os.path.abspath(f) for f in files])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job).encode("utf-8") + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        response = json.loads(sock.makefile("rb").readline())
+    if "error" in response:
+        raise JobError(response["error"])
+    return response
+
+
+def shutdown(socket_path, timeout=None):
+    "Ask a server started by serve() to stop, once its current job is done"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(b'{"shutdown": true}\n')
+        sock.shutdown(socket.SHUT_WR)
+        sock.makefile("rb").readline()
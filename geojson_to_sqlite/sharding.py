@@ -0,0 +1,424 @@
+import contextlib
+import itertools
+import numpy
+import os
+import queue
+import shapely
+import sqlite_utils
+import zlib
+
+from . import clustering, geometry, utils
+
+SHARD_BY = ("spatial", "pk")
+
+# Table in the coordinator database describing each shard
+SHARDS_TABLE = "_geojson_shards"
+
+# Records sent to a shard writer at a time, and how many may be waiting
+ROUTE_BATCH_SIZE = 1000
+QUEUE_SIZE = 8
+
+# SQLite can attach 10 databases by default, and open_sharded() attaches
+# every shard
+MAX_SHARDS = 10
+
+
+def shard_path(db_path, shard):
+    "The path of a shard database, next to the coordinator db_path"
+    stem, ext = os.path.splitext(db_path)
+    return "{}-shard-{}{}".format(stem, shard, ext or ".db")
+
+
+def import_sharded(
+    db_path,
+    table,
+    records,
+    shards,
+    shard_by=None,
+    pk=None,
+    spatialite=False,
+    spatialite_mod=None,
+    geometry_format="wkt",
+    sample_size=100,
+    sample=None,
+    bulk=None,
+    stats=None,
+    extent=clustering.WORLD,
+    srid=4326,
+    ordered=True,
+    quarantine=False,
+    log=None,
+    **kwargs
+):
+    """
+    Import records from yield_records() into shards separate databases,
+    each loaded by its own writer process, and record them in the
+    coordinator database at the path db_path. Use open_sharded() to
+    query them. Returns the number of rows in each shard.
+
+    shard_by="spatial" sends each record to a shard covering one part of
+    a Hilbert curve through extent, so that each shard covers a compact
+    area. srid is the SRID of the records' geometries, which are placed
+    on the curve in EPSG:4326. shard_by="pk" uses a hash of the primary
+    key, so upserts of a feature always reach the shard that already
+    holds it. Spatial sharding cannot be used with a primary key, given
+    as pk or detected from ids, as a feature that moved would be upserted
+    into a different shard from its old row. By default records are
+    sharded by primary key if there is one, or spatially if not. A table
+    that was imported before must use the same number of shards, sharded
+    the same way, so that features reach the shards that hold them.
+
+    bulk is an optional dictionary of bulk_load() arguments for the
+    writers. ordered=False says records are not in input order, as from
+    parallel.yield_records(ordered=False), which is only allowed if there
+    is no primary key.
+
+    quarantine=True writes records that the geometry module marked as
+    invalid to a quarantine table in the coordinator database, before
+    the others are routed, see geometry.divert_invalid(). log is an
+    optional callable that is passed a message saying how many there
+    were. Other keyword arguments are passed to import_records().
+    """
+    if shard_by is not None and shard_by not in SHARD_BY:
+        raise ValueError("shard_by must be one of: {}".format(", ".join(SHARD_BY)))
+    if not 1 <= shards <= MAX_SHARDS:
+        raise ValueError(
+            "shards must be between 1 and {}, as that is how many databases "
+            "SQLite can attach to query them together".format(MAX_SHARDS)
+        )
+    if spatialite_mod or kwargs.get("spatial_index"):
+        spatialite = True
+    if stats is None:
+        stats = utils.NullStats()
+    coordinator = sqlite_utils.Database(db_path)
+    existing = _existing_shards(coordinator, table)
+    if existing and len(existing) != shards:
+        raise ValueError(
+            "{} is already split into {} shards, so it cannot be imported "
+            "into {}".format(table, len(existing), shards)
+        )
+    quarantined = {}
+    if quarantine:
+        # Kept together in the coordinator, rather than spread across shards
+        records = geometry.divert_invalid(coordinator, table, records, quarantined)
+        if sample is not None:
+            sample = [r for r in sample if geometry.INVALID_REASON not in r]
+    records = stats.count("insert", records)
+    if sample is None:
+        sample = list(itertools.islice(records, sample_size))
+        records = itertools.chain(sample, records)
+    if pk is None and sample and utils.has_ids(sample):
+        pk = "id"
+    if pk and not ordered:
+        raise ValueError(
+            "Records with a primary key cannot be inserted unordered, "
+            "as upserts must be applied in input order"
+        )
+    if shard_by is None:
+        shard_by = "pk" if pk else "spatial"
+    if shard_by == "pk" and not pk:
+        raise ValueError("Sharding by primary key requires a primary key")
+    if shard_by == "spatial" and pk:
+        raise ValueError(
+            "Spatial sharding cannot be used with a primary key, as a feature "
+            "that moved would be upserted into a different shard"
+        )
+    previous_by = existing[0].get("shard_by") if existing else None
+    if previous_by and previous_by != shard_by:
+        raise ValueError(
+            "{} is already sharded by {}, so it cannot be sharded by {}".format(
+                table, previous_by, shard_by
+            )
+        )
+    kwargs.update(
+        pk=pk,
+        spatialite=spatialite,
+        spatialite_mod=spatialite_mod,
+        geometry_format=geometry_format,
+        srid=srid,
+    )
+
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    writers = []
+    for shard in range(shards):
+        shard_queue = context.Queue(QUEUE_SIZE)
+        process = context.Process(
+            target=_write_shard,
+            args=(
+                shard,
+                shard_path(db_path, shard),
+                table,
+                shard_queue,
+                results,
+                sample,
+                kwargs,
+                bulk,
+            ),
+            daemon=True,
+        )
+        process.start()
+        writers.append((process, shard_queue))
+
+    bounds = numpy.full((shards, 4), numpy.nan)
+    try:
+        while True:
+            batch = list(itertools.islice(records, ROUTE_BATCH_SIZE))
+            if not batch:
+                break
+            with stats.stage("route"):
+                geometries = clustering.parse_geometries(
+                    [record.get("geometry") for record in batch],
+                    spatialite,
+                    geometry_format,
+                )
+                batch_bounds = shapely.bounds(geometries)
+                if shard_by == "pk":
+                    targets = [_hash_shard(record[pk], shards) for record in batch]
+                else:
+                    targets = _spatial_shards(batch_bounds, shards, extent, srid)
+                routed = [[] for _ in range(shards)]
+                for record, target, record_bounds in zip(batch, targets, batch_bounds):
+                    routed[target].append(record)
+                    bounds[target] = _union(bounds[target], record_bounds)
+            stats.add("route", rows=len(batch))
+            with stats.stage("write"):
+                for (process, shard_queue), shard_records in zip(writers, routed):
+                    if shard_records:
+                        _put(shard_queue, shard_records, process, results)
+        with stats.stage("write"):
+            for process, shard_queue in writers:
+                _put(shard_queue, None, process, results)
+            counts = _wait(writers, results)
+    finally:
+        for process, shard_queue in writers:
+            if process.is_alive():
+                process.terminate()
+            # Do not wait to flush batches that a failed writer will never read
+            shard_queue.cancel_join_thread()
+
+    _record_shards(coordinator, db_path, table, counts, bounds, shard_by)
+    if quarantined:
+        stats.add("quarantine", rows=quarantined["quarantined"])
+        utils._log(
+            log,
+            "Wrote {} features with invalid geometries to {}".format(
+                quarantined["quarantined"], geometry.quarantine_table(table)
+            ),
+        )
+    stats.finish()
+    return counts
+
+
+def _hash_shard(key, shards):
+    # A stable hash, unlike hash() which differs between processes
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+def _spatial_shards(bounds, shards, extent, srid):
+    keys = clustering.curve_keys(*clustering.centres(bounds, srid), "hilbert", extent)
+    # Missing geometries have NaN bounds and are spread by their position
+    cells = 1 << (2 * clustering.ORDER)
+    targets = (keys * shards // cells).clip(0, shards - 1)
+    missing = numpy.isnan(bounds[:, 0])
+    targets[missing] = numpy.arange(missing.sum()) % shards
+    return targets.tolist()
+
+
+def _union(current, new):
+    if numpy.isnan(new[0]):
+        return current
+    if numpy.isnan(current[0]):
+        return new
+    return numpy.concatenate(
+        [numpy.minimum(current[:2], new[:2]), numpy.maximum(current[2:], new[2:])]
+    )
+
+
+def _put(shard_queue, item, process, results):
+    # Time out regularly so that a writer that has failed is noticed
+    while True:
+        try:
+            shard_queue.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                _raise_failure(results)
+
+
+def _wait(writers, results):
+    counts = {}
+    while len(counts) < len(writers):
+        try:
+            shard, outcome = results.get(timeout=0.5)
+        except queue.Empty:
+            # Writers report before exiting, unless they crashed
+            if any(process.exitcode not in (None, 0) for process, _ in writers):
+                raise RuntimeError("A shard writer process exited unexpectedly")
+            continue
+        if isinstance(outcome, BaseException):
+            raise outcome
+        counts[shard] = outcome
+    for process, _ in writers:
+        process.join()
+    return [counts[shard] for shard in range(len(writers))]
+
+
+def _raise_failure(results):
+    # A writer stopped early, so it should have reported an exception
+    while True:
+        try:
+            _, outcome = results.get(timeout=1)
+        except queue.Empty:
+            raise RuntimeError("A shard writer process exited unexpectedly")
+        if isinstance(outcome, BaseException):
+            raise outcome
+
+
+def _write_shard(shard, path, table, shard_queue, results, sample, kwargs, bulk):
+    "Run in a writer process: import the batches of records sent to one shard"
+
+    def records():
+        while True:
+            batch = shard_queue.get()
+            if batch is None:
+                return
+            yield from batch
+
+    try:
+        db = sqlite_utils.Database(path)
+        if kwargs["spatialite"]:
+            # SpatiaLite metadata must be created outside the transaction
+            utils.init_spatialite(db, kwargs["spatialite_mod"])
+        context = (
+            utils.bulk_load(db, **bulk)
+            if bulk is not None
+            else contextlib.nullcontext()
+        )
+        with context:
+            utils.import_records(db, table, records(), sample=sample, **kwargs)
+        results.put((shard, db[table].count if db[table].exists() else 0))
+    except Exception as e:
+        results.put((shard, e))
+
+
+def _existing_shards(db, table):
+    "The rows of SHARDS_TABLE recorded for table by an earlier import"
+    if not db[SHARDS_TABLE].exists():
+        return []
+    return list(
+        db[SHARDS_TABLE].rows_where("table_name = ?", [table], order_by="shard")
+    )
+
+
+def _record_shards(db, db_path, table, counts, bounds, shard_by):
+    directory = os.path.dirname(os.path.abspath(db_path))
+    existing = {row["shard"]: row for row in _existing_shards(db, table)}
+    rows = []
+    for shard, (count, shard_bounds) in enumerate(zip(counts, bounds)):
+        previous = existing.get(shard)
+        if previous and previous["minx"] is not None:
+            shard_bounds = _union(
+                numpy.array(
+                    [
+                        previous["minx"],
+                        previous["miny"],
+                        previous["maxx"],
+                        previous["maxy"],
+                    ]
+                ),
+                shard_bounds,
+            )
+        values = [None if numpy.isnan(v) else float(v) for v in shard_bounds]
+        rows.append(
+            {
+                "table_name": table,
+                "shard": shard,
+                "path": os.path.relpath(
+                    os.path.abspath(shard_path(db_path, shard)), directory
+                ),
+                "rows": count,
+                "shard_by": shard_by,
+                "minx": values[0],
+                "miny": values[1],
+                "maxx": values[2],
+                "maxy": values[3],
+            }
+        )
+    # alter adds shard_by to tables recorded before it was
+    db[SHARDS_TABLE].upsert_all(rows, pk=("table_name", "shard"), alter=True)
+
+
+def open_sharded(db_path):
+    """
+    Open a coordinator database created by import_sharded(), attaching
+    each shard as shard_N and creating a TEMP view for every sharded
+    table that combines the shards with UNION ALL.
+
+    SQLite does not allow views stored in one database to refer to
+    another, so the views only exist on the returned connection.
+    """
+    db = sqlite_utils.Database(db_path)
+    directory = os.path.dirname(os.path.abspath(db_path))
+    tables = {}
+    for row in db[SHARDS_TABLE].rows_where(order_by="table_name, shard"):
+        tables.setdefault(row["table_name"], []).append(row)
+    attached = {}
+    for rows in tables.values():
+        for row in rows:
+            if row["path"] not in attached:
+                alias = "shard_{}".format(len(attached))
+                db.attach(alias, os.path.join(directory, row["path"]))
+                attached[row["path"]] = alias
+    for table, rows in tables.items():
+        aliases = [attached[row["path"]] for row in rows]
+        db.execute(union_view_sql(db, table, aliases))
+    return db
+
+
+def union_view_sql(db, table, aliases):
+    "SQL for a TEMP view of table that UNION ALLs it from each attached alias"
+    columns = {}
+    for alias in aliases:
+        for row in db.execute("PRAGMA [{}].table_info([{}])".format(alias, table)):
+            columns.setdefault(row[1], None)
+    selects = []
+    for alias in aliases:
+        present = {
+            row[1]
+            for row in db.execute("PRAGMA [{}].table_info([{}])".format(alias, table))
+        }
+        expressions = [
+            (
+                "[{}]".format(column)
+                if column in present
+                else "NULL AS [{}]".format(column)
+            )
+            for column in columns
+        ]
+        selects.append(
+            "SELECT {}, '{}' AS _shard FROM [{}].[{}]".format(
+                ", ".join(expressions), alias, alias, table
+            )
+        )
+    return "CREATE TEMP VIEW [{}] AS {}".format(table, " UNION ALL ".join(selects))
+
+
+def shards_for_bbox(db, table, minx, miny, maxx, maxy):
+    """
+    Return the aliases, as attached by open_sharded(), of the shards of
+    table whose bounding box intersects the one given.
+    """
+    databases = db.execute("PRAGMA database_list").fetchall()
+    directory = os.path.dirname(databases[0][2])
+    aliases = {os.path.realpath(path): name for _, name, path in databases}
+    rows = db.execute(
+        "SELECT path FROM [{}] WHERE table_name = ? AND minx <= ? AND maxx >= ? "
+        "AND miny <= ? AND maxy >= ? ORDER BY shard".format(SHARDS_TABLE),
+        [table, maxx, minx, maxy, miny],
+    )
+    return [
+        aliases[os.path.realpath(os.path.join(directory, path))] for (path,) in rows
+    ]
@@ -0,0 +1,104 @@
+import contextlib
+import time
+
+
+class ImportStats:
+    """
+    Collects cumulative time and row counts for each stage of an import.
+
+    Pass an instance as stats= to import_features() or import_records().
+    Stages are timed exclusively: time spent pulling features through
+    "parse" while "convert" or "insert" is running is only counted
+    against "parse".
+
+    callback, if provided, is called with this object every interval
+    inserted rows and once more when the import has finished.
+    """
+
+    def __init__(self, callback=None, interval=1000):
+        self.callback = callback
+        self.interval = interval
+        self.stages = {}
+        self.started = time.perf_counter()
+        self._stack = []
+
+    def add(self, stage, seconds=0.0, rows=0):
+        totals = self.stages.setdefault(stage, {"seconds": 0.0, "rows": 0})
+        totals["seconds"] += seconds
+        totals["rows"] += rows
+
+    def rows(self, stage):
+        return self.stages.get(stage, {}).get("rows", 0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        "Time the body of a with block, excluding any nested stages"
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            self.add(name, elapsed - nested)
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def iterate(self, name, iterable):
+        "Time each step of iterable against the named stage, counting rows"
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+            self.add(name, rows=1)
+            yield item
+
+    def count(self, name, iterable):
+        "Count the rows passing through iterable without timing them"
+        for item in iterable:
+            self.add(name, rows=1)
+            if self.callback and self.rows(name) % self.interval == 0:
+                self.callback(self)
+            yield item
+
+    def finish(self):
+        if self.callback:
+            self.callback(self)
+
+    def as_dict(self):
+        return {
+            "elapsed_seconds": time.perf_counter() - self.started,
+            "stages": {
+                name: dict(
+                    totals,
+                    rows_per_second=(
+                        totals["rows"] / totals["seconds"]
+                        if totals["seconds"] > 0
+                        else None
+                    ),
+                )
+                for name, totals in self.stages.items()
+            },
+        }
+
+
+class NullStats(ImportStats):
+    "Used when no stats object is provided, so nothing is timed"
+
+    def __init__(self):
+        super().__init__()
+
+    def add(self, stage, seconds=0.0, rows=0):
+        pass
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def count(self, name, iterable):
+        return iterable
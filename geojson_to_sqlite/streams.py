@@ -0,0 +1,194 @@
+import io
+import queue
+import threading
+
+# Leading bytes of each supported compressed format
+MAGIC_BYTES = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+
+# Size of each decompressed chunk, and how many may be read ahead
+READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+READ_AHEAD_CHUNKS = 8
+
+
+def detect_compression(fp):
+    """
+    Return the name of the compression used by a binary file object, from
+    its magic bytes, or None. The file position is not changed.
+    """
+    if hasattr(fp, "peek"):
+        head = fp.peek(6)[:6]
+    elif hasattr(fp, "seekable") and fp.seekable():
+        position = fp.tell()
+        head = fp.read(6)
+        fp.seek(position)
+    else:
+        return None
+    if not isinstance(head, bytes):
+        return None
+    for magic, name in MAGIC_BYTES:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def detect_format(fp):
+    """
+    Return the name of the columnar format of a binary file object from
+    columnar.FORMATS, based on its magic bytes, or None. The position is
+    not changed.
+    """
+    if hasattr(fp, "peek"):
+        head = fp.peek(8)[:8]
+    elif hasattr(fp, "seekable") and fp.seekable():
+        position = fp.tell()
+        head = fp.read(8)
+        fp.seek(position)
+    else:
+        return None
+    if not isinstance(head, bytes):
+        return None
+    if is_flatgeobuf(head):
+        return "flatgeobuf"
+    if head.startswith(b"PAR1"):
+        return "geoparquet"
+    return None
+
+
+def is_flatgeobuf(head):
+    "True if the bytes head are the start of a FlatGeobuf file"
+    return head[:3] == b"fgb" and head[4:7] == b"fgb"
+
+
+def decompress(fp, threaded=True):
+    """
+    If fp is compressed with gzip, bzip2, xz or zstd return a binary file
+    object of its decompressed contents, otherwise return fp unchanged.
+
+    With threaded=True decompression runs in a background thread, reading
+    ahead of the caller, so that it overlaps with parsing.
+    """
+    compression = detect_compression(fp)
+    if compression is None:
+        return fp
+    if compression == "gzip":
+        import gzip
+
+        decompressed = gzip.GzipFile(fileobj=fp, mode="rb")
+    elif compression == "bz2":
+        import bz2
+
+        decompressed = bz2.BZ2File(fp)
+    elif compression == "xz":
+        import lzma
+
+        decompressed = lzma.LZMAFile(fp)
+    else:
+        decompressed = _zstd_reader(fp)
+    if threaded:
+        return io.BufferedReader(ReadAheadReader(decompressed))
+    return decompressed
+
+
+def _zstd_reader(fp):
+    try:
+        from compression import zstd
+    except ImportError:
+        pass
+    else:
+        return zstd.ZstdFile(fp)
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstandard package is required to read zstd files")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp))
+
+
+class ChunkReader(io.RawIOBase):
+    "A readable binary file fed by an iterator of bytes chunks"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.pending):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+            self.offset = 0
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = self.pending[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+
+_END = object()
+
+
+class ReadAheadReader(ChunkReader):
+    """
+    Reads fp in a background thread, keeping up to READ_AHEAD_CHUNKS
+    chunks ready. Exceptions raised while reading are re-raised here.
+
+    The thread stops when the reader is closed, or garbage collected by
+    a caller that stopped reading early, as it holds no reference to it.
+    """
+
+    def __init__(self, fp, chunk_size=READ_AHEAD_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(READ_AHEAD_CHUNKS)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=_read_ahead,
+            args=(fp, chunk_size, self.queue, self.stopped),
+            daemon=True,
+        )
+        self.thread.start()
+        super().__init__(_queued_chunks(self.queue))
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+
+def _read_ahead(fp, chunk_size, chunks, stopped):
+    try:
+        while not stopped.is_set():
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            _put(chunks, stopped, chunk)
+        _put(chunks, stopped, _END)
+    except Exception as e:
+        _put(chunks, stopped, e)
+
+
+def _put(chunks, stopped, item):
+    # Time out regularly so that close() can stop a blocked thread
+    while not stopped.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _queued_chunks(chunks):
+    while True:
+        item = chunks.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
@@ -0,0 +1,373 @@
+"""
+An index of the XYZ map tiles covered by each row of a table, so that
+the rows for a tile can be found with a single range scan.
+"""
+
+import itertools
+import json
+import math
+import numpy
+import shapely
+from shapely.geometry import shape
+
+from . import geometry, twkb, wkb
+from .changes import transaction
+from .dedupe import GEOMETRY_ID, geometries_table
+
+# Table recording the zoom range indexed for each table
+TILE_INDEXES_TABLE = "_geojson_tile_indexes"
+
+# The most northern and southern latitudes of Web Mercator tiles
+MAX_LATITUDE = 85.0511287798066
+
+MAX_ZOOM = 24
+
+# Rows read and indexed at a time
+BATCH_SIZE = 5000
+
+# Changed rows updated at a time, as SQLite may allow only 999 parameters
+PENDING_BATCH_SIZE = 500
+
+
+def tiles_table(table):
+    return "{}_tiles".format(table)
+
+
+def pending_table(table):
+    return "{}_tiles_pending".format(table)
+
+
+def parse_zoom_range(value):
+    "Parse a zoom range such as 0-14, or a single zoom level, into (min, max)"
+    try:
+        if "-" in value:
+            min_zoom, max_zoom = (int(part) for part in value.split("-", 1))
+        else:
+            min_zoom = max_zoom = int(value)
+    except ValueError:
+        raise ValueError("Zoom range must look like 0-14, not {}".format(value))
+    if not 0 <= min_zoom <= max_zoom <= MAX_ZOOM:
+        raise ValueError(
+            "Zoom range must be between 0 and {}, lowest first".format(MAX_ZOOM)
+        )
+    return min_zoom, max_zoom
+
+
+def tile_xy(lon, lat, zoom):
+    "Arrays of the x and y of the tiles containing arrays of points at zoom"
+    n = 1 << zoom
+    lon = numpy.asarray(lon, dtype=float)
+    lat = numpy.radians(
+        numpy.clip(numpy.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    )
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - numpy.arcsinh(numpy.tan(lat)) / math.pi) / 2.0 * n
+    return (
+        numpy.clip(numpy.floor(x), 0, n - 1).astype(numpy.int64),
+        numpy.clip(numpy.floor(y), 0, n - 1).astype(numpy.int64),
+    )
+
+
+def tile_bounds(zoom, x, y):
+    "The west, south, east and north edges of tiles, in degrees"
+    n = 1 << zoom
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * y / n))))
+    south = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def quadkey(zoom, x, y):
+    "The Bing Maps quadkey of a tile"
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+
+def quadkey_tile(key):
+    "The (zoom, x, y) of a quadkey"
+    x = y = 0
+    for digit in key:
+        x = (x << 1) | (int(digit) & 1)
+        y = (y << 1) | (int(digit) >> 1)
+    return len(key), x, y
+
+
+def covered_tiles(keys, geometries, min_zoom, max_zoom):
+    """
+    Yield (z, x, y, key) for every tile between min_zoom and max_zoom
+    that each of an array of Shapely geometries, in EPSG:4326, touches,
+    where key is the item of keys, such as rowids, for the geometry.
+    Tiles within a geometry's bounding box that it does not actually
+    touch are left out.
+    """
+    geometries = numpy.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries)
+    present = ~numpy.isnan(bounds[:, 0])
+    keys = numpy.asarray(keys)[present]
+    geometries = geometries[present]
+    bounds = bounds[present]
+    shapely.prepare(geometries)
+    for zoom in range(min_zoom, max_zoom + 1):
+        x0, y0 = tile_xy(bounds[:, 0], bounds[:, 3], zoom)
+        x1, y1 = tile_xy(bounds[:, 2], bounds[:, 1], zoom)
+        single = (x0 == x1) & (y0 == y1)
+        yield from zip(
+            itertools.repeat(zoom),
+            x0[single].tolist(),
+            y0[single].tolist(),
+            keys[single].tolist(),
+        )
+        for i in numpy.flatnonzero(~single):
+            xs, ys = numpy.meshgrid(
+                numpy.arange(x0[i], x1[i] + 1), numpy.arange(y0[i], y1[i] + 1)
+            )
+            xs, ys = xs.ravel(), ys.ravel()
+            boxes = shapely.box(*tile_bounds(zoom, xs, ys))
+            touched = shapely.intersects(geometries[i], boxes)
+            key = keys[i].item()
+            for x, y in zip(xs[touched].tolist(), ys[touched].tolist()):
+                yield zoom, x, y, key
+
+
+class TileIndex:
+    """
+    Maintains TABLE_tiles, a (z, x, y, rowid) table listing the tiles
+    covered by each row of table between min_zoom and max_zoom.
+
+    update() builds it for every row the first time, or if the zoom range
+    has changed. After that triggers record the rows that are inserted,
+    deleted or have their geometry changed, and update() only recomputes
+    the tiles for those.
+
+    srid is the SRID of the stored geometries, which are reprojected to
+    EPSG:4326 to find their tiles.
+    """
+
+    def __init__(self, db, table, min_zoom, max_zoom, srid=4326):
+        self.db = db
+        self.table = table
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.srid = srid
+        self.tiles_table = tiles_table(table)
+        self.pending_table = pending_table(table)
+
+    def update(self, spatialite=False, batch_size=BATCH_SIZE):
+        "Bring the index up to date, returning the number of rows indexed"
+        if not self.db[self.table].exists():
+            return 0
+        if self._indexed_range() != (self.min_zoom, self.max_zoom):
+            with transaction(self.db):
+                self._create()
+                return self._index_rows(None, spatialite, batch_size)
+        count = 0
+        with transaction(self.db):
+            while True:
+                rowids = [
+                    row[0]
+                    for row in self.db.execute(
+                        "select rowid from [{}] limit ?".format(self.pending_table),
+                        [PENDING_BATCH_SIZE],
+                    )
+                ]
+                if not rowids:
+                    break
+                params = ", ".join("?" for _ in rowids)
+                self.db.execute(
+                    "delete from [{}] where rowid in ({})".format(
+                        self.tiles_table, params
+                    ),
+                    rowids,
+                )
+                count += self._index_rows(rowids, spatialite, batch_size)
+                self.db.execute(
+                    "delete from [{}] where rowid in ({})".format(
+                        self.pending_table, params
+                    ),
+                    rowids,
+                )
+        return count
+
+    def _indexed_range(self):
+        if not self.db[TILE_INDEXES_TABLE].exists():
+            return None
+        if not self.db[self.tiles_table].exists():
+            return None
+        rows = self.db.execute(
+            "select min_zoom, max_zoom from [{}] where table_name = ?".format(
+                TILE_INDEXES_TABLE
+            ),
+            [self.table],
+        ).fetchall()
+        return tuple(rows[0]) if rows else None
+
+    def _create(self):
+        for name in (self.tiles_table, self.pending_table):
+            self.db.execute("drop table if exists [{}]".format(name))
+        self.db.execute(
+            "create table [{}] (z integer, x integer, y integer, rowid integer, "
+            "primary key (z, x, y, rowid)) without rowid".format(self.tiles_table)
+        )
+        self.db.execute(
+            "create index [idx_{0}_rowid] on [{0}] (rowid)".format(self.tiles_table)
+        )
+        self.db.execute(
+            "create table [{}] (rowid integer primary key)".format(self.pending_table)
+        )
+        column = self._geometry_column()
+        statements = (
+            """
+            CREATE TRIGGER IF NOT EXISTS [{pending}_insert] AFTER INSERT ON [{table}]
+            BEGIN
+                INSERT OR IGNORE INTO [{pending}] VALUES (new.rowid);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS [{pending}_update]
+            AFTER UPDATE OF [{column}] ON [{table}]
+            WHEN old.[{column}] IS NOT new.[{column}] BEGIN
+                INSERT OR IGNORE INTO [{pending}] VALUES (new.rowid);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS [{pending}_delete] AFTER DELETE ON [{table}]
+            BEGIN
+                INSERT OR IGNORE INTO [{pending}] VALUES (old.rowid);
+            END
+            """,
+        )
+        # Not executescript(), which would commit a bulk_load() transaction
+        for statement in statements:
+            self.db.execute(
+                statement.format(
+                    table=self.table, pending=self.pending_table, column=column
+                )
+            )
+        self.db[TILE_INDEXES_TABLE].upsert(
+            {
+                "table_name": self.table,
+                "min_zoom": self.min_zoom,
+                "max_zoom": self.max_zoom,
+            },
+            pk="table_name",
+        )
+
+    def _geometry_column(self):
+        if GEOMETRY_ID in self.db[self.table].columns_dict:
+            return GEOMETRY_ID
+        return "geometry"
+
+    def _index_rows(self, rowids, spatialite, batch_size):
+        count = 0
+        for rows in self._rows(rowids, spatialite, batch_size):
+            # Rows sharing a geometry, such as with --dedupe-geometries,
+            # share the work of finding its tiles
+            groups = {}
+            for rowid, value in rows:
+                if value is not None:
+                    groups.setdefault(value, []).append(rowid)
+            geometries = _parse_geometries(list(groups))
+            if self.srid != 4326:
+                geometries = geometry.reproject(
+                    geometries, "EPSG:{}".format(self.srid), geometry.DEFAULT_CRS
+                )
+            group_rowids = list(groups.values())
+            tiles = sorted(
+                (z, x, y, rowid)
+                for z, x, y, group in covered_tiles(
+                    range(len(groups)), geometries, self.min_zoom, self.max_zoom
+                )
+                for rowid in group_rowids[group]
+            )
+            self.db.conn.executemany(
+                "insert or ignore into [{}] (z, x, y, rowid) values (?, ?, ?, ?)".format(
+                    self.tiles_table
+                ),
+                tiles,
+            )
+            count += len(rows)
+        return count
+
+    def _rows(self, rowids, spatialite, batch_size):
+        # Batches of (rowid, geometry) for rowids, or for every row if None
+        if self._geometry_column() == GEOMETRY_ID:
+            source = "[{0}] left join [{1}] on [{1}].id = [{0}].[{2}]".format(
+                self.table, geometries_table(self.table), GEOMETRY_ID
+            )
+        else:
+            source = "[{}]".format(self.table)
+        sql = "select [{}].rowid, {} from {}".format(
+            self.table, "AsBinary(geometry)" if spatialite else "geometry", source
+        )
+        if rowids is not None:
+            yield self.db.execute(
+                "{} where [{}].rowid in ({})".format(
+                    sql, self.table, ", ".join("?" for _ in rowids)
+                ),
+                rowids,
+            ).fetchall()
+            return
+        rows = self.db.execute(
+            "{} order by [{}].rowid limit ?".format(sql, self.table), [batch_size]
+        ).fetchall()
+        while rows:
+            yield rows
+            rows = self.db.execute(
+                "{0} where [{1}].rowid > ? order by [{1}].rowid limit ?".format(
+                    sql, self.table
+                ),
+                [rows[-1][0], batch_size],
+            ).fetchall()
+
+
+def _parse_geometries(values):
+    # Stored as GeoJSON, WKB (including from SpatiaLite's AsBinary()) or
+    # TWKB. Geometries that cannot be read, even after closing unclosed
+    # rings, are left as None and have no tiles
+    geometries = numpy.full(len(values), None, dtype=object)
+    text = [i for i, value in enumerate(values) if isinstance(value, str)]
+    if text:
+        geometries[text] = shapely.from_geojson(
+            [values[i] for i in text], on_invalid="ignore"
+        )
+        for i in text:
+            if geometries[i] is None:
+                geometries[i] = _fix_geojson(values[i])
+    binary = [i for i, value in enumerate(values) if isinstance(value, bytes)]
+    well_known = [i for i in binary if not twkb.is_twkb(values[i])]
+    if well_known:
+        geometries[well_known] = shapely.from_wkb(
+            [values[i] for i in well_known], on_invalid="fix"
+        )
+    for i in binary:
+        if twkb.is_twkb(values[i]):
+            geometries[i] = shape(twkb.decode(values[i]))
+    return geometries
+
+
+def _fix_geojson(value):
+    # The GeoJSON reader cannot fix geometries, unlike the WKB one
+    try:
+        encoded = wkb.encode(json.loads(value))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    return shapely.from_wkb(encoded, on_invalid="fix")
+
+
+def tile_rowids(db, table, zoom, x, y):
+    "The rowids of the rows of table that touch a tile, from its TileIndex"
+    return [
+        row[0]
+        for row in db.execute(
+            "select rowid from [{}] where z = ? and x = ? and y = ?".format(
+                tiles_table(table)
+            ),
+            [zoom, x, y],
+        )
+    ]
@@ -0,0 +1,196 @@
+"""
+Tiny Well-Known Binary: a compact geometry encoding that stores
+coordinates as varint-encoded deltas between integers at a fixed
+decimal precision. See https://github.com/TWKB/Specification
+"""
+
+from .wkb import GEOMETRY_TYPES, _dimensions
+
+TYPE_NAMES = {code: name for name, code in GEOMETRY_TYPES.items()}
+
+# Decimal places used when none are specified, about 1cm for degrees
+PRECISION = 7
+
+_EXTENDED_DIMENSIONS = 0x08
+_EMPTY = 0x10
+
+
+def encode(geometry, precision=PRECISION):
+    """
+    Encode a GeoJSON geometry dictionary as TWKB bytes, rounding
+    coordinates to precision decimal places (1 to 7).
+    """
+    # Precision 0 is not used so that a TWKB Point can never start with
+    # the 0x00 or 0x01 byte that begins WKB, see is_twkb()
+    precision = min(max(precision, 1), 7)
+    out = bytearray()
+    _encode(geometry, precision, _dimensions(geometry), out)
+    return bytes(out)
+
+
+def is_twkb(data):
+    "True for TWKB written by encode(), False for WKB"
+    return data[0] not in (0, 1)
+
+
+def _encode(geometry, precision, dims, out):
+    geometry_type = geometry.get("type")
+    if geometry_type not in GEOMETRY_TYPES:
+        raise ValueError("Unsupported geometry type: {}".format(geometry_type))
+    out.append(GEOMETRY_TYPES[geometry_type] | (_zigzag(precision) << 4))
+    if geometry_type == "GeometryCollection":
+        children = geometry.get("geometries") or []
+        out.append(_header(dims, not children))
+        if dims == 3:
+            out.append(0x01 | (precision << 2))
+        if children:
+            _varint(len(children), out)
+            for child in children:
+                _encode(child, precision, dims, out)
+        return
+    coords = geometry.get("coordinates") or []
+    out.append(_header(dims, not coords))
+    if dims == 3:
+        out.append(0x01 | (precision << 2))
+    if not coords:
+        return
+    scale = 10**precision
+    previous = [0] * dims
+    if geometry_type == "Point":
+        _positions([coords], scale, dims, previous, out, counted=False)
+    elif geometry_type == "LineString":
+        _positions(coords, scale, dims, previous, out)
+    elif geometry_type == "Polygon":
+        _rings(coords, scale, dims, previous, out)
+    else:
+        _varint(len(coords), out)
+        for part in coords:
+            if geometry_type == "MultiPoint":
+                _positions([part], scale, dims, previous, out, counted=False)
+            elif geometry_type == "MultiLineString":
+                _positions(part, scale, dims, previous, out)
+            else:
+                _rings(part, scale, dims, previous, out)
+
+
+def _header(dims, empty):
+    return (_EXTENDED_DIMENSIONS if dims == 3 else 0) | (_EMPTY if empty else 0)
+
+
+def _rings(rings, scale, dims, previous, out):
+    _varint(len(rings), out)
+    for ring in rings:
+        _positions(ring, scale, dims, previous, out)
+
+
+def _positions(positions, scale, dims, previous, out, counted=True):
+    if counted:
+        _varint(len(positions), out)
+    for position in positions:
+        for i in range(dims):
+            value = round((position[i] if i < len(position) else 0) * scale)
+            _varint(_zigzag(value - previous[i]), out)
+            previous[i] = value
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode(data):
+    "Decode TWKB bytes to a GeoJSON geometry dictionary"
+    geometry, _ = _decode(memoryview(data), 0)
+    return geometry
+
+
+def _decode(data, pos):
+    type_and_precision, header = data[pos], data[pos + 1]
+    pos += 2
+    geometry_type = TYPE_NAMES[type_and_precision & 0x0F]
+    precision = _unzigzag(type_and_precision >> 4)
+    dims = 2
+    z_precision = 0
+    if header & _EXTENDED_DIMENSIONS:
+        extended = data[pos]
+        pos += 1
+        if extended & 0x01:
+            dims = 3
+            z_precision = (extended >> 2) & 0x07
+    if header & 0x02:
+        # Skip the size, the bounding box and id lists are not written
+        _, pos = _read_varint(data, pos)
+    if header & _EMPTY:
+        if geometry_type == "GeometryCollection":
+            return {"type": geometry_type, "geometries": []}, pos
+        return {"type": geometry_type, "coordinates": []}, pos
+    if geometry_type == "GeometryCollection":
+        count, pos = _read_varint(data, pos)
+        geometries = []
+        for _ in range(count):
+            child, pos = _decode(data, pos)
+            geometries.append(child)
+        return {"type": geometry_type, "geometries": geometries}, pos
+    reader = _PositionReader(data, pos, dims, precision, z_precision)
+    if geometry_type == "Point":
+        coordinates = reader.positions(1)[0]
+    elif geometry_type == "LineString":
+        coordinates = reader.positions(reader.varint())
+    elif geometry_type == "Polygon":
+        coordinates = reader.rings()
+    else:
+        count = reader.varint()
+        if geometry_type == "MultiPoint":
+            coordinates = [reader.positions(1)[0] for _ in range(count)]
+        elif geometry_type == "MultiLineString":
+            coordinates = [reader.positions(reader.varint()) for _ in range(count)]
+        else:
+            coordinates = [reader.rings() for _ in range(count)]
+    return {"type": geometry_type, "coordinates": coordinates}, reader.pos
+
+
+class _PositionReader:
+    def __init__(self, data, pos, dims, precision, z_precision):
+        self.data = data
+        self.pos = pos
+        self.dims = dims
+        self.scales = [10**precision, 10**precision, 10**z_precision][:dims]
+        self.previous = [0] * dims
+
+    def varint(self):
+        value, self.pos = _read_varint(self.data, self.pos)
+        return value
+
+    def positions(self, count):
+        positions = []
+        for _ in range(count):
+            position = []
+            for i in range(self.dims):
+                self.previous[i] += _unzigzag(self.varint())
+                position.append(self.previous[i] / self.scales[i])
+            positions.append(position)
+        return positions
+
+    def rings(self):
+        return [self.positions(self.varint()) for _ in range(self.varint())]
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
@@ -1,18 +1,86 @@
 from shapely.geometry import shape
+import shapely
 import sqlite_utils
-from sqlite_utils.utils import find_spatialite
+from sqlite_utils.utils import find_spatialite, sqlite3
+from . import geometry, twkb, wkb
+from .changes import HASH_COLUMN, content_hash, transaction
+from .decoders import get_decoder
+from .stats import NullStats
+from .streams import decompress, detect_compression
 
+import codecs
+import contextlib
 import inspect
 import itertools
 import json
 import os
+import random
+import re
 
 
 class SpatiaLiteError(Exception):
     pass
 
 
-def yield_records(features, pk, properties, spatialite):
+class SchemaCache:
+    """
+    The columns of the tables in db, looked up once and then remembered,
+    so that a session making many imports over one connection does not
+    query them again for every file.
+
+    Tables that do not exist are not remembered. Changes made through
+    other connections are not seen, call clear() if they may happen.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._columns = {}
+
+    def columns(self, table):
+        "The set of column names of table, or None if it does not exist"
+        if table not in self._columns:
+            if not self.db[table].exists():
+                return None
+            self._columns[table] = set(self.db[table].columns_dict)
+        return self._columns[table]
+
+    def exists(self, table):
+        return self.columns(table) is not None
+
+    def forget(self, table):
+        "Look the columns of table up again next time, after changing it"
+        self._columns.pop(table, None)
+
+    def clear(self):
+        self._columns.clear()
+
+
+GEOMETRY_FORMATS = ("wkt", "wkb")
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+
+
+def yield_records(
+    features,
+    pk,
+    properties,
+    spatialite,
+    geometry_format="wkt",
+    hash_column=None,
+    geometry_options=None,
+):
+    if geometry_options is not None:
+        # Geometries are converted in batches after rounding and simplifying
+        records = _yield_records(features, properties, False, None, hash_column)
+        return geometry.process_records(
+            records, geometry_options, spatialite, geometry_format
+        )
+    return _yield_records(
+        features, properties, spatialite, geometry_format, hash_column
+    )
+
+
+def _yield_records(features, properties, spatialite, geometry_format, hash_column):
     for feature in features:
         record = {}
         if "id" in feature:
@@ -22,8 +90,14 @@ def yield_records(features, pk, properties, spatialite):
         else:
             record.update(feature.get("properties") or {})
         geometry = feature.get("geometry")
+        if hash_column:
+            record["geometry"] = geometry
+            record[hash_column] = content_hash(record)
         if spatialite and geometry:
-            geometry = shape(geometry).wkt
+            if geometry_format == "wkb":
+                geometry = wkb.encode(geometry)
+            else:
+                geometry = shape(geometry).wkt
 
         record["geometry"] = geometry
         yield record
@@ -39,14 +113,270 @@ def import_features(
     spatialite=False,
     spatialite_mod=None,
     spatial_index=False,
+    geometry_format="wkt",
+    batch_size=100,
+    spatial_index_threshold=10000,
+    log=None,
+    stats=None,
+    sample_size=100,
+    sample=None,
+    changes=None,
+    geometry_options=None,
+    rtree=False,
+    cluster=None,
+    checkpoint=None,
+    schema=None,
+    deduplicator=None,
+):
+    """
+    Import GeoJSON features into a table, creating it if necessary.
+
+    The first sample_size features are used to detect column types and
+    whether to use "id" as the primary key. Pass sample, a list of
+    features (such as one from sample_nl_features()), to use that for
+    detection instead.
+
+    changes is an optional changes.ChangeDetector, used to only write the
+    features that are new or differ from the existing rows.
+
+    geometry_options is an optional geometry.GeometryOptions, for rounding
+    and simplifying geometries and adding simplified zoom level columns.
+    If it adds bounding box columns, rtree=True also indexes them with an
+    R*Tree.
+
+    cluster is an optional curve name from clustering.CURVES: features
+    are then inserted in the order of that space-filling curve.
+
+    checkpoint is an optional checkpoints.Checkpoint, which records the
+    position reached in the input each time a batch is committed. The
+    features should come from its read_features().
+
+    schema is an optional SchemaCache for db_path, see import_records().
+
+    deduplicator is an optional dedupe.GeometryDeduplicator, for the same
+    table. Each distinct geometry is then stored once in its table, and
+    the rows reference it by id.
+    """
+    if spatialite_mod or spatial_index:
+        spatialite = True
+    if stats is None:
+        stats = NullStats()
+    hash_column = HASH_COLUMN if changes is not None else None
+    if deduplicator is not None:
+        if sample is not None or cluster:
+            raise ValueError("deduplicator cannot be used with sample or cluster")
+        if geometry_options is not None and geometry_options.validate == "quarantine":
+            raise ValueError("deduplicator cannot be used to quarantine geometries")
+        features = stats.iterate("parse", features)
+        records = deduplicator.records(
+            features,
+            properties,
+            spatialite,
+            geometry_format,
+            hash_column,
+            geometry_options,
+            geometry.target_srid(geometry_options),
+            stats,
+        )
+        result = import_records(
+            db_path,
+            table,
+            records,
+            pk=pk,
+            alter=alter,
+            batch_size=batch_size,
+            log=log,
+            stats=stats,
+            sample_size=sample_size,
+            changes=changes,
+            geometry_columns=(),
+            checkpoint=checkpoint,
+            schema=schema,
+            foreign_keys=deduplicator.foreign_keys,
+        )
+        with stats.stage("index"):
+            deduplicator.finish(geometry_options, spatial_index, rtree)
+        _log(log, deduplicator.summary())
+        return result
+    if sample is not None:
+        sample = list(
+            yield_records(
+                sample, pk, properties, False, "wkt", hash_column, geometry_options
+            )
+        )
+    features = stats.iterate("parse", features)
+    records = stats.iterate(
+        "convert",
+        yield_records(
+            features,
+            pk,
+            properties,
+            spatialite,
+            geometry_format,
+            hash_column,
+            geometry_options,
+        ),
+    )
+    return import_records(
+        db_path,
+        table,
+        records,
+        pk=pk,
+        alter=alter,
+        spatialite=spatialite,
+        spatialite_mod=spatialite_mod,
+        spatial_index=spatial_index,
+        geometry_format=geometry_format,
+        batch_size=batch_size,
+        spatial_index_threshold=spatial_index_threshold,
+        log=log,
+        stats=stats,
+        sample_size=sample_size,
+        sample=sample,
+        changes=changes,
+        geometry_columns=geometry.geometry_columns(geometry_options),
+        bbox=geometry_options is not None and geometry_options.bbox,
+        quarantine=(
+            geometry_options is not None and geometry_options.validate == "quarantine"
+        ),
+        srid=geometry.target_srid(geometry_options),
+        rtree=rtree,
+        cluster=cluster,
+        checkpoint=checkpoint,
+        schema=schema,
+    )
+
+
+def import_records(
+    db_path,
+    table,
+    records,
+    pk=None,
+    alter=False,
+    spatialite=False,
+    spatialite_mod=None,
+    spatial_index=False,
+    geometry_format="wkt",
+    batch_size=100,
+    spatial_index_threshold=10000,
+    log=None,
+    stats=None,
+    sample_size=100,
+    sample=None,
+    changes=None,
+    geometry_columns=("geometry",),
+    bbox=False,
+    rtree=False,
+    cluster=None,
+    checkpoint=None,
+    quarantine=False,
+    srid=4326,
+    schema=None,
+    foreign_keys=None,
 ):
-    db = sqlite_utils.Database(db_path)
-    features = iter(features)
+    """
+    Insert records that have already been produced by yield_records()
+    using the same spatialite and geometry_format settings.
+
+    db_path can also be an existing sqlite_utils.Database, for example
+    one that is inside a bulk_load() block.
+
+    If the table already has a spatial index, loads of at least
+    spatial_index_threshold records drop it and rebuild it in one pass
+    after inserting; smaller loads leave its triggers to update it row
+    by row. log is an optional callable that is passed a message
+    describing the choice that was made.
+
+    stats is an optional ImportStats, which will be used to record the
+    time spent inserting and building the spatial index.
+
+    If the table does not exist it is created using column types detected
+    from the first sample_size records, which are then inserted without
+    being processed again, or from sample if that list of records is
+    provided.
+
+    If changes, a changes.ChangeDetector, is provided the records must
+    include content hashes and only new or changed records are written.
 
-    # grab a sample, for checking ids
-    sample_geojson = list(itertools.islice(features, 100))
-    features = itertools.chain(sample_geojson, features)
-    sample_records = list(yield_records(sample_geojson, pk, properties, spatialite))
+    geometry_columns lists the columns holding geometries, which are
+    created as SpatiaLite geometry columns when spatialite is used.
+
+    bbox=True indexes the bounding box columns added by the geometry
+    module, and rtree=True adds an R*Tree of them too.
+
+    cluster is an optional curve name from clustering.CURVES. Records are
+    sorted along that curve before inserting, spilling to temporary files
+    if there are too many to sort in memory. Their positions are found in
+    EPSG:4326, reprojecting from srid if needed. It cannot be used if
+    there is a primary key, given as pk or detected from the sample, as
+    upserts must then be applied in input order.
+
+    checkpoint is an optional checkpoints.Checkpoint. Each batch of
+    batch_size records is then written in its own transaction, together
+    with the number of records written so far. Records must be in input
+    order, so it cannot be combined with changes or cluster.
+
+    quarantine=True writes records that the geometry module marked as
+    invalid to a separate table, see geometry.divert_invalid().
+
+    srid is the SRID recorded for SpatiaLite geometries, which should
+    match the CRS of the records' coordinates.
+
+    schema is an optional SchemaCache of db, to be shared between imports
+    made over the same connection. By default the tables and columns are
+    looked up for this import only.
+
+    foreign_keys are passed to Table.create() if the table is created.
+    """
+    if geometry_format not in GEOMETRY_FORMATS:
+        raise ValueError(
+            "geometry_format must be one of: {}".format(", ".join(GEOMETRY_FORMATS))
+        )
+    if checkpoint is not None and (changes is not None or cluster or quarantine):
+        raise ValueError(
+            "checkpoint cannot be used with changes, cluster or quarantine"
+        )
+    if isinstance(db_path, sqlite_utils.Database):
+        db = db_path
+    else:
+        db = sqlite_utils.Database(db_path)
+    if stats is None:
+        stats = NullStats()
+    if schema is None:
+        schema = SchemaCache(db)
+    records = iter(records)
+    quarantined = {}
+    if quarantine:
+        records = geometry.divert_invalid(db, table, records, quarantined)
+        if sample is not None:
+            sample = [r for r in sample if geometry.INVALID_REASON not in r]
+    if changes is not None:
+        records = changes.filter(records)
+    if cluster:
+        if sample is None:
+            # Detect the primary key as the unsorted import would
+            sample = list(itertools.islice(records, sample_size))
+            records = itertools.chain(sample, records)
+        if pk or has_ids(sample):
+            raise ValueError(
+                "Records with a primary key cannot be clustered, "
+                "as upserts must be applied in input order"
+            )
+        from . import clustering
+
+        records = stats.iterate(
+            "sort",
+            clustering.cluster_records(
+                records, spatialite, geometry_format, cluster, srid=srid
+            ),
+        )
+
+    if sample is not None:
+        sample_records = sample
+    else:
+        # grab a sample, for checking ids and column types
+        sample_records = list(itertools.islice(records, sample_size))
+        records = itertools.chain(sample_records, records)
 
     if pk is None and has_ids(sample_records):
         pk = "id"
@@ -56,75 +386,549 @@ def import_features(
         spatialite = True
 
     if spatialite:
-        lib = spatialite_mod or find_spatialite()
+        init_spatialite(db, spatialite_mod)
 
-        if not lib:
-            raise SpatiaLiteError("Could not find SpatiaLite module")
-
-        db.init_spatialite(lib)
-
-        if table not in db.table_names():
-            # Create the table, using detected column types
-            column_types = sqlite_utils.suggest_column_types(sample_records)
-            column_types.pop("geometry")
+    if sample_records and not schema.exists(table):
+        # Create the table, using detected column types
+        column_types = sqlite_utils.suggest_column_types(sample_records)
+        if spatialite:
+            for column in geometry_columns:
+                column_types.pop(column, None)
             remove_tmp_column = False
             if not column_types:
                 column_types["_tmp"] = str
                 remove_tmp_column = True
-            db[table].create(column_types, pk=pk)
-            ensure_table_has_geometry(db, table)
+            db[table].create(column_types, pk=pk, foreign_keys=foreign_keys)
+            for column in geometry_columns:
+                ensure_table_has_geometry(db, table, column, srid)
             if remove_tmp_column:
                 db[table].transform(drop={"_tmp"})
+        else:
+            db[table].create(column_types, pk=pk, foreign_keys=foreign_keys)
+        if changes is not None:
+            changes.ensure_column()
+        schema.forget(table)
 
-        conversions = {"geometry": "GeomFromText(?, 4326)"}
+    if spatialite:
+        if geometry_format == "wkb":
+            conversion = "GeomFromWKB(?, {})".format(int(srid))
+        else:
+            conversion = "GeomFromText(?, {})".format(int(srid))
+        conversions = {column: conversion for column in geometry_columns}
 
-    if pk:
-        db[table].upsert_all(
-            yield_records(features, pk, properties, spatialite),
-            conversions=conversions,
-            pk=pk,
-            alter=alter,
-        )
+    columns = schema.columns(table)
+    if columns is not None:
+        # Zoom level and bounding box columns may be new to an existing table
+        added = False
+        for column in geometry_columns[1:]:
+            if column in columns:
+                continue
+            if spatialite:
+                ensure_table_has_geometry(db, table, column, srid)
+            else:
+                # Stored the same way as the table's geometry column
+                column_type = db[table].columns_dict.get(geometry_columns[0], str)
+                db[table].add_column(column, column_type)
+            added = True
+        if bbox:
+            for column in geometry.BBOX_COLUMNS:
+                if column not in columns:
+                    db[table].add_column(column, float)
+                    added = True
+        if added:
+            schema.forget(table)
 
-    else:
-        db[table].insert_all(
-            yield_records(features, pk, properties, spatialite), conversions=conversions
-        )
+    rebuild_spatial_index = False
+    if spatial_index and schema.exists(spatial_index_table(table)):
+        # Look ahead to decide between incremental updates and a rebuild
+        head = list(itertools.islice(records, spatial_index_threshold))
+        records = itertools.chain(head, records)
+        if len(head) >= spatial_index_threshold:
+            rebuild_spatial_index = True
+            with stats.stage("index"):
+                disable_spatial_index(db, table)
+            _log(
+                log,
+                "Spatial index: dropped for a load of {} or more rows, "
+                "will rebuild after inserting".format(spatial_index_threshold),
+            )
+        else:
+            _log(
+                log,
+                "Spatial index: updating incrementally for {} rows".format(len(head)),
+            )
+    elif spatial_index:
+        _log(log, "Spatial index: will build after inserting")
+
+    records = stats.count("insert", records)
+    try:
+        with stats.stage("insert"):
+            if checkpoint is not None:
+                _insert_checkpointed(
+                    db, table, records, checkpoint, pk, conversions, alter, batch_size
+                )
+            elif pk:
+                db[table].upsert_all(
+                    records,
+                    conversions=conversions,
+                    pk=pk,
+                    alter=alter,
+                    batch_size=batch_size,
+                )
+
+            else:
+                db[table].insert_all(
+                    records,
+                    conversions=conversions,
+                    alter=alter,
+                    batch_size=batch_size,
+                )
+    finally:
+        if rebuild_spatial_index:
+            # Rebuild even if the insert failed, so the index is not left missing
+            with stats.stage("index"):
+                db[table].create_spatial_index("geometry")
+        if alter:
+            # New properties may have added columns
+            schema.forget(table)
 
     if spatial_index:
         # db.conn.execute("select CreateSpatialIndex(?, ?)", [table, "geometry"])
-        db[table].create_spatial_index("geometry")
+        with stats.stage("index"):
+            db[table].create_spatial_index("geometry")
+
+    if bbox and db[table].exists():
+        with stats.stage("index"):
+            geometry.create_bbox_index(db, table, rtree)
 
+    if quarantined:
+        stats.add("quarantine", rows=quarantined["quarantined"])
+        _log(
+            log,
+            "Wrote {} features with invalid geometries to {}".format(
+                quarantined["quarantined"], geometry.quarantine_table(table)
+            ),
+        )
+
+    stats.finish()
     return db[table]
 
 
-def get_features(geojson_file, nl=False):
+def _insert_checkpointed(
+    db, table, records, checkpoint, pk, conversions, alter, batch_size
+):
+    # Commit each batch together with the checkpoint that records it
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        with transaction(db):
+            if pk:
+                db[table].upsert_all(batch, conversions=conversions, pk=pk, alter=alter)
+            else:
+                db[table].insert_all(batch, conversions=conversions, alter=alter)
+            checkpoint.commit(len(batch))
+
+
+def geometry_to_geojson(value):
+    """
+    Return a stored geometry as a GeoJSON dictionary, whether it was
+    stored as GeoJSON or with --geometry-encoding wkb or twkb.
+    """
+    if value is None or isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        return json.loads(value)
+    if twkb.is_twkb(value):
+        return twkb.decode(value)
+    return json.loads(shapely.to_geojson(shapely.from_wkb(bytes(value))))
+
+
+def register_functions(db):
+    """
+    Register a geometry_to_geojson(geometry) SQL function with db, which
+    returns stored geometries as GeoJSON text.
+    """
+
+    def sql_geometry_to_geojson(value):
+        geometry = geometry_to_geojson(value)
+        return None if geometry is None else json.dumps(geometry)
+
+    db.conn.create_function(
+        "geometry_to_geojson", 1, sql_geometry_to_geojson, deterministic=True
+    )
+
+
+def reservoir_sample(iterable, size, seed=None):
+    "Return a uniform random sample of up to size items from iterable"
+    rnd = random.Random(seed)
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < size:
+            sample.append(item)
+        else:
+            j = rnd.randint(0, i)
+            if j < size:
+                sample[j] = item
+    return sample
+
+
+def sample_nl_features(files, size, decoder="auto", seed=None):
+    """
+    Sample up to size features uniformly from newline-delimited GeoJSON
+    files, then seek each file back to where it started.
+
+    Lines are only decoded once they have been picked, so this costs one
+    extra read of each file. The files must be seekable.
     """
-    Get a list of features from something resembling geojson.
+    positions = []
+    for fp in files:
+        if not fp.seekable():
+            raise ValueError("Sampling requires a file that can be seeked")
+        if detect_compression(fp):
+            raise ValueError("Sampling cannot be used with compressed files")
+        positions.append(fp.tell())
+    lines = itertools.chain.from_iterable(
+        (line for line in fp if line.strip()) for fp in files
+    )
+    sample = reservoir_sample(lines, size, seed)
+    for fp, position in zip(files, positions):
+        fp.seek(position)
+    loads = get_decoder(decoder).loads
+    return [loads(line) for line in sample]
+
+
+def _log(log, message):
+    if log is not None:
+        log(message)
+
+
+def spatial_index_table(table, column="geometry"):
+    return "idx_{}_{}".format(table, column)
+
+
+def disable_spatial_index(db, table, column="geometry"):
+    """
+    Remove the triggers that maintain a SpatiaLite spatial index and drop
+    its R*Tree, so that create_spatial_index() can rebuild it in one pass.
+    """
+    db.execute("select DisableSpatialIndex(?, ?)", [table, column])
+    db[spatial_index_table(table, column)].drop()
+
+
+def init_spatialite(db, spatialite_mod=None):
+    """
+    Load SpatiaLite into the connection and create its metadata tables,
+    unless it has already been loaded into this connection.
+    """
+    if spatialite_loaded(db):
+        return
+    lib = spatialite_mod or find_spatialite()
+
+    if not lib:
+        raise SpatiaLiteError("Could not find SpatiaLite module")
+
+    db.init_spatialite(lib)
+
+
+def spatialite_loaded(db):
+    try:
+        db.execute("select spatialite_version()")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def bulk_load(
+    db, journal_mode="memory", synchronous="off", cache_size=-256000, exclusive=False
+):
+    """
+    Context manager for loading large amounts of data into db.
+
+    Sets fast (but less crash-safe) PRAGMAs, runs the block inside a single
+    transaction and then restores the original settings. cache_size follows
+    SQLite's convention: negative values are a size in KiB, positive values
+    a number of pages.
+    """
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(
+            "journal_mode must be one of: {}".format(", ".join(JOURNAL_MODES))
+        )
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(
+            "synchronous must be one of: {}".format(", ".join(SYNCHRONOUS_MODES))
+        )
+    conn = db.conn
+    original = {
+        name: conn.execute("PRAGMA {}".format(name)).fetchone()[0]
+        for name in ("journal_mode", "synchronous", "cache_size")
+    }
+    # These cannot be changed in the middle of a transaction
+    if exclusive:
+        conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.execute("PRAGMA journal_mode={}".format(journal_mode))
+    conn.execute("PRAGMA synchronous={}".format(synchronous))
+    conn.execute("PRAGMA cache_size={}".format(int(cache_size)))
+    try:
+        # With older sqlite-utils, which commit after each batch, this
+        # transaction only covers work outside of insert_all()
+        with transaction(db):
+            yield db
+    finally:
+        if exclusive:
+            conn.execute("PRAGMA locking_mode=NORMAL")
+        conn.execute("PRAGMA journal_mode={}".format(original["journal_mode"]))
+        conn.execute("PRAGMA synchronous={}".format(original["synchronous"]))
+        conn.execute("PRAGMA cache_size={}".format(original["cache_size"]))
+
+
+def get_features(geojson_file, nl=False, decoder="auto"):
+    """
+    Get an iterable of features from something resembling geojson.
 
     Note that if the `nl` option is True, this will return a generator
     that yields a single feature from each line in the source file.
+
+    FeatureCollections are parsed incrementally: the members of the
+    `features` array are yielded one at a time as they are read, so
+    memory use is bounded by the largest single feature rather than
+    by the size of the file.
+
+    geojson_file can be opened in text or binary mode; binary is faster.
+    decoder is the name of a JSON backend from decoders.DECODERS.
+
+    Binary files compressed with gzip, bzip2, xz or zstd are decompressed
+    in a background thread as they are read. The result is a generator:
+    the decompressed file is closed, stopping the thread, once the
+    features have all been read or reading them fails, or when the
+    generator is closed by a caller that stops early.
     """
+    decoder = get_decoder(decoder)
+    fp = decompress(geojson_file)
+    # Only a file object created here is closed, not the caller's
+    created = fp if fp is not geojson_file else None
+    try:
+        features = _read_features(fp, nl, decoder)
+    except BaseException:
+        if created is not None:
+            created.close()
+        raise
+    return _close_after(features, created)
+
+
+def _close_after(features, fp):
+    try:
+        yield from features
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+def _read_features(geojson_file, nl, decoder):
     if nl:
-        return (json.loads(line) for line in geojson_file if line.strip())
+        loads = decoder.loads
+        return (loads(line) for line in geojson_file if line.strip())
 
-    # if not nl, load the whole file
-    geojson = json.load(geojson_file)
-    if not isinstance(geojson, dict):
+    stream = _JSONStream(geojson_file, decoder)
+    if stream.peek() != "{":
+        # Decode it anyway, so invalid JSON raises a JSONDecodeError
+        stream.value()
         raise TypeError("GeoJSON root must be an object")
 
-    if geojson.get("type") not in ("Feature", "FeatureCollection"):
+    # Read the top-level keys until we reach the "features" array
+    root = {}
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.expect("}")
+        return _root_features(stream, root)
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if (
+            key == "features"
+            and root.get("type", "FeatureCollection") == "FeatureCollection"
+            and stream.peek() == "["
+        ):
+            return _stream_features(stream, root)
+        root[key] = stream.value()
+        if key == "type":
+            _check_type(root)
+        if stream.expect(",}") == "}":
+            return _root_features(stream, root)
+
+
+def _check_type(root):
+    if root.get("type") not in ("Feature", "FeatureCollection"):
+        raise ValueError("GeoJSON must be a Feature or a FeatureCollection")
+
+
+def _root_features(stream, root):
+    stream.expect_end()
+    _check_type(root)
+
+    if root["type"] == "Feature":
+        return [root]
+
+    return root.get("features", [])
+
+
+def _stream_features(stream, root):
+    stream.expect("[")
+    if stream.peek() == "]":
+        stream.expect("]")
+    else:
+        while True:
+            yield stream.array_item()
+            if stream.expect(",]") == "]":
+                break
+
+    # Consume any keys that follow the features array
+    while stream.expect(",}") == ",":
+        key = stream.value()
+        stream.expect(":")
+        root[key] = stream.value()
+    stream.expect_end()
+    if root.get("type") != "FeatureCollection":
         raise ValueError("GeoJSON must be a Feature or a FeatureCollection")
 
-    if geojson["type"] == "Feature":
-        return [geojson]
 
-    return geojson.get("features", [])
+class _JSONStream:
+    """
+    Minimal pull parser over a file object: values are decoded with
+    JSONDecoder.raw_decode() from a buffer that is refilled as needed.
+
+    With a binary decoder such as orjson the buffer holds UTF-8 bytes,
+    and objects inside arrays are decoded by finding a candidate end
+    with a regular expression and checking that the slice up to it
+    decodes as a complete value.
+    """
+
+    whitespace = re.compile(r"[ \t\n\r]*")
+    binary_whitespace = re.compile(rb"[ \t\n\r]*")
+    # The end of an object followed by another object or the end of an array
+    binary_object_end = re.compile(rb"\}[ \t\n\r]*(?:,[ \t\n\r]*\{|\])")
+    max_attempts = 8
+
+    def __init__(self, fp, decoder=None, chunk_size=64 * 1024):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = get_decoder(decoder or "json")
+        self.binary = self.decoder.binary
+        self.raw_decoder = json.JSONDecoder()
+        self.utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = b"" if self.binary else ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        "Read more data, discarding what has already been consumed"
+        if self.eof:
+            return False
+        # Read at least as much as is pending, so that re-decoding a
+        # large value after each refill stays linear in its size
+        chunk = self.fp.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        if self.binary and isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        elif not self.binary and isinstance(chunk, bytes):
+            chunk = self.utf8_decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "Return the next non-whitespace character, or '' at end of input"
+        whitespace = self.binary_whitespace if self.binary else self.whitespace
+        while True:
+            self.pos = whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                char = self.buffer[self.pos]
+                return chr(char) if self.binary else char
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(
+                "Expecting {}".format(" or ".join(repr(c) for c in chars)),
+                self._text(),
+                self.pos,
+            )
+        self.pos += 1
+        return char
+
+    def expect_end(self):
+        if self.peek():
+            raise json.JSONDecodeError("Extra data", self._text(), self.pos)
+
+    def _text(self):
+        if self.binary:
+            return self.buffer.decode("utf-8", "replace")
+        return self.buffer
+
+    def array_item(self):
+        "Decode the next value inside an array"
+        if not self.binary or self.peek() != "{":
+            return self.value()
+        search_from = self.pos
+        attempts = 0
+        while True:
+            view = memoryview(self.buffer)
+            for match in self.binary_object_end.finditer(self.buffer, search_from):
+                end = match.start() + 1
+                try:
+                    value = self.decoder.loads(view[self.pos : end])
+                except ValueError:
+                    # e.g. the end of a nested object, or inside a string
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        # Many nested objects: avoid re-decoding the prefix
+                        return self.value()
+                    search_from = end
+                    continue
+                self.pos = end
+                return value
+            offset = search_from - self.pos
+            if not self.fill():
+                # Let the standard library report what is wrong with it
+                return self.value()
+            search_from = self.pos + offset
+
+    def value(self):
+        self.peek()
+        while True:
+            if self.binary:
+                text = codecs.getincrementaldecoder("utf-8")().decode(
+                    self.buffer[self.pos :]
+                )
+                start = 0
+            else:
+                text, start = self.buffer, self.pos
+            try:
+                value, end = self.raw_decoder.raw_decode(text, start)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A value ending exactly at the end of the buffer may have been
+            # truncated (e.g. a number), so only accept it once more data
+            # has been read or the input is exhausted
+            if end == len(text) and self.fill():
+                continue
+            if self.binary:
+                self.pos += len(text[:end].encode("utf-8"))
+            else:
+                self.pos = end
+            return value
 
 
-def ensure_table_has_geometry(db, table):
-    if "geometry" not in db[table].columns_dict:
-        db[table].add_geometry_column("geometry", "GEOMETRY")
+def ensure_table_has_geometry(db, table, column="geometry", srid=4326):
+    if column not in db[table].columns_dict:
+        db[table].add_geometry_column(column, "GEOMETRY", srid=srid)
 
 
 def has_ids(features):
@@ -0,0 +1,83 @@
+from itertools import chain
+import struct
+
+# ISO WKB geometry type codes; 3D geometries add 1000
+GEOMETRY_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7,
+}
+
+NAN = float("nan")
+
+
+def encode(geometry):
+    """
+    Encode a GeoJSON geometry dictionary as little-endian ISO WKB bytes.
+
+    This packs the coordinate arrays directly with struct, without
+    building an intermediate Shapely object or WKT string.
+    """
+    return b"".join(_encode(geometry, _dimensions(geometry)))
+
+
+def _dimensions(geometry):
+    "2 or 3, based on the first position found in the geometry"
+    if geometry.get("type") == "GeometryCollection":
+        for child in geometry.get("geometries") or []:
+            dims = _dimensions(child)
+            if dims == 3:
+                return 3
+        return 2
+    coords = geometry.get("coordinates")
+    while isinstance(coords, (list, tuple)) and coords:
+        if not isinstance(coords[0], (list, tuple)):
+            return 3 if len(coords) > 2 else 2
+        coords = coords[0]
+    return 2
+
+
+def _encode(geometry, dims):
+    geometry_type = geometry.get("type")
+    if geometry_type not in GEOMETRY_TYPES:
+        raise ValueError("Unsupported geometry type: {}".format(geometry_type))
+    code = GEOMETRY_TYPES[geometry_type] + (1000 if dims == 3 else 0)
+    if geometry_type == "GeometryCollection":
+        children = geometry.get("geometries") or []
+        yield struct.pack("<BII", 1, code, len(children))
+        for child in children:
+            yield from _encode(child, dims)
+        return
+
+    coords = geometry.get("coordinates") or []
+    if geometry_type == "Point":
+        yield struct.pack("<BI", 1, code)
+        yield _pack_positions([coords] if coords else [[NAN] * dims], dims, False)
+    elif geometry_type == "LineString":
+        yield struct.pack("<BI", 1, code)
+        yield _pack_positions(coords, dims)
+    elif geometry_type == "Polygon":
+        yield struct.pack("<BII", 1, code, len(coords))
+        for ring in coords:
+            yield _pack_positions(ring, dims)
+    else:
+        # Multi* geometries are a sequence of complete WKB geometries
+        child_type = geometry_type[len("Multi") :]
+        yield struct.pack("<BII", 1, code, len(coords))
+        for child_coords in coords:
+            yield from _encode({"type": child_type, "coordinates": child_coords}, dims)
+
+
+def _pack_positions(positions, dims, counted=True):
+    fmt = "<I%dd" % (len(positions) * dims) if counted else "<%dd" % dims
+    prefix = (len(positions),) if counted else ()
+    try:
+        return struct.pack(fmt, *prefix, *chain.from_iterable(positions))
+    except struct.error:
+        # Mixed 2D/3D (or 4D) positions: pad or truncate each one
+        fixed = [(list(position) + [0.0] * dims)[:dims] for position in positions]
+        return struct.pack(fmt, *prefix, *chain.from_iterable(fixed))
@@ -25,7 +25,15 @@ setup(
     entry_points="""
         [console_scripts]
         geojson-to-sqlite=geojson_to_sqlite.cli:cli
+        geojson-to-sqlite-serve=geojson_to_sqlite.cli:serve
     """,
-    install_requires=["sqlite-utils>=3.23", "shapely"],
-    extras_require={"test": ["pytest", "dirty-equals"]},
+    install_requires=["sqlite-utils>=3.23", "shapely>=2.1", "numpy"],
+    extras_require={
+        "test": ["pytest", "dirty-equals"],
+        "fast": ["orjson"],
+        "zstd": ["zstandard"],
+        "parquet": ["pyarrow"],
+        "reproject": ["pyproj"],
+    },
+    python_requires=">=3.10",
 )
@@ -1,16 +1,62 @@
 from click.testing import CliRunner
 from dirty_equals import IsApprox
-from geojson_to_sqlite import cli
+from geojson_to_sqlite import (
+    aio,
+    benchmark,
+    checkpoints,
+    cli,
+    clustering,
+    columnar,
+    decoders,
+    dedupe,
+    flatgeobuf,
+    geometry,
+    parallel,
+    session,
+    sharding,
+    streams,
+    tiles,
+    twkb,
+    utils,
+    wkb,
+)
+from geojson_to_sqlite.stats import ImportStats
+from shapely.geometry import shape
+import shapely
+import shapely.wkb
 import pytest
 import sqlite_utils
 from sqlite_utils.utils import find_spatialite
+import asyncio
+import bz2
+import datetime
+import gzip
+import hashlib
+import io
+import lzma
 import pathlib
+import random
 import json
-
+import socket
+import subprocess
+import sys
+import threading
 
 testdir = pathlib.Path(__file__).parent
 
 
+def available_decoders():
+    params = []
+    for name in decoders.DECODERS[1:]:
+        try:
+            decoders.get_decoder(name)
+        except ValueError:
+            params.append(pytest.param(name, marks=pytest.mark.skip("Not installed")))
+        else:
+            params.append(name)
+    return params
+
+
 def test_version():
     result = CliRunner().invoke(cli.cli, ["--version"])
     assert result.exit_code == 0
@@ -25,7 +71,7 @@ def test_invalid(tmpdir):
     assert 1 == result.exit_code
     assert (
         "Error: GeoJSON must be a Feature or a FeatureCollection"
-        == result.stdout.strip()
+        == result.output.strip()
     )
 
 
@@ -443,3 +489,2199 @@ def test_bundle_properties_spatialite(tmpdir):
         "properties": str,
         "geometry": float,  # no idea why this is float, but it's consistent
     }
+
+
+@pytest.mark.parametrize("decoder", available_decoders())
+@pytest.mark.parametrize("binary", (False, True))
+def test_get_features_streams_feature_collection(decoder, binary):
+    features = [
+        {
+            "type": "Feature",
+            "id": i,
+            "properties": {
+                "name": "feature {} \u00e9\u2603".format(i),
+                "value": i * 1.5,
+                # Things that look like the end of a feature
+                "tricky": '}, {"type": "Feature"}]',
+                "nested": [{"a": {"b": 1}}, {"c": 2}] * (i % 12),
+            },
+            "geometry": {"type": "Point", "coordinates": [i, -i]},
+        }
+        for i in range(5000)
+    ]
+    # "type" after "features" and extra keys either side of the array
+    geojson = json.dumps(
+        {"name": "big", "features": features, "type": "FeatureCollection", "n": 5000}
+    )
+    if binary:
+        fp = io.BytesIO(geojson.encode("utf-8"))
+    else:
+        fp = io.StringIO(geojson)
+    iterator = utils.get_features(fp, decoder=decoder)
+    assert not isinstance(iterator, list)
+    assert next(iterator) == features[0]
+    # Only part of the file should have been read so far
+    assert fp.tell() < len(geojson)
+    assert list(iterator) == features[1:]
+
+
+@pytest.mark.parametrize("decoder", available_decoders())
+def test_get_features_nl_decoder(decoder):
+    with open(testdir / "quakes.ndjson", "rb") as fp:
+        features = list(utils.get_features(fp, nl=True, decoder=decoder))
+    with open(testdir / "quakes.ndjson") as fp:
+        assert features == [json.loads(line) for line in fp]
+
+
+def test_get_decoder():
+    assert decoders.get_decoder("json").name == "json"
+    assert decoders.get_decoder("auto").name in ("orjson", "msgspec", "json")
+    with pytest.raises(ValueError):
+        decoders.get_decoder("simplejson")
+
+
+@pytest.mark.parametrize(
+    "geojson,expected",
+    (
+        ('{"type": "FeatureCollection", "features": []}', []),
+        ('{"type": "FeatureCollection"}', []),
+        (
+            '{"type": "Feature", "properties": {"a": 1}, "geometry": null}',
+            [{"type": "Feature", "properties": {"a": 1}, "geometry": None}],
+        ),
+    ),
+)
+@pytest.mark.parametrize("decoder", available_decoders())
+def test_get_features_small(geojson, expected, decoder):
+    fp = io.StringIO(geojson)
+    assert list(utils.get_features(fp, decoder=decoder)) == expected
+
+
+@pytest.mark.parametrize(
+    "geojson,exception",
+    (
+        ("[]", TypeError),
+        ("", json.JSONDecodeError),
+        ('{"type": "Feature"} {}', json.JSONDecodeError),
+        ('{"type": "Property", "features": []}', ValueError),
+        ('{"features": [{"type": "Feature"}], "type": "Property"}', ValueError),
+        ('{"type": "FeatureCollection", "features": [{}, }', json.JSONDecodeError),
+    ),
+)
+@pytest.mark.parametrize("decoder", available_decoders())
+def test_get_features_errors(geojson, exception, decoder):
+    with pytest.raises(exception):
+        list(utils.get_features(io.BytesIO(geojson.encode()), decoder=decoder))
+
+
+@pytest.mark.parametrize(
+    "geometry",
+    (
+        {"type": "Point", "coordinates": [1.5, -2.25]},
+        {"type": "Point", "coordinates": [1.5, -2.25, 10.0]},
+        {"type": "LineString", "coordinates": [[0, 0], [1, 1], [2, 0]]},
+        {
+            "type": "Polygon",
+            "coordinates": [
+                [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                [[2, 2], [4, 2], [4, 4], [2, 2]],
+            ],
+        },
+        {"type": "MultiPoint", "coordinates": [[0, 0, 1], [1, 1, 2]]},
+        {
+            "type": "MultiLineString",
+            "coordinates": [[[0, 0], [1, 1]], [[2, 2], [3, 3]]],
+        },
+        {
+            "type": "MultiPolygon",
+            "coordinates": [
+                [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+                [[[5, 5], [6, 5], [6, 6], [5, 5]]],
+            ],
+        },
+        {
+            "type": "GeometryCollection",
+            "geometries": [
+                {"type": "Point", "coordinates": [0, 0]},
+                {"type": "LineString", "coordinates": [[0, 0], [1, 1]]},
+            ],
+        },
+    ),
+)
+def test_wkb_encode(geometry):
+    encoded = wkb.encode(geometry)
+    assert isinstance(encoded, bytes)
+    # Should decode to the same geometry, and the same WKT, as the Shapely path
+    decoded = shapely.wkb.loads(encoded)
+    assert decoded.wkt == shape(geometry).wkt
+
+
+def test_wkb_encode_invalid_type():
+    with pytest.raises(ValueError):
+        wkb.encode({"type": "Circle", "coordinates": [0, 0]})
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+def test_geometry_format_wkb_matches_wkt(tmpdir):
+    ndjson = str(testdir / "quakes.ndjson")
+    results = {}
+    for geometry_format in ("wkt", "wkb"):
+        db_path = str(tmpdir / "{}.db".format(geometry_format))
+        result = CliRunner().invoke(
+            cli.cli,
+            [
+                db_path,
+                "features",
+                ndjson,
+                "--nl",
+                "--spatialite",
+                "--geometry-format",
+                geometry_format,
+            ],
+            catch_exceptions=False,
+        )
+        assert 0 == result.exit_code, result.stdout
+        db = sqlite_utils.Database(db_path)
+        db.init_spatialite()
+        results[geometry_format] = db.execute_returning_dicts(
+            "select id, AsText(geometry) as geometry from features order by id"
+        )
+    assert len(results["wkb"]) == 44
+    assert results["wkb"] == results["wkt"]
+
+
+def test_workers_multiple_files(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            db_path,
+            "features",
+            str(testdir / "feature-collection.geojson"),
+            str(testdir / "feature.geojson"),
+            "--workers",
+            "2",
+        ],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.stdout
+    db = sqlite_utils.Database(db_path)
+    rows = list(db["features"].rows)
+    # Files are imported in order, same as without --workers
+    assert [r["slug"] for r in rows] == ["uk", "usa", "uk"]
+
+
+def test_workers_ndjson(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "features", str(testdir / "quakes.ndjson"), "--nl", "--workers", "3"],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.stdout
+    db = sqlite_utils.Database(db_path)
+    assert db["features"].count == 44
+    assert ["id"] == db["features"].pks
+
+
+def test_workers_invalid(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "features", str(testdir / "invalid.geojson"), "--workers", "2"],
+    )
+    assert 1 == result.exit_code
+    assert (
+        "Error: GeoJSON must be a Feature or a FeatureCollection"
+        == result.output.strip()
+    )
+
+
+def test_parallel_iter_tasks_splits_on_lines():
+    path = str(testdir / "quakes.ndjson")
+    tasks = list(parallel.iter_tasks([path], nl=True, chunk_size=1000))
+    assert len(tasks) > 1
+    records = []
+    for task in tasks:
+        records.extend(parallel.convert_task(task, True, "", False, "wkt"))
+    with open(path) as fp:
+        expected = list(
+            utils.yield_records(utils.get_features(fp, True), None, "", False)
+        )
+    assert records == expected
+
+
+def test_parallel_unordered(tmpdir):
+    path = str(testdir / "quakes.ndjson")
+    records = list(
+        parallel.yield_records([path], 3, nl=True, ordered=False, chunk_size=1000)
+    )
+    assert len(records) == 44
+    with open(path) as fp:
+        expected = list(
+            utils.yield_records(utils.get_features(fp, True), None, "", False)
+        )
+    key = lambda record: record["id"]
+    assert sorted(records, key=key) == sorted(expected, key=key)
+
+
+@pytest.mark.parametrize("ordered", (True, False))
+def test_parallel_streams_feature_collections(tmpdir, monkeypatch, ordered):
+    # Whole files come back from the workers in batches
+    monkeypatch.setattr(parallel, "STREAM_BATCH_SIZE", 7)
+    paths = []
+    for i in range(3):
+        path = tmpdir / "collection-{}.geojson".format(i)
+        path.write_text(
+            json.dumps(
+                {
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "properties": {"file": i, "n": n},
+                            "geometry": {"type": "Point", "coordinates": [n, i]},
+                        }
+                        for n in range(50)
+                    ],
+                }
+            ),
+            "utf-8",
+        )
+        paths.append(str(path))
+    records = list(parallel.yield_records(paths, 2, ordered=ordered))
+    expected = [
+        {"file": i, "n": n, "geometry": {"type": "Point", "coordinates": [n, i]}}
+        for i in range(3)
+        for n in range(50)
+    ]
+    if not ordered:
+        key = lambda record: (record["file"], record["n"])
+        records.sort(key=key)
+    assert records == expected
+    # Stopping early does not leave workers waiting to send the rest
+    records = parallel.yield_records(paths, 2, ordered=ordered)
+    assert next(records)["n"] == 0
+    records.close()
+
+
+def test_unordered_with_pk(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "quakes.ndjson")]
+        + ["--nl", "--workers", "2", "--unordered", "--pk", "id"],
+    )
+    assert 1 == result.exit_code
+    assert "Error: --unordered cannot be used with --pk" in result.output
+
+
+@pytest.mark.parametrize("shards", ([], ["--shards", "2"]))
+def test_unordered_with_detected_pk(tmpdir, shards):
+    # quakes.ndjson has ids, so "id" is detected as the primary key
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "quakes.ndjson")]
+        + ["--nl", "--workers", "2", "--unordered"]
+        + shards,
+    )
+    assert 1 == result.exit_code
+    assert (
+        "Error: Records with a primary key cannot be inserted unordered, "
+        "as upserts must be applied in input order" == result.output.strip()
+    )
+
+
+@pytest.mark.parametrize(
+    "options", (["--bulk"], ["--journal-mode", "off", "--synchronous", "off"])
+)
+def test_bulk_load(tmpdir, options):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            db_path,
+            "features",
+            str(testdir / "feature-collection.geojson"),
+            str(testdir / "feature.geojson"),
+            "--batch-size",
+            "1",
+            "--alter",
+        ]
+        + options,
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.stdout
+    db = sqlite_utils.Database(db_path)
+    assert sorted(r["slug"] for r in db["features"].rows) == ["uk", "uk", "usa"]
+    # Settings are not left in their bulk-load state
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+
+def test_bulk_load_single_transaction(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            db_path,
+            "features",
+            str(testdir / "feature-collection.geojson"),
+            str(testdir / "invalid.geojson"),
+            "--bulk",
+            "--batch-size",
+            "1",
+        ],
+    )
+    assert 1 == result.exit_code
+    # The first file should have been rolled back along with the second
+    db = sqlite_utils.Database(db_path)
+    assert "features" not in db.table_names()
+
+
+def test_bulk_load_restores_settings(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "output.db"))
+    db.enable_wal()
+    with utils.bulk_load(db, journal_mode="memory", synchronous="off", exclusive=True):
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "memory"
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 0
+        db["t"].insert({"id": 1})
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert db.execute("PRAGMA locking_mode").fetchone()[0] == "normal"
+    assert db["t"].count == 1
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+@pytest.mark.parametrize(
+    "threshold,expected_message",
+    (
+        ("1", "Spatial index: dropped for a load of 1 or more rows"),
+        ("100", "Spatial index: updating incrementally for 2 rows"),
+    ),
+)
+def test_spatial_index_threshold(tmpdir, threshold, expected_message):
+    db_path = str(tmpdir / "output.db")
+    args = [
+        db_path,
+        "features",
+        str(testdir / "feature-collection.geojson"),
+        "--spatial-index",
+    ]
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert 0 == result.exit_code, result.output
+    assert "Spatial index: will build after inserting" in result.output
+
+    # Append the same features again
+    result = CliRunner().invoke(
+        cli.cli,
+        args + ["--spatial-index-threshold", threshold],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.output
+    assert expected_message in result.output
+
+    db = sqlite_utils.Database(db_path)
+    db.init_spatialite()
+    assert db["features"].count == 4
+    # Either way the index should cover every row
+    assert db["idx_features_geometry"].count == 4
+    assert list(db["geometry_columns"].rows_where("spatial_index_enabled = 1"))
+
+
+@pytest.mark.parametrize("dataset", benchmark.DATASETS)
+def test_benchmark_generate_features(dataset):
+    features = list(benchmark.generate_features(dataset, 5, ids=False))
+    assert len(features) == 5
+    assert all("id" not in feature for feature in features)
+    assert [shape(f["geometry"]).is_valid for f in features] == [True] * 5
+
+
+def test_benchmark_run(tmpdir):
+    results = benchmark.run_benchmarks(
+        ["points"], ["plain", "pk-upsert"], 20, directory=str(tmpdir)
+    )
+    assert [(r["mode"], r["features"]) for r in results] == [
+        ("plain", 20),
+        ("pk-upsert", 20),
+    ]
+    for result in results:
+        assert result["features_per_second"] > 0
+        assert result["db_size_bytes"] > 0
+
+
+def test_import_stats(tmpdir):
+    calls = []
+    stats = ImportStats(callback=lambda stats: calls.append(stats.rows("insert")))
+    stats.interval = 10
+    with open(testdir / "quakes.ndjson") as fp:
+        utils.import_features(
+            str(tmpdir / "output.db"),
+            "features",
+            utils.get_features(fp, nl=True),
+            stats=stats,
+        )
+    stages = stats.as_dict()["stages"]
+    assert set(stages) == {"parse", "convert", "insert"}
+    assert [stages[stage]["rows"] for stage in ("parse", "convert", "insert")] == [
+        44,
+        44,
+        44,
+    ]
+    assert all(stage["seconds"] >= 0 for stage in stages.values())
+    # Called every 10 rows, then once at the end
+    assert calls == [10, 20, 30, 40, 44]
+
+
+def test_import_stats_exclusive_timing():
+    stats = ImportStats()
+    with stats.stage("outer"):
+        with stats.stage("inner"):
+            sum(range(100000))
+    stages = stats.as_dict()["stages"]
+    assert stages["outer"]["seconds"] < stages["inner"]["seconds"]
+
+
+@pytest.mark.parametrize("use_stdin", (False, True))
+def test_progress_and_stats_json(tmpdir, use_stdin):
+    db_path = str(tmpdir / "output.db")
+    stats_path = str(tmpdir / "stats.json")
+    ndjson = testdir / "quakes.ndjson"
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            db_path,
+            "features",
+            "-" if use_stdin else str(ndjson),
+            "--nl",
+            "--progress",
+            "--stats-json",
+            stats_path,
+        ],
+        input=ndjson.read_text() if use_stdin else None,
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.output
+    stats = json.loads(pathlib.Path(stats_path).read_text())
+    assert stats["stages"]["insert"]["rows"] == 44
+    assert stats["elapsed_seconds"] > 0
+
+
+@pytest.fixture
+def late_column_ndjson(tmpdir):
+    # The "extra" property only appears in the second half of the file
+    path = tmpdir / "late.ndjson"
+    with open(path, "w") as fp:
+        for i in range(200):
+            properties = {"n": i}
+            if i >= 100:
+                properties["extra"] = "value {}".format(i)
+            feature = {"type": "Feature", "properties": properties, "geometry": None}
+            fp.write(json.dumps(feature) + "\n")
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "options,should_work",
+    (
+        ([], False),
+        (["--sample-size", "150"], True),
+        (["--sample-size", "50", "--reservoir"], True),
+    ),
+)
+def test_sample_size(tmpdir, late_column_ndjson, options, should_work):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli, [db_path, "features", late_column_ndjson, "--nl"] + options
+    )
+    if not should_work:
+        assert 1 == result.exit_code
+        assert "no column named extra" in str(result.exception)
+        return
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["features"].columns_dict == {"n": int, "geometry": str, "extra": str}
+    assert db["features"].count == 200
+
+
+def test_reservoir_requires_nl(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--reservoir"],
+    )
+    assert 1 == result.exit_code
+    assert "Error: --reservoir can only be used with --nl" in result.output
+
+
+def test_reservoir_sample():
+    sample = utils.reservoir_sample(range(1000), 10, seed=1)
+    assert len(sample) == 10
+    assert len(set(sample)) == 10
+    assert any(item >= 10 for item in sample)
+    assert utils.reservoir_sample(range(5), 10) == [0, 1, 2, 3, 4]
+
+
+def test_sample_nl_features_rewinds():
+    with open(testdir / "quakes.ndjson", "rb") as fp:
+        fp.readline()
+        position = fp.tell()
+        sample = utils.sample_nl_features([fp], 5)
+        assert fp.tell() == position
+        assert len(sample) == 5
+        assert all(feature["type"] == "Feature" for feature in sample)
+
+
+def _write_ndjson(path, features):
+    path.write_text(
+        "".join(json.dumps(feature) + "\n" for feature in features), "utf-8"
+    )
+
+
+def _point_features(count, changed=None):
+    for i in range(count):
+        name = "changed" if i == changed else "feature {}".format(i)
+        yield {
+            "type": "Feature",
+            "properties": {"fid": i, "name": name},
+            "geometry": {"type": "Point", "coordinates": [i, i]},
+        }
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_detect_changes(tmpdir, workers):
+    db_path = str(tmpdir / "output.db")
+    path = tmpdir / "features.ndjson"
+    args = [db_path, "features", str(path), "--nl", "--pk", "fid"]
+    args += ["--detect-changes", "--workers", str(workers)]
+    _write_ndjson(path, _point_features(10))
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert "10 inserted, 0 updated, 0 unchanged, 0 deleted" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert "_geojson_hash" in db["features"].columns_dict
+    # Mark rows to check that unchanged ones are not rewritten
+    db.execute("update features set name = 'untouched' where fid != 3")
+    db.execute("update features set _geojson_hash = 'stale' where fid = 4")
+    _write_ndjson(path, list(_point_features(12, changed=3)))
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert "2 inserted, 2 updated, 8 unchanged, 0 deleted" in result.output
+    names = dict(db.execute("select fid, name from features").fetchall())
+    assert names[3] == "changed"
+    assert names[4] == "feature 4"
+    assert names[5] == "untouched"
+    assert names[11] == "feature 11"
+
+
+def test_delete_missing(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    path = tmpdir / "features.ndjson"
+    args = [db_path, "features", str(path), "--nl", "--pk", "fid"]
+    _write_ndjson(path, _point_features(5))
+    assert 0 == CliRunner().invoke(cli.cli, args + ["--detect-changes"]).exit_code
+    _write_ndjson(path, list(_point_features(5))[2:])
+    stats_path = str(tmpdir / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli, args + ["--delete-missing", "--bulk", "--stats-json", stats_path]
+    )
+    assert 0 == result.exit_code, result.output
+    assert "0 inserted, 0 updated, 3 unchanged, 2 deleted" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert [r[0] for r in db.execute("select fid from features order by fid")] == [
+        2,
+        3,
+        4,
+    ]
+    with open(stats_path) as fp:
+        assert json.load(fp)["changes"] == {
+            "inserted": 0,
+            "updated": 0,
+            "unchanged": 3,
+            "deleted": 2,
+        }
+
+
+def test_detect_changes_requires_pk(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--detect-changes"],
+    )
+    assert 1 == result.exit_code
+    assert "Error: --detect-changes requires --pk" in result.output
+
+
+async def _aiter(items):
+    for item in items:
+        await asyncio.sleep(0)
+        yield item
+
+
+@pytest.mark.parametrize("nl", (False, True))
+def test_import_features_async_bytes(tmpdir, nl):
+    path = testdir / ("quakes.ndjson" if nl else "quakes.geojson")
+    data = path.read_bytes()
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    db_path = str(tmpdir / "output.db")
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0)
+
+    async def run():
+        task = asyncio.ensure_future(ticker())
+        table = await aio.import_features_async(
+            db_path, "quakes", _aiter(chunks), nl=nl, queue_size=2
+        )
+        task.cancel()
+        return table
+
+    table = asyncio.run(run())
+    assert ticks
+    expected = sqlite_utils.Database(memory=True)
+    with open(path, "rb") as fp:
+        utils.import_features(expected, "quakes", utils.get_features(fp, nl))
+    assert table.count == expected["quakes"].count
+    assert list(table.rows) == list(expected["quakes"].rows)
+
+
+def test_import_features_async_features(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    features = list(_point_features(250))
+    table = asyncio.run(
+        aio.import_features_async(db_path, "points", _aiter(features), pk="fid")
+    )
+    assert table.count == 250
+    assert table.pks == ["fid"]
+
+
+def test_import_features_async_source_error(tmpdir):
+    async def failing():
+        yield b'{"type": "FeatureCollection", "features": ['
+        raise IOError("Connection lost")
+
+    with pytest.raises(IOError, match="Connection lost"):
+        asyncio.run(
+            aio.import_features_async(str(tmpdir / "output.db"), "t", failing())
+        )
+
+
+COMPRESSORS = {
+    "gzip": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+}
+
+
+@pytest.mark.parametrize("compression", COMPRESSORS)
+@pytest.mark.parametrize(
+    "filename,options",
+    (
+        ("quakes.geojson", []),
+        ("quakes.ndjson", ["--nl"]),
+        ("quakes.ndjson", ["--nl", "--workers", "2"]),
+    ),
+)
+def test_compressed_input(tmpdir, compression, filename, options):
+    path = tmpdir / (filename + ".compressed")
+    path.write_binary(COMPRESSORS[compression]((testdir / filename).read_bytes()))
+    with open(path, "rb") as fp:
+        assert streams.detect_compression(fp) == compression
+        assert fp.tell() == 0
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(cli.cli, [db_path, "quakes", str(path)] + options)
+    assert 0 == result.exit_code, result.output
+    expected = sqlite_utils.Database(memory=True)
+    with open(testdir / filename, "rb") as fp:
+        features = utils.get_features(fp, "--nl" in options)
+        utils.import_features(expected, "quakes", features)
+    rows = sqlite_utils.Database(db_path)["quakes"].rows
+    assert list(rows) == list(expected["quakes"].rows)
+
+
+def test_detect_compression_uncompressed():
+    assert streams.detect_compression(io.BytesIO(b'{"type": "Feature"}')) is None
+    assert streams.detect_compression(io.StringIO('{"type": "Feature"}')) is None
+
+
+def test_read_ahead_reader_errors():
+    class Failing(io.RawIOBase):
+        def readinto(self, buffer):
+            raise OSError("Read failed")
+
+    reader = io.BufferedReader(streams.ReadAheadReader(Failing()))
+    with pytest.raises(OSError, match="Read failed"):
+        reader.read()
+
+
+def test_read_ahead_reader_stops_when_dropped():
+    reader = streams.ReadAheadReader(io.BytesIO(b"x" * 1000), chunk_size=10)
+    assert reader.read(10) == b"x" * 10
+    thread = reader.thread
+    # The thread is blocked on a full queue until the reader is collected
+    del reader
+    thread.join(2)
+    assert not thread.is_alive()
+
+
+@pytest.mark.parametrize("stop", ("error", "close"))
+def test_get_features_stops_read_ahead(stop):
+    # More than the read-ahead queue holds, so its thread would block
+    line = b'{"type": "Feature", "properties": {}, "geometry": null}\n'
+    data = b"not json\n" if stop == "error" else b""
+    data += line * (streams.READ_AHEAD_CHUNKS * streams.READ_AHEAD_CHUNK_SIZE // 40)
+    before = set(threading.enumerate())
+    features = utils.get_features(
+        io.BufferedReader(io.BytesIO(gzip.compress(data))), True
+    )
+    if stop == "error":
+        # The traceback keeps the generator's frame, and the file, alive
+        with pytest.raises(ValueError) as error:
+            next(features)
+    else:
+        next(features)
+        features.close()
+    started = set(threading.enumerate()) - before
+    for thread in started:
+        thread.join(2)
+    assert not any(thread.is_alive() for thread in started)
+    if stop == "error":
+        assert error.value
+
+
+def _circle_feature(fid, points=720):
+    rnd = random.Random(fid)
+    ring = benchmark._ring(rnd, fid, 0, points)
+    return {
+        "type": "Feature",
+        "properties": {"fid": fid},
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+    }
+
+
+def test_process_records_precision_and_simplify():
+    features = [
+        _circle_feature(1),
+        {"type": "Feature", "properties": {"fid": 2}, "geometry": None},
+    ]
+    options = geometry.GeometryOptions(precision=3, tolerance=0.001, zooms=(2, 12))
+    records = list(
+        utils.yield_records(features, "fid", "", False, "wkt", None, options)
+    )
+    assert records[1]["geometry"] is None
+    assert records[1]["geometry_z2"] is None
+    full = shape(features[0]["geometry"])
+    simplified = shape(json.loads(records[0]["geometry"]))
+    zoom_12 = shape(json.loads(records[0]["geometry_z12"]))
+    zoom_2 = shape(json.loads(records[0]["geometry_z2"]))
+    assert all(
+        round(x, 3) == x and round(y, 3) == y for x, y in simplified.exterior.coords
+    )
+    counts = [len(g.exterior.coords) for g in (full, zoom_12, simplified, zoom_2)]
+    assert counts == sorted(counts, reverse=True)
+    assert counts[0] > counts[2] > counts[3] >= 4
+    assert simplified.is_valid and zoom_2.is_valid
+    assert simplified.area == IsApprox(full.area, delta=full.area * 0.05)
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_simplify_options(tmpdir, workers):
+    path = tmpdir / "circles.ndjson"
+    _write_ndjson(path, [_circle_feature(i) for i in range(5)])
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "circles", str(path), "--nl", "--workers", str(workers)]
+        + ["--precision", "4", "--simplify", "0.0001"]
+        + ["--simplify-zoom", "4", "--simplify-zoom", "10"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["circles"].columns_dict == {
+        "fid": int,
+        "geometry": str,
+        "geometry_z4": str,
+        "geometry_z10": str,
+    }
+    for row in db["circles"].rows:
+        geometry = shape(json.loads(row["geometry"]))
+        zoom_4 = shape(json.loads(row["geometry_z4"]))
+        assert len(zoom_4.exterior.coords) < len(geometry.exterior.coords) < 721
+
+
+@pytest.mark.parametrize("encoding", ("geojson", "twkb"))
+def test_simplify_zoom_existing_table(tmpdir, encoding):
+    # Zoom level and bounding box columns are added to an existing table
+    path = tmpdir / "circles.ndjson"
+    _write_ndjson(path, [_circle_feature(i) for i in range(5)])
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "circles", str(path), "--nl", "--pk", "fid"]
+    args += ["--geometry-encoding", encoding]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    result = CliRunner().invoke(cli.cli, args + ["--simplify-zoom", "4", "--bbox"])
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    column_type = str if encoding == "geojson" else bytes
+    assert db["circles"].columns_dict == {
+        "fid": int,
+        "geometry": column_type,
+        "geometry_z4": column_type,
+        "minx": float,
+        "miny": float,
+        "maxx": float,
+        "maxy": float,
+    }
+    assert db["circles"].count == 5
+    assert all(
+        row["geometry_z4"] is not None and row["minx"] is not None
+        for row in db["circles"].rows
+    )
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+@pytest.mark.parametrize("geometry_format", ("wkt", "wkb"))
+def test_simplify_zoom_spatialite(tmpdir, geometry_format):
+    path = tmpdir / "circles.ndjson"
+    _write_ndjson(path, [_circle_feature(i) for i in range(5)])
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "circles", str(path), "--nl", "--spatialite", "--precision", "6"]
+        + ["--simplify-zoom", "4", "--geometry-format", geometry_format],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    db.init_spatialite()
+    rows = db.execute(
+        "select NumPoints(ExteriorRing(geometry)), "
+        "NumPoints(ExteriorRing(geometry_z4)) from circles"
+    ).fetchall()
+    assert len(rows) == 5
+    assert all(full == 721 and zoom < full for full, zoom in rows)
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_bbox_rtree(tmpdir, workers):
+    db_path = str(tmpdir / "output.db")
+    path = str(testdir / "feature-collection.geojson")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "features", path, "--bbox-rtree", "--workers", str(workers)],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    columns = db["features"].columns_dict
+    assert all(columns[name] is float for name in ("minx", "miny", "maxx", "maxy"))
+    assert {tuple(index.columns) for index in db["features"].indexes} == {
+        ("minx",),
+        ("miny",),
+        ("maxx",),
+        ("maxy",),
+    }
+    rows = {row["slug"]: row for row in db["features"].rows}
+    uk = shape(json.loads(rows["uk"]["geometry"]))
+    # Geometries are stored unchanged when only adding bounding boxes
+    with open(path) as fp:
+        expected = json.load(fp)["features"][0]["geometry"]
+    assert json.loads(rows["uk"]["geometry"]) == expected
+    assert (
+        rows["uk"]["minx"],
+        rows["uk"]["miny"],
+        rows["uk"]["maxx"],
+        rows["uk"]["maxy"],
+    ) == uk.bounds
+    viewport = """
+        select slug from features where rowid in (
+            select id from rtree_features_bbox
+            where minx <= :maxx and maxx >= :minx and miny <= :maxy and maxy >= :miny
+        )
+    """
+    # Around London
+    london = {"minx": -0.5, "miny": 51.3, "maxx": 0.3, "maxy": 51.7}
+    assert [r[0] for r in db.execute(viewport, london)] == ["uk"]
+    # Triggers keep the R*Tree up to date
+    db.execute("delete from features where slug = 'uk'")
+    assert [r[0] for r in db.execute(viewport, london)] == []
+    db["features"].insert(
+        {"slug": "london", "minx": 0, "miny": 51.5, "maxx": 0.1, "maxy": 51.6}
+    )
+    assert [r[0] for r in db.execute(viewport, london)] == ["london"]
+    db.execute("update features set minx = 10, maxx = 11 where slug = 'london'")
+    assert [r[0] for r in db.execute(viewport, london)] == []
+
+
+def _scattered_records(count):
+    rnd = random.Random(0)
+    records = []
+    for i in range(count):
+        point = [rnd.uniform(-180, 180), rnd.uniform(-90, 90)]
+        records.append({"n": i, "geometry": {"type": "Point", "coordinates": point}})
+    records.append({"n": count, "geometry": None})
+    return records
+
+
+@pytest.mark.parametrize("curve", clustering.CURVES)
+def test_cluster_records_spills_to_disk(tmpdir, curve):
+    records = _scattered_records(500)
+    in_memory = list(clustering.cluster_records(records, False, curve=curve))
+    spilled = list(
+        clustering.cluster_records(
+            records, False, curve=curve, run_size=64, directory=str(tmpdir)
+        )
+    )
+    assert spilled == in_memory
+    assert sorted(record["n"] for record in spilled) == list(range(501))
+    # Missing geometries sort last
+    assert spilled[-1]["n"] == 500
+    x = [r["geometry"]["coordinates"][0] for r in spilled[:-1]]
+    y = [r["geometry"]["coordinates"][1] for r in spilled[:-1]]
+    keys = clustering.curve_keys(x, y, curve).tolist()
+    assert keys == sorted(keys)
+
+    # Consecutive rows are much closer together than in the input order
+    def total_distance(records):
+        points = [shape(r["geometry"]) for r in records if r["geometry"]]
+        return sum(a.distance(b) for a, b in zip(points, points[1:]))
+
+    assert total_distance(spilled) < total_distance(records) / 5
+
+
+def test_curve_keys_hilbert_is_continuous():
+    # Each step along the curve moves to an adjacent cell of a 4x4 grid
+    cells = [(x + 0.5, y + 0.5) for x in range(4) for y in range(4)]
+    x, y = zip(*cells)
+    keys = clustering.curve_keys(x, y, "hilbert", (0, 0, 4, 4), order=2)
+    path = [cell for _, cell in sorted(zip(keys.tolist(), cells))]
+    assert sorted(keys.tolist()) == list(range(16))
+    assert all(abs(a[0] - b[0]) + abs(a[1] - b[1]) == 1 for a, b in zip(path, path[1:]))
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_cluster_option(tmpdir, workers):
+    features = [
+        {"type": "Feature", "properties": {"n": r["n"]}, "geometry": r["geometry"]}
+        for r in _scattered_records(200)
+    ]
+    # The files are sorted together, as a single input
+    paths = [tmpdir / "points-1.ndjson", tmpdir / "points-2.ndjson"]
+    _write_ndjson(paths[0], features[:100])
+    _write_ndjson(paths[1], features[100:])
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "points"]
+        + [str(path) for path in paths]
+        + ["--nl", "--cluster", "hilbert", "--workers", str(workers)],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    rows = list(db.query("select n, geometry from points order by rowid"))
+    assert len(rows) == 201
+    points = [json.loads(row["geometry"])["coordinates"] for row in rows[:-1]]
+    keys = clustering.curve_keys(*zip(*points)).tolist()
+    assert keys == sorted(keys)
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--pk", "id"], "Error: --cluster cannot be used with --pk"),
+        (
+            [],
+            "Error: Records with a primary key cannot be clustered, as upserts "
+            "must be applied in input order",
+        ),
+    ),
+)
+def test_cluster_with_pk(tmpdir, args, error):
+    # Sorting would change which copy of a repeated id is kept
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "quakes.ndjson")]
+        + ["--nl", "--cluster", "hilbert"]
+        + args,
+    )
+    assert 1 == result.exit_code
+    assert result.output.strip() == error
+
+
+@pytest.mark.parametrize(
+    "geometry",
+    (
+        {"type": "Point", "coordinates": [-122.4194155, 37.7749295]},
+        {"type": "Point", "coordinates": [1.5, 2.25, 300.125]},
+        {"type": "Point", "coordinates": []},
+        {"type": "LineString", "coordinates": [[0, 0], [1.1234567, -1], [2, 0.5]]},
+        {
+            "type": "Polygon",
+            "coordinates": [
+                [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                [[2, 2], [3, 2], [3, 3], [2, 2]],
+            ],
+        },
+        {"type": "MultiPoint", "coordinates": [[1, 2], [-3, 4.5]]},
+        {
+            "type": "MultiLineString",
+            "coordinates": [[[0, 0], [1, 1]], [[5, 5], [6, 7]]],
+        },
+        {
+            "type": "MultiPolygon",
+            "coordinates": [
+                [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+                [[[170, -80], [180, -80], [180, -70], [170, -80]]],
+            ],
+        },
+        {
+            "type": "GeometryCollection",
+            "geometries": [
+                {"type": "Point", "coordinates": [1, 2]},
+                {"type": "LineString", "coordinates": [[1, 2], [3, 4]]},
+            ],
+        },
+    ),
+)
+def test_twkb_round_trip(geometry):
+    encoded = twkb.encode(geometry)
+    assert twkb.is_twkb(encoded)
+    assert not twkb.is_twkb(wkb.encode(geometry))
+    decoded = twkb.decode(encoded)
+    assert shape(decoded).equals(shape(geometry)) or shape(geometry).is_empty
+    assert decoded["type"] == geometry["type"]
+    assert len(encoded) < len(wkb.encode(geometry))
+
+
+def test_twkb_precision():
+    geometry = {"type": "Point", "coordinates": [1.23456789, -9.87654321]}
+    assert twkb.decode(twkb.encode(geometry, 3))["coordinates"] == [1.235, -9.877]
+    # Spec example: POINT(1 1) at one decimal place
+    point = {"type": "Point", "coordinates": [1, 1]}
+    assert twkb.encode(point, 1) == bytes.fromhex("21001414")
+
+
+@pytest.mark.parametrize("encoding", ("wkb", "twkb"))
+@pytest.mark.parametrize("workers", (1, 2))
+def test_geometry_encoding(tmpdir, encoding, workers):
+    db_path = str(tmpdir / "output.db")
+    path = str(testdir / "quakes.ndjson")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "quakes", path, "--nl", "--geometry-encoding", encoding]
+        + ["--workers", str(workers)],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["quakes"].columns_dict["geometry"] is bytes
+    utils.register_functions(db)
+    with open(path) as fp:
+        expected = {
+            feature["properties"]["id"]: feature["geometry"]
+            for feature in map(json.loads, fp)
+        }
+    rows = db.execute("select id, geometry_to_geojson(geometry) from quakes")
+    for id, geojson in rows:
+        decoded = json.loads(geojson)
+        assert decoded["coordinates"] == [
+            IsApprox(value, delta=1e-7) for value in expected[id]["coordinates"]
+        ]
+    geometry = db.execute("select geometry from quakes limit 1").fetchone()[0]
+    assert utils.geometry_to_geojson(geometry)["type"] == "Point"
+
+
+def test_geometry_encoding_not_with_spatialite(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--spatialite", "--geometry-encoding", "wkb"],
+    )
+    assert 1 == result.exit_code
+    assert "--geometry-encoding cannot be used with SpatiaLite" in result.output
+
+
+def test_geometry_to_geojson_plain():
+    geometry = {"type": "Point", "coordinates": [1, 2]}
+    assert utils.geometry_to_geojson(json.dumps(geometry)) == geometry
+    assert utils.geometry_to_geojson(None) is None
+
+
+@pytest.mark.parametrize("shard_by,extra", (("spatial", []), ("pk", ["--pk", "n"])))
+def test_shards(tmpdir, shard_by, extra):
+    path = tmpdir / "points.ndjson"
+    _write_ndjson(
+        path,
+        (
+            {"type": "Feature", "properties": {"n": r["n"]}, "geometry": r["geometry"]}
+            for r in _scattered_records(300)
+        ),
+    )
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "points", str(path), "--nl", "--shards", "3"]
+        + ["--shard-by", shard_by]
+        + extra,
+    )
+    assert 0 == result.exit_code, result.output
+    for shard in range(3):
+        assert (tmpdir / "output-shard-{}.db".format(shard)).exists()
+    db = sharding.open_sharded(db_path)
+    shards = list(db[sharding.SHARDS_TABLE].rows)
+    assert [row["path"] for row in shards] == [
+        "output-shard-{}.db".format(shard) for shard in range(3)
+    ]
+    assert sum(row["rows"] for row in shards) == 301
+    assert all(row["rows"] for row in shards)
+    rows = db.execute("select n, geometry, _shard from points").fetchall()
+    assert sorted(row[0] for row in rows) == list(range(301))
+    # Shards whose bounding box intersects the query box
+    everywhere = sharding.shards_for_bbox(db, "points", -180, -90, 180, 90)
+    assert everywhere == ["shard_0", "shard_1", "shard_2"]
+    minx, miny, maxx, maxy = [shards[0][c] for c in ("minx", "miny", "maxx", "maxy")]
+    assert "shard_0" in sharding.shards_for_bbox(db, "points", minx, miny, maxx, maxy)
+    if shard_by == "spatial":
+        # Hilbert curve ranges give each shard a distinct area
+        assert sharding.shards_for_bbox(db, "points", 170, -89, 180, -80) != everywhere
+
+
+def test_shards_pk_upsert(tmpdir):
+    path = tmpdir / "points.ndjson"
+    _write_ndjson(path, _point_features(50))
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "points", str(path), "--nl", "--pk", "fid"]
+    args += ["--shards", "2", "--shard-by", "pk"]
+    assert 0 == CliRunner().invoke(cli.cli, args).exit_code
+    _write_ndjson(path, _point_features(50, changed=7))
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    db = sharding.open_sharded(db_path)
+    assert db.execute("select count(*) from points").fetchone()[0] == 50
+    assert db.execute("select name from points where fid = 7").fetchone()[0] == (
+        "changed"
+    )
+
+
+def test_shards_detected_pk_moved_feature(tmpdir):
+    # Features with ids are sharded by their id, so one that moves to a
+    # different part of the world still replaces its old row
+    path = tmpdir / "points.ndjson"
+    features = [
+        {
+            "type": "Feature",
+            "id": i,
+            "properties": {"n": i},
+            "geometry": {"type": "Point", "coordinates": [-170 + i * 10, 0]},
+        }
+        for i in range(30)
+    ]
+    _write_ndjson(path, features)
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "points", str(path), "--nl", "--shards", "2"]
+    assert 0 == CliRunner().invoke(cli.cli, args).exit_code
+    features[1]["geometry"]["coordinates"] = [170, 80]
+    _write_ndjson(path, features)
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    db = sharding.open_sharded(db_path)
+    assert db.execute("select count(*) from points").fetchone()[0] == 30
+    assert db.execute("select count(*) from points where id = 1").fetchone()[0] == 1
+
+
+def test_shard_by_spatial_with_pk(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "quakes.ndjson")]
+        + ["--nl", "--shards", "2", "--shard-by", "spatial"],
+    )
+    assert 1 == result.exit_code
+    assert (
+        "Error: Spatial sharding cannot be used with a primary key, as a feature "
+        "that moved would be upserted into a different shard" == result.output.strip()
+    )
+
+
+def test_shards_limit(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--shards", "11"],
+    )
+    assert 2 == result.exit_code
+    assert "11 is not in the range 2<=x<=10" in result.output
+    with pytest.raises(ValueError):
+        sharding.import_sharded(str(tmpdir / "output.db"), "features", [], 11)
+
+
+def test_shards_reimport_must_match(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "features", str(testdir / "quakes.ndjson"), "--nl"]
+    result = CliRunner().invoke(cli.cli, args + ["--shards", "3"])
+    assert 0 == result.exit_code, result.output
+    # The ids would hash to different shards, duplicating the features
+    result = CliRunner().invoke(cli.cli, args + ["--shards", "5"])
+    assert 1 == result.exit_code
+    assert (
+        "Error: features is already split into 3 shards, so it cannot be "
+        "imported into 5" == result.output.strip()
+    )
+    path = tmpdir / "points.ndjson"
+    _write_ndjson(path, _point_features(20))
+    args = [db_path, "points", str(path), "--nl", "--shards", "2"]
+    assert 0 == CliRunner().invoke(cli.cli, args).exit_code
+    result = CliRunner().invoke(cli.cli, args + ["--pk", "fid"])
+    assert 1 == result.exit_code
+    assert (
+        "Error: points is already sharded by spatial, so it cannot be sharded "
+        "by pk" == result.output.strip()
+    )
+    db = sharding.open_sharded(db_path)
+    assert db.execute("select count(*) from features").fetchone()[0] == 44
+    assert not (tmpdir / "output-shard-3.db").exists()
+    assert db.execute("select count(*) from points").fetchone()[0] == 20
+
+
+def test_shard_by_pk_requires_pk(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--shards", "2", "--shard-by", "pk"],
+    )
+    assert 1 == result.exit_code
+    assert "--shard-by pk requires --pk" in result.output
+
+
+def _fail_after(features, count):
+    for i, feature in enumerate(features):
+        if i == count:
+            raise OSError("disk full")
+        yield feature
+
+
+@pytest.mark.parametrize("nl", (True, False))
+def test_resume(tmpdir, nl):
+    path = tmpdir / "points.geojson"
+    if nl:
+        _write_ndjson(path, _point_features(250))
+    else:
+        path.write_text(
+            json.dumps(
+                {"type": "FeatureCollection", "features": list(_point_features(250))}
+            ),
+            "utf-8",
+        )
+    db_path = str(tmpdir / "output.db")
+    db = sqlite_utils.Database(db_path)
+    with open(str(path), "rb") as fp:
+        checkpoint = checkpoints.Checkpoint.for_file(db, "points", fp)
+        assert not checkpoint.load()
+        features = _fail_after(checkpoint.read_features(fp, nl), 130)
+        with pytest.raises(OSError):
+            utils.import_features(
+                db, "points", features, batch_size=50, checkpoint=checkpoint
+            )
+    # The two complete batches were committed, along with their position
+    assert db["points"].count == 100
+    saved = list(db[checkpoints.CHECKPOINTS_TABLE].rows)
+    assert len(saved) == 1
+    assert saved[0]["features"] == 100
+    assert saved[0]["rows"] == 100
+    if nl:
+        lines = path.read_binary().splitlines(keepends=True)
+        assert saved[0]["offset"] == len(b"".join(lines[:100]))
+    else:
+        assert saved[0]["offset"] is None
+    args = [db_path, "points", str(path), "--resume", "--batch-size", "50"]
+    if nl:
+        args.append("--nl")
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    fids = [row["fid"] for row in db["points"].rows]
+    assert fids == list(range(250))
+    # Progress is forgotten once the import has completed
+    assert db[checkpoints.CHECKPOINTS_TABLE].count == 0
+
+
+def test_resume_changed_file(tmpdir):
+    path = tmpdir / "points.ndjson"
+    _write_ndjson(path, _point_features(10))
+    db = sqlite_utils.Database(str(tmpdir / "output.db"))
+    with open(str(path), "rb") as fp:
+        checkpoint = checkpoints.Checkpoint.for_file(db, "points", fp)
+        checkpoint.commit(5)
+    _write_ndjson(path, _point_features(20))
+    result = CliRunner().invoke(
+        cli.cli, [str(tmpdir / "output.db"), "points", str(path), "--nl", "--resume"]
+    )
+    assert 1 == result.exit_code
+    assert "has changed since the import was checkpointed" in result.output
+
+
+@pytest.mark.parametrize(
+    "extra,option",
+    (
+        (["--workers", "2"], "--workers"),
+        (["--cluster", "hilbert"], "--cluster"),
+        (["--bulk"], "--bulk"),
+    ),
+)
+def test_resume_invalid_options(tmpdir, extra, option):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "features", str(testdir / "feature.geojson")]
+        + ["--resume"]
+        + extra,
+    )
+    assert 1 == result.exit_code
+    assert "--resume cannot be used with {}".format(option) in result.output
+
+
+def _invalid_features():
+    square = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+    bowtie = [[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]
+    unclosed = [[0, 0], [1, 0], [1, 1], [0, 1]]
+    for name, geometry in (
+        ("square", {"type": "Polygon", "coordinates": [square]}),
+        ("bowtie", {"type": "Polygon", "coordinates": [bowtie]}),
+        ("point", {"type": "Point", "coordinates": [1, 2]}),
+        ("unclosed", {"type": "Polygon", "coordinates": [unclosed]}),
+        ("missing", None),
+    ):
+        yield {"type": "Feature", "properties": {"name": name}, "geometry": geometry}
+
+
+def test_validate_repair():
+    records = list(
+        geometry.process_records(
+            utils.yield_records(_invalid_features(), None, "", False),
+            geometry.GeometryOptions(validate="repair"),
+            False,
+        )
+    )
+    assert [record["name"] for record in records] == [
+        "square",
+        "bowtie",
+        "point",
+        "unclosed",
+        "missing",
+    ]
+    geometries = clustering.parse_geometries(
+        [record["geometry"] for record in records], False, None
+    )
+    assert shapely.is_valid(geometries[:4]).all()
+    assert geometries[1].geom_type == "MultiPolygon"
+    assert geometries[3].equals(shapely.box(0, 0, 1, 1))
+    assert records[4]["geometry"] is None
+
+
+def test_validate_repair_precision():
+    unclosed = [[0, 0], [1.123456, 0], [1.123456, 1], [0, 1]]
+    bowtie = [[0, 0], [1.123456, 1], [1.123456, 0], [0, 1], [0, 0]]
+    features = [
+        {"type": "Feature", "properties": {}, "geometry": geometry}
+        for geometry in (
+            {"type": "Polygon", "coordinates": [unclosed]},
+            {"type": "Polygon", "coordinates": [bowtie]},
+        )
+    ]
+    records = list(
+        geometry.process_records(
+            utils.yield_records(features, None, "", False),
+            geometry.GeometryOptions(precision=2, validate="repair"),
+            False,
+        )
+    )
+    geometries = clustering.parse_geometries(
+        [record["geometry"] for record in records], False, None
+    )
+    assert shapely.is_valid(geometries).all()
+    coordinates = shapely.get_coordinates(geometries)
+    assert (coordinates == coordinates.round(2)).all()
+    assert geometries[0].equals(shapely.box(0, 0, 1.12, 1))
+
+
+def test_validate_reject():
+    with pytest.raises(ValueError) as e:
+        list(
+            geometry.process_records(
+                utils.yield_records(_invalid_features(), None, "", False),
+                geometry.GeometryOptions(validate="reject"),
+                False,
+            )
+        )
+    assert str(e.value).startswith("Invalid geometry in feature 1: Self-intersection")
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_validate_quarantine(tmpdir, workers):
+    path = tmpdir / "shapes.ndjson"
+    _write_ndjson(path, _invalid_features())
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "shapes", str(path), "--nl", "--validate", "quarantine"]
+        + ["--workers", str(workers)],
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Wrote 2 features with invalid geometries to shapes_invalid" in (
+        result.output
+    )
+    db = sqlite_utils.Database(db_path)
+    assert [row["name"] for row in db["shapes"].rows] == ["square", "point", "missing"]
+    quarantined = list(db["shapes_invalid"].rows)
+    assert [row["name"] for row in quarantined] == ["bowtie", "unclosed"]
+    assert quarantined[0]["invalid_reason"].startswith("Self-intersection")
+    assert "closed linestring" in quarantined[1]["invalid_reason"]
+    # The original geometry is kept, so it can be inspected or fixed
+    assert json.loads(quarantined[1]["geometry"])["coordinates"][0][-1] == [0, 1]
+
+
+def test_validate_quarantine_shards(tmpdir):
+    path = tmpdir / "shapes.ndjson"
+    _write_ndjson(path, _invalid_features())
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "shapes", str(path), "--nl", "--validate", "quarantine"]
+        + ["--shards", "2"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Wrote 2 features with invalid geometries to shapes_invalid" in (
+        result.output
+    )
+    # Invalid features are kept in the coordinator database, not the shards
+    db = sharding.open_sharded(db_path)
+    assert sorted(row[0] for row in db.execute("select name from shapes")) == [
+        "missing",
+        "point",
+        "square",
+    ]
+    quarantined = db.execute("select name from main.shapes_invalid").fetchall()
+    assert [row[0] for row in quarantined] == ["bowtie", "unclosed"]
+    for shard in range(2):
+        shard_db = sqlite_utils.Database(
+            str(tmpdir / "output-shard-{}.db".format(shard))
+        )
+        assert "shapes_invalid" not in shard_db.table_names()
+
+
+def test_validate_reject_option(tmpdir):
+    path = tmpdir / "shapes.ndjson"
+    _write_ndjson(path, _invalid_features())
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "shapes", str(path), "--nl"]
+        + ["--validate", "reject"],
+    )
+    assert 1 == result.exit_code
+    assert "Invalid geometry in feature 1: Self-intersection" in result.output
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        [],
+        ["--precision", "3"],
+        ["--simplify", "0.001"],
+        ["--geometry-encoding", "wkb"],
+        ["--geometry-encoding", "twkb"],
+    ),
+)
+def test_unclosed_ring_without_validate(tmpdir, args):
+    # Read with its ring closed, rather than failing to parse
+    path = tmpdir / "shapes.ndjson"
+    _write_ndjson(path, _invalid_features())
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli, [db_path, "shapes", str(path), "--nl", "--bbox"] + args
+    )
+    assert 0 == result.exit_code, result.output
+    rows = list(sqlite_utils.Database(db_path)["shapes"].rows)
+    assert [row["name"] for row in rows][3] == "unclosed"
+    assert [rows[3][c] for c in geometry.BBOX_COLUMNS] == [0, 0, 1, 1]
+
+
+def test_unreadable_geometry_without_validate(tmpdir):
+    path = tmpdir / "shapes.ndjson"
+    point_ring = {"type": "Polygon", "coordinates": [[[0, 0]]]}
+    _write_ndjson(
+        path,
+        [{"type": "Feature", "id": 7, "properties": {}, "geometry": point_ring}],
+    )
+    result = CliRunner().invoke(
+        cli.cli, [str(tmpdir / "output.db"), "shapes", str(path), "--nl", "--bbox"]
+    )
+    assert 1 == result.exit_code
+    assert result.output.startswith("Error: Invalid geometry in feature 7: ")
+
+
+def test_flatgeobuf_reader():
+    with open(testdir / "places.fgb", "rb") as fp:
+        assert columnar.detect_format(fp) == "flatgeobuf"
+        reader = flatgeobuf.FlatGeobufReader(fp)
+        assert reader.srid == 4326
+        assert reader.column_types == {
+            "id": int,
+            "name": str,
+            "population": int,
+            "area": float,
+            "capital": int,
+            "founded": str,
+            "tags": str,
+            "code": int,
+            "ratio": float,
+            "flag": bytes,
+        }
+        batches = list(reader.batches(batch_size=3))
+    assert [len(batch.geometry) for batch in batches] == [3, 3, 2]
+    columns = {
+        name: sum((batch.columns[name] for batch in batches), [])
+        for name in reader.column_types
+    }
+    assert columns["name"][:2] == ["Point town", "Río"]
+    assert columns["population"][:3] == [1200, 0, None]
+    assert columns["code"][0] == -3
+    assert columns["capital"][0] == 1
+    assert columns["flag"][0] == b"\x00\x01"
+    assert columns["tags"][0] == '["a", "b"]'
+    geometries = sum((batch.geometry for batch in batches), [])
+    assert geometries[-1] is None
+    assert [shapely.from_wkb(g).wkt for g in geometries[:-1]] == [
+        "POINT (-0.1275 51.507222)",
+        "LINESTRING (0 0, 1 1, 2 0)",
+        "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 2 4, 4 4, 4 2, 2 2))",
+        "MULTIPOLYGON (((0 0, 10 0, 10 10, 0 10, 0 0)), "
+        "((20 20, 21 20, 21 21, 20 20)))",
+        "MULTIPOINT ((1 2), (3 4))",
+        "MULTILINESTRING ((0 0, 1 1), (2 2, 3 3, 4 4))",
+        "GEOMETRYCOLLECTION (POINT (5 5), LINESTRING (6 6, 7 7))",
+    ]
+
+
+@pytest.mark.parametrize("encoding", ("geojson", "wkb"))
+def test_import_flatgeobuf(tmpdir, encoding):
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "places", str(testdir / "places.fgb")]
+    args += ["--geometry-encoding", encoding]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    # The id column is used as the primary key, so importing again updates
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["places"].pks == ["id"]
+    assert db["places"].count == 8
+    row = db["places"].get(1)
+    assert row["name"] == "Point town"
+    assert row["area"] == 3.5
+    assert row["founded"] == "1850-01-01T00:00:00Z"
+    utils.register_functions(db)
+    geometry = db.execute(
+        "select geometry_to_geojson(geometry) from places where id = 3"
+    ).fetchone()[0]
+    assert json.loads(geometry)["type"] == "Polygon"
+    assert db["places"].get(8)["geometry"] is None
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+def test_import_flatgeobuf_spatialite(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli, [db_path, "places", str(testdir / "places.fgb"), "--spatial-index"]
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    db.init_spatialite()
+    rows = db.execute("select id, AsText(geometry) from places order by id").fetchall()
+    assert rows[0] == (1, "POINT(-0.1275 51.507222)")
+    assert "idx_places_geometry" in db.table_names()
+
+
+def test_import_flatgeobuf_existing_table(tmpdir):
+    # The table has no primary key, so the detected id cannot be upserted
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli, [db_path, "places", str(testdir / "feature-collection.geojson")]
+    )
+    assert 0 == result.exit_code, result.output
+    args = [db_path, "places", str(testdir / "places.fgb")]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 1 == result.exit_code
+    assert "Error: table places has no column named" in result.output
+    result = CliRunner().invoke(cli.cli, args + ["--alter"])
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["places"].count == 10
+    assert db["places"].pks == ["rowid"]
+    result = CliRunner().invoke(cli.cli, args + ["--pk", "id"])
+    assert 1 == result.exit_code
+    assert (
+        "Error: places has no primary key or unique index on id, so rows cannot "
+        "be upserted by it" == result.output.strip()
+    )
+    # A unique index is enough to upsert
+    with db.conn:
+        db["places"].delete_where("id is not null")
+        db["places"].create_index(["id"], unique=True)
+    for _ in range(2):
+        result = CliRunner().invoke(cli.cli, args)
+        assert 0 == result.exit_code, result.output
+    assert db["places"].count == 10
+
+
+def test_import_flatgeobuf_invalid_options(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "places", str(testdir / "places.fgb"), "--bbox"],
+    )
+    assert 1 == result.exit_code
+    assert "FlatGeobuf and GeoParquet files cannot be used with --bbox" in (
+        result.output
+    )
+
+
+def _write_geoparquet(path, encoding):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    points = [(-0.1275, 51.507222), (2.3522, 48.8566), None]
+    if encoding == "WKB":
+        geometry = pyarrow.array(
+            [shapely.Point(p).wkb if p else None for p in points], pyarrow.binary()
+        )
+    else:
+        geometry = pyarrow.array(
+            [{"x": p[0], "y": p[1]} if p else None for p in points],
+            pyarrow.struct([("x", pyarrow.float64()), ("y", pyarrow.float64())]),
+        )
+    table = pyarrow.table(
+        {
+            "id": [1, 2, 3],
+            "name": pyarrow.array(["London", "Paris", "Nowhere"]).dictionary_encode(),
+            "founded": pyarrow.array(
+                [datetime.date(47, 1, 1), None, None], pyarrow.date32()
+            ),
+            "tags": [["big"], [], None],
+            "geometry": geometry,
+        }
+    )
+    metadata = {
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": encoding, "geometry_types": ["Point"]}},
+    }
+    table = table.replace_schema_metadata({"geo": json.dumps(metadata)})
+    pyarrow.parquet.write_table(table, str(path))
+
+
+@pytest.mark.parametrize("encoding", ("WKB", "point"))
+def test_import_geoparquet(tmpdir, encoding):
+    path = tmpdir / "places.parquet"
+    _write_geoparquet(path, encoding)
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(cli.cli, [db_path, "places", str(path)])
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["places"].columns_dict == {
+        "id": int,
+        "name": str,
+        "founded": str,
+        "tags": str,
+        "geometry": str,
+    }
+    rows = list(db["places"].rows)
+    assert rows[0]["name"] == "London"
+    assert rows[0]["founded"] == "0047-01-01"
+    assert json.loads(rows[0]["tags"]) == ["big"]
+    assert json.loads(rows[1]["geometry"]) == {
+        "type": "Point",
+        "coordinates": [2.3522, 48.8566],
+    }
+    assert rows[2]["geometry"] is None
+
+
+def test_crs_srid():
+    assert geometry.crs_srid("EPSG:27700") == 27700
+    assert geometry.crs_srid("epsg:3857") == 3857
+    assert geometry.crs_srid("4326") == 4326
+    assert not geometry.needs_reprojection("EPSG:4326", "4326")
+    assert geometry.target_srid(geometry.GeometryOptions(source_crs="EPSG:27700")) == (
+        27700
+    )
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_reproject(tmpdir, workers):
+    pytest.importorskip("pyproj")
+    path = tmpdir / "bng.ndjson"
+    _write_ndjson(
+        path,
+        [
+            {
+                "type": "Feature",
+                "properties": {"name": "Trafalgar"},
+                "geometry": {"type": "Point", "coordinates": [530000, 180000]},
+            },
+            {"type": "Feature", "properties": {"name": "Nowhere"}, "geometry": None},
+        ],
+    )
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "places", str(path), "--nl", "--workers", str(workers)]
+        + ["--source-crs", "EPSG:27700", "--target-crs", "EPSG:4326"],
+    )
+    assert 0 == result.exit_code, result.output
+    rows = list(sqlite_utils.Database(db_path)["places"].rows)
+    x, y = json.loads(rows[0]["geometry"])["coordinates"]
+    assert x == pytest.approx(-0.12835, abs=1e-4)
+    assert y == pytest.approx(51.50399, abs=1e-4)
+    assert rows[1]["geometry"] is None
+
+
+def test_reproject_flatgeobuf(tmpdir):
+    pytest.importorskip("pyproj")
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "places", str(testdir / "places.fgb"), "--target-crs", "EPSG:3857"],
+    )
+    assert 0 == result.exit_code, result.output
+    row = sqlite_utils.Database(db_path)["places"].get(1)
+    x, y = json.loads(row["geometry"])["coordinates"]
+    assert x == pytest.approx(-14193.0, abs=1)
+    assert y == pytest.approx(6711510.6, abs=1)
+
+
+def test_zoom_tolerance_units():
+    pytest.importorskip("pyproj")
+    assert geometry.zoom_tolerance(0) == 360.0 / 256
+    # Metres for British National Grid, and US feet for Massachusetts
+    assert geometry.zoom_tolerance(10, "EPSG:27700") == pytest.approx(152.87, abs=0.01)
+    assert geometry.zoom_tolerance(10, "EPSG:2249") == pytest.approx(501.55, abs=0.01)
+
+
+def _bng_circles(count):
+    rnd = random.Random(0)
+    for i in range(count):
+        centre = shapely.Point(rnd.uniform(100000, 600000), rnd.uniform(0, 1000000))
+        yield {
+            "type": "Feature",
+            "properties": {"n": i},
+            "geometry": shapely.geometry.mapping(centre.buffer(5000, 180)),
+        }
+
+
+@pytest.mark.parametrize(
+    "crs_args,srid",
+    (
+        (["--source-crs", "EPSG:27700"], 27700),
+        (["--source-crs", "EPSG:27700", "--target-crs", "EPSG:3857"], 3857),
+    ),
+)
+def test_projected_crs_zoom_and_cluster(tmpdir, crs_args, srid):
+    # Zoom tolerances and curve positions follow the units of the CRS
+    pytest.importorskip("pyproj")
+    path = tmpdir / "circles.ndjson"
+    _write_ndjson(path, _bng_circles(50))
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "circles", str(path), "--nl", "--simplify-zoom", "6"]
+        + ["--cluster", "hilbert"]
+        + crs_args,
+    )
+    assert 0 == result.exit_code, result.output
+    rows = list(sqlite_utils.Database(db_path).query("select * from circles"))
+    geometries = shapely.from_geojson([row["geometry"] for row in rows])
+    zoom_6 = shapely.from_geojson([row["geometry_z6"] for row in rows])
+    assert all(shapely.get_num_coordinates(geometries) == 721)
+    assert all(shapely.get_num_coordinates(zoom_6) < 20)
+    x, y = clustering.centres(shapely.bounds(geometries), srid)
+    keys = clustering.curve_keys(x, y).tolist()
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+
+def test_projected_crs_spatial_shards(tmpdir):
+    pytest.importorskip("pyproj")
+    path = tmpdir / "circles.ndjson"
+    _write_ndjson(path, _bng_circles(50))
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "circles", str(path), "--nl", "--shards", "2"]
+        + ["--source-crs", "EPSG:27700"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sharding.open_sharded(db_path)
+    counts = [row["rows"] for row in db[sharding.SHARDS_TABLE].rows]
+    assert sum(counts) == 50
+    assert all(counts)
+
+
+def test_reproject_invalid_crs(tmpdir):
+    path = tmpdir / "places.ndjson"
+    _write_ndjson(path, _point_features(1))
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "places", str(path), "--nl"]
+        + ["--target-crs", "not-a-crs"],
+    )
+    assert 1 == result.exit_code
+    assert "Error:" in result.output
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+def test_reproject_spatialite_srid(tmpdir):
+    pytest.importorskip("pyproj")
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "places", str(testdir / "places.fgb"), "--spatialite"]
+        + ["--target-crs", "EPSG:3857"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    db.init_spatialite()
+    srid = db.execute("select SRID(geometry) from places where id = 1").fetchone()
+    assert srid == (3857,)
+    assert db.execute(
+        "select srid from geometry_columns where f_table_name = 'places'"
+    ).fetchone() == (3857,)
+
+
+def test_importer_session(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    with session.Importer(db_path, alter=True) as importer:
+        importer.import_file("quakes", testdir / "quakes.ndjson", nl=True)
+        assert importer.schema.exists("quakes")
+        features = [
+            {
+                "type": "Feature",
+                "properties": {"extra": "new column"},
+                "geometry": {"type": "Point", "coordinates": [1, 2]},
+            }
+        ]
+        importer.import_features("quakes", features)
+        # The cached columns are refreshed after the table was altered
+        assert "extra" in importer.schema.columns("quakes")
+        importer.import_file("places", testdir / "feature-collection.geojson")
+    db = sqlite_utils.Database(db_path)
+    assert db["quakes"].count == 45
+    assert db["places"].count == 2
+
+
+def test_schema_cache(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "output.db"))
+    schema = utils.SchemaCache(db)
+    assert schema.columns("places") is None
+    db["places"].insert({"id": 1, "name": "London"})
+    # Missing tables are not remembered
+    assert schema.columns("places") == {"id", "name"}
+    db["places"].add_column("country", str)
+    assert schema.columns("places") == {"id", "name"}
+    schema.forget("places")
+    assert schema.columns("places") == {"id", "name", "country"}
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Needs Unix sockets")
+def test_serve(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    socket_path = str(tmpdir / "import.sock")
+    messages = []
+
+    def run():
+        # SQLite connections belong to the thread that opened them
+        with session.Importer(db_path) as importer:
+            session.serve(importer, socket_path, log=messages.append)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        for _ in range(100):
+            if messages:
+                break
+            thread.join(0.05)
+        response = session.submit(
+            socket_path, "quakes", [testdir / "quakes.ndjson"], nl=True, precision=1
+        )
+        assert response["rows"] == 44
+        assert response["files"] == 1
+        with pytest.raises(session.JobError) as e:
+            session.submit(socket_path, "quakes", [testdir / "missing.json"])
+        assert "No such file" in str(e.value)
+        with pytest.raises(session.JobError) as e:
+            session.submit(socket_path, "quakes", [], unknown=1)
+        assert str(e.value) == "Unknown job option: unknown"
+    finally:
+        session.shutdown(socket_path, timeout=5)
+        thread.join(5)
+    assert not thread.is_alive()
+    assert not (tmpdir / "import.sock").exists()
+    db = sqlite_utils.Database(db_path)
+    assert db["quakes"].count == 44
+    coordinates = json.loads(next(db["quakes"].rows)["geometry"])["coordinates"]
+    assert coordinates == [round(c, 1) for c in coordinates]
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Needs Unix sockets")
+def test_serve_socket_path_not_a_socket(tmpdir):
+    path = tmpdir / "notes.txt"
+    path.write_text("keep me", "utf-8")
+    with session.Importer(str(tmpdir / "output.db")) as importer:
+        with pytest.raises(ValueError) as e:
+            session.serve(importer, str(path))
+    assert str(e.value) == "{} already exists and is not a socket".format(path)
+    assert path.read_text("utf-8") == "keep me"
+
+
+def test_cli_lazy_imports():
+    # Modules only needed by some options are not loaded for every run
+    code = (
+        "import sys, geojson_to_sqlite.cli; "
+        "print([m for m in {!r} if m in sys.modules])".format(
+            (
+                "pdb",
+                "concurrent.futures",
+                "multiprocessing",
+                "gzip",
+            )
+            + tuple(
+                "geojson_to_sqlite." + module
+                for module in (
+                    "columnar",
+                    "sharding",
+                    "checkpoints",
+                    "clustering",
+                    "dedupe",
+                    "tiles",
+                    "parallel",
+                    "flatgeobuf",
+                )
+            )
+        )
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_cli_option_choices():
+    # The CLI's copies of option choices, kept so it need not import these
+    assert cli.ENCODINGS == geometry.ENCODINGS
+    assert cli.VALIDATE_MODES == geometry.VALIDATE_MODES
+    assert cli.CURVES == clustering.CURVES
+    assert cli.SHARD_BY == sharding.SHARD_BY
+    assert cli.MAX_SHARDS == sharding.MAX_SHARDS
+
+
+def _repeated_features(count):
+    squares = [
+        {"type": "Polygon", "coordinates": [[[i, 0], [i + 1, 0], [i, 1], [i, 0]]]}
+        for i in range(3)
+    ]
+    for i in range(count):
+        yield {
+            "type": "Feature",
+            "id": i,
+            "properties": {"name": "feature {}".format(i)},
+            "geometry": squares[i % 3] if i % 4 else None,
+        }
+
+
+@pytest.mark.parametrize("extra", ([], ["--simplify-zoom", "4", "--bbox"]))
+def test_dedupe_geometries(tmpdir, extra):
+    path = tmpdir / "repeated.ndjson"
+    _write_ndjson(path, _repeated_features(20))
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "shapes", str(path), "--nl", "--dedupe-geometries"] + extra
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert "Stored 3 unique geometries for 20 features" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert "geometry" not in db["shapes"].columns_dict
+    assert db["shapes"].foreign_keys[0].other_table == "shapes_geometries"
+    assert db["shapes_geometries"].count == 3
+    rows = list(db["shapes_with_geometry"].rows_where(order_by="id"))
+    assert rows[0]["geometry"] is None
+    assert json.loads(rows[5]["geometry"])["coordinates"][0][1] == [3, 0]
+    assert rows[2]["geometry_id"] == rows[5]["geometry_id"]
+    if extra:
+        assert rows[5]["geometry_z4"] is not None
+        assert (rows[5]["minx"], rows[5]["maxx"]) == (2, 3)
+    # Geometries stored by an earlier import are reused
+    result = CliRunner().invoke(cli.cli, args + ["--pk", "id"])
+    assert 0 == result.exit_code, result.output
+    assert "Stored 0 unique geometries for 20 features" in result.output
+    assert db["shapes_geometries"].count == 3
+
+
+def test_dedupe_geometries_existing_table(tmpdir):
+    path = tmpdir / "repeated.ndjson"
+    _write_ndjson(path, _repeated_features(4))
+    db_path = str(tmpdir / "output.db")
+    CliRunner().invoke(cli.cli, [db_path, "shapes", str(path), "--nl"])
+    result = CliRunner().invoke(
+        cli.cli, [db_path, "shapes", str(path), "--nl", "--dedupe-geometries"]
+    )
+    assert 1 == result.exit_code
+    assert "shapes already has a geometry column" in result.output
+
+
+def test_dedupe_geometries_invalid_options(tmpdir):
+    path = tmpdir / "repeated.ndjson"
+    _write_ndjson(path, _repeated_features(4))
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "shapes", str(path), "--nl"]
+        + ["--dedupe-geometries", "--cluster", "hilbert"],
+    )
+    assert 1 == result.exit_code
+    assert "--dedupe-geometries cannot be used with --cluster" in result.output
+
+
+def test_geometry_hash():
+    geometry = {"type": "Point", "coordinates": [1.5, 2.25]}
+    reordered = {"coordinates": [1.5, 2.25], "type": "Point"}
+    assert dedupe.geometry_hash(geometry) == dedupe.geometry_hash(reordered)
+    # The same canonical encoding whichever JSON libraries are installed,
+    # including numbers that orjson would write differently
+    large = {"type": "Point", "coordinates": [1e16, 2.5e-7]}
+    assert (
+        dedupe.geometry_hash(large)
+        == hashlib.sha1(b'{"coordinates":[1e+16,2.5e-07],"type":"Point"}').digest()
+    )
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+def test_dedupe_geometries_spatialite(tmpdir):
+    path = tmpdir / "repeated.ndjson"
+    _write_ndjson(path, _repeated_features(20))
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "shapes", str(path), "--nl", "--dedupe-geometries"]
+        + ["--spatial-index"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    db.init_spatialite()
+    assert "idx_shapes_geometries_geometry" in db.table_names()
+    assert db.execute(
+        "select AsText(geometry) from shapes_with_geometry where id = 1"
+    ).fetchone() == ("POLYGON((1 0, 2 0, 1 1, 1 0))",)
+
+
+def test_tile_math():
+    x, y = tiles.tile_xy([-0.1275], [51.507222], 10)
+    assert (x[0], y[0]) == (511, 340)
+    west, south, east, north = tiles.tile_bounds(10, 511, 340)
+    assert west <= -0.1275 <= east and south <= 51.507222 <= north
+    assert tiles.quadkey(3, 3, 5) == "213"
+    assert tiles.quadkey_tile("213") == (3, 3, 5)
+    assert tiles.parse_zoom_range("0-14") == (0, 14)
+    assert tiles.parse_zoom_range("5") == (5, 5)
+    with pytest.raises(ValueError):
+        tiles.parse_zoom_range("14-2")
+
+
+def test_covered_tiles():
+    line = shapely.LineString([(-170, 80), (170, -80)])
+    covered = [(z, x, y) for z, x, y, _ in tiles.covered_tiles([1], [line], 2, 2)]
+    # Tiles in the bounding box that the line does not cross are left out
+    assert (2, 3, 0) not in covered
+    assert (2, 0, 0) in covered and (2, 3, 3) in covered
+    assert len(covered) == 8
+
+
+def _tile_features(path, features):
+    _write_ndjson(
+        path,
+        [
+            {
+                "type": "Feature",
+                "id": fid,
+                "properties": {"name": name},
+                "geometry": geometry,
+            }
+            for fid, name, geometry in features
+        ],
+    )
+
+
+@pytest.mark.parametrize("extra", ([], ["--dedupe-geometries"]))
+def test_tile_zooms(tmpdir, extra):
+    london = {"type": "Point", "coordinates": [-0.1275, 51.507222]}
+    paris = {"type": "Point", "coordinates": [2.3522, 48.8566]}
+    line = {"type": "LineString", "coordinates": [[-10, -10], [10, 10]]}
+    path = tmpdir / "places.ndjson"
+    _tile_features(path, [(1, "London", london), (2, "Line", line), (3, "None", None)])
+    db_path = str(tmpdir / "output.db")
+    args = [db_path, "places", str(path), "--nl", "--tile-zooms", "0-10"] + extra
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert "Tile index: indexed 3 rows for zoom levels 0-10" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert tiles.tile_rowids(db, "places", 10, 511, 340) == [1]
+    assert tiles.tile_rowids(db, "places", 0, 0, 0) == [1, 2]
+    assert tiles.tile_rowids(db, "places", 1, 0, 0) == [1, 2]
+    assert tiles.tile_rowids(db, "places", 1, 1, 1) == [2]
+    # Only the row whose geometry changed, and the deleted row, are redone
+    _tile_features(path, [(1, "Paris", paris), (2, "Line renamed", line)])
+    result = CliRunner().invoke(cli.cli, args + ["--pk", "id", "--delete-missing"])
+    assert 0 == result.exit_code, result.output
+    assert "Tile index: indexed 1 rows" in result.output
+    assert tiles.tile_rowids(db, "places", 10, 511, 340) == []
+    assert tiles.tile_rowids(db, "places", 10, 518, 352) == [1]
+    assert db["places_tiles_pending"].count == 0
+    # A different zoom range rebuilds the index
+    assert tiles.TileIndex(db, "places", 2, 3).update() == 2
+    assert db.execute("select min(z), max(z) from places_tiles").fetchone() == (2, 3)
+
+
+@pytest.mark.parametrize("extra", ([], ["--geometry-encoding", "wkb"]))
+def test_tile_zooms_unclosed_ring(tmpdir, extra):
+    # Stored as given, then read with the ring closed to find its tiles
+    unclosed = {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1]]]}
+    point_ring = {"type": "Polygon", "coordinates": [[[5, 5]]]}
+    features = [(1, "Unclosed", unclosed)]
+    if not extra:
+        # Other encodings reject geometries that cannot be read at all
+        features.append((2, "Unreadable", point_ring))
+    path = tmpdir / "shapes.ndjson"
+    _tile_features(path, features)
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "shapes", str(path), "--nl", "--tile-zooms", "0-2"] + extra,
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert tiles.tile_rowids(db, "shapes", 0, 0, 0) == [1]
+    assert tiles.tile_rowids(db, "shapes", 2, 2, 1) == [1]
+
+
+def test_tile_zooms_invalid(tmpdir):
+    path = tmpdir / "places.ndjson"
+    _write_ndjson(path, _point_features(1))
+    result = CliRunner().invoke(
+        cli.cli,
+        [str(tmpdir / "output.db"), "places", str(path), "--nl"]
+        + ["--tile-zooms", "3-x"],
+    )
+    assert 2 == result.exit_code
+    assert "Zoom range must look like 0-14, not 3-x" in result.output
+
+
+@pytest.mark.skipif(not find_spatialite(), reason="Could not find SpatiaLite")
+def test_tile_zooms_spatialite(tmpdir):
+    db_path = str(tmpdir / "output.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [db_path, "places", str(testdir / "places.fgb"), "--spatialite"]
+        + ["--tile-zooms", "10"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert tiles.tile_rowids(db, "places", 10, 511, 340) == [1]